@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Сравнение скорости записи в локальный memcached: set_multi из python-memcached
+# пачками по N записей (как раньше в memc_load.py) и BinaryMemcClient
+# (SETQ + NOOP одним sendall) пачками заданного размера в байтах.
+# Записи похожи на UserApps из test_data: ключ "idfa:<id>", значение ~ 200 байт.
+
+# $ python memc_bench.py --addr 127.0.0.1:33013 -n 200000
+# $ python memc_bench.py --addr 127.0.0.1:33013 -n 200000 --batch-bytes 65536,262144,1048576
+
+import argparse
+import os
+import time
+
+from memc_binary import BinaryMemcClient, ITEM_OVERHEAD
+
+
+def make_items(count, value_size):
+    return [("idfa:%032x" % i, os.urandom(value_size)) for i in xrange(count)]
+
+
+def bench_set_multi(addr, items, chunk_size):
+    import memcache
+    mc = memcache.Client([addr], socket_timeout=3)
+    errors = 0
+    started = time.time()
+    for i in xrange(0, len(items), chunk_size):
+        errors += len(mc.set_multi(dict(items[i:i + chunk_size])))
+    elapsed = time.time() - started
+    mc.disconnect_all()
+    return elapsed, errors
+
+
+def bench_binary(addr, items, batch_bytes):
+    mc = BinaryMemcClient(addr)
+    started = time.time()
+    batch = []
+    size = 0
+    for key, value in items:
+        batch.append((key, value))
+        size += len(key) + len(value) + ITEM_OVERHEAD
+        if size >= batch_bytes:
+            mc.set_batch(batch)
+            batch = []
+            size = 0
+    if batch:
+        mc.set_batch(batch)
+    mc.close()
+    return time.time() - started, mc.errors
+
+
+def report(name, count, elapsed, errors):
+    print "%-28s %8.2fs %10.0f items/s  errors: %d" % (name, elapsed, count / elapsed, errors)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='set_multi vs pipelined SETQ')
+    parser.add_argument('--addr', action='store', default='127.0.0.1:33013')
+    parser.add_argument('-n', '--items', type=int, action='store', default=100000)
+    parser.add_argument('--value-size', type=int, action='store', default=200)
+    parser.add_argument('--chunk-size', type=int, action='store', default=1000,
+                        help='items in one set_multi call')
+    parser.add_argument('--batch-bytes', action='store', default='65536,262144,1048576',
+                        help='comma separated batch sizes for binary client')
+    parser.add_argument('--skip-set-multi', action='store_true', default=False,
+                        help='do not run python-memcached set_multi')
+    options = parser.parse_args()
+
+    items = make_items(options.items, options.value_size)
+    if not options.skip_set_multi:
+        elapsed, errors = bench_set_multi(options.addr, items, options.chunk_size)
+        report("set_multi %d items" % options.chunk_size, len(items), elapsed, errors)
+    for batch_bytes in options.batch_bytes.split(','):
+        elapsed, errors = bench_binary(options.addr, items, int(batch_bytes))
+        report("binary SETQ %s bytes" % batch_bytes, len(items), elapsed, errors)
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+
+# Клиент memcached для массовой загрузки по бинарному протоколу.
+# Пачка записей отправляется одним sendall: тихие команды SETQ (сервер отвечает
+# только на ошибки) и в конце NOOP. Ответы читает отдельный тред: ответ на NOOP
+# означает, что вся пачка обработана, ответы на SETQ - ошибки записи.
+# Писатель не ждет ответов, число неподтвержденных пачек ограничено max_inflight.
+
+import collections
+import logging
+import socket
+import struct
+import threading
+
+MAGIC_REQUEST = 0x80
+MAGIC_RESPONSE = 0x81
+OP_SETQ = 0x11
+OP_NOOP = 0x0a
+# header: magic, opcode, key length, extras length, data type, vbucket/status,
+# total body length, opaque, cas
+HEADER = struct.Struct("!BBHBBHIIQ")
+# SETQ header with extras: flags, expiration
+SETQ_HEADER = struct.Struct("!BBHBBHIIQII")
+SETQ_EXTRAS_LEN = 8
+# bytes added by protocol to every item
+ITEM_OVERHEAD = SETQ_HEADER.size
+
+MEMC_SOCKET_TIMEOUT = 1.5
+MEMC_MAX_INFLIGHT = 4
+
+
+class Batch(object):
+    def __init__(self, count, noop_opaque):
+        self.count = count
+        self.noop_opaque = noop_opaque
+        self.errors = 0
+
+
+class BinaryMemcClient(object):
+    """Pipelined SETQ writer to one memcached. On connection error all
+    unconfirmed items are counted as errors, next batch reconnects"""
+
+    def __init__(self, addr, timeout=MEMC_SOCKET_TIMEOUT, max_inflight=MEMC_MAX_INFLIGHT):
+        host, _, port = addr.rpartition(":")
+        self.address = (host, int(port))
+        self.timeout = timeout
+        self.max_inflight = max_inflight
+        self.slots = threading.BoundedSemaphore(max_inflight)
+        # connection state and inflight, never held during blocking socket calls
+        self.lock = threading.Lock()
+        # keeps order of batches in inflight the same as on the wire
+        self.send_lock = threading.Lock()
+        self.stats_lock = threading.Lock()
+        self.inflight = collections.deque()
+        self.sock = None
+        self.opaque = 0
+        self.success = 0
+        self.errors = 0
+
+    def connect(self):
+        sock = socket.create_connection(self.address, timeout=self.timeout)
+        reader = threading.Thread(target=self.read_replies, args=(sock,), name="memc-reader")
+        reader.daemon = True
+        self.sock = sock
+        reader.start()
+
+    def set_batch(self, items):
+        """Send list of (key, value) without waiting for replies"""
+        self.slots.acquire()
+        pack = SETQ_HEADER.pack
+        packets = []
+        opaque = self.opaque
+        for key, value in items:
+            body_len = SETQ_EXTRAS_LEN + len(key) + len(value)
+            packets.append(pack(MAGIC_REQUEST, OP_SETQ, len(key), SETQ_EXTRAS_LEN, 0, 0, body_len, opaque, 0, 0, 0))
+            packets.append(key)
+            packets.append(value)
+            opaque = (opaque + 1) & 0xffffffff
+        packets.append(HEADER.pack(MAGIC_REQUEST, OP_NOOP, 0, 0, 0, 0, 0, opaque, 0))
+        self.opaque = (opaque + 1) & 0xffffffff
+        batch = Batch(len(items), opaque)
+
+        with self.send_lock:
+            with self.lock:
+                sock = self.sock
+                try:
+                    if sock is None:
+                        self.connect()
+                        sock = self.sock
+                except socket.error as e:
+                    logging.error("Cannot connect to memc %s:%s: %s", self.address[0], self.address[1], e)
+                    # batch is not in flight
+                    self.count(0, batch.count)
+                    self.slots.release()
+                    return
+                self.inflight.append(batch)
+            try:
+                sock.sendall("".join(packets))
+            except socket.error as e:
+                with self.lock:
+                    if self.sock is sock:
+                        logging.error("Cannot write to memc %s:%s: %s", self.address[0], self.address[1], e)
+                    self.fail(sock)
+
+    def fail(self, sock):
+        """Must be called with lock held"""
+        if self.sock is not sock:
+            return
+        sock.close()
+        self.sock = None
+        while self.inflight:
+            self.count(0, self.inflight.popleft().count)
+            self.slots.release()
+
+    def count(self, success, errors):
+        with self.stats_lock:
+            self.success += success
+            self.errors += errors
+
+    def recv_exactly(self, sock, size, idle_ok):
+        """Wait for data without timeout only if nothing is in flight"""
+        chunks = []
+        while size:
+            try:
+                chunk = sock.recv(size)
+            except socket.timeout:
+                if idle_ok and not chunks:
+                    with self.lock:
+                        idle = not self.inflight
+                    if idle:
+                        continue
+                raise
+            if not chunk:
+                raise socket.error("Connection closed by server")
+            chunks.append(chunk)
+            size -= len(chunk)
+        return "".join(chunks)
+
+    def read_replies(self, sock):
+        try:
+            while True:
+                header = self.recv_exactly(sock, HEADER.size, idle_ok=True)
+                magic, opcode, _, _, _, status, body_len, opaque, _ = HEADER.unpack(header)
+                if body_len:
+                    self.recv_exactly(sock, body_len, idle_ok=False)
+                with self.lock:
+                    if self.sock is not sock:
+                        # connection is already failed, its batches are counted
+                        return
+                    if magic != MAGIC_RESPONSE or not self.inflight:
+                        raise socket.error("Unexpected reply from server")
+                    batch = self.inflight[0]
+                    done = opcode == OP_NOOP and opaque == batch.noop_opaque
+                    if done:
+                        self.inflight.popleft()
+                    elif status:
+                        batch.errors += 1
+                if done:
+                    self.count(batch.count - batch.errors, batch.errors)
+                    self.slots.release()
+        except socket.error as e:
+            with self.lock:
+                if self.sock is sock:
+                    logging.error("Cannot read from memc %s:%s: %s", self.address[0], self.address[1], e)
+                self.fail(sock)
+
+    def wait(self):
+        """Wait until all sent batches are confirmed or failed"""
+        for _ in range(self.max_inflight):
+            self.slots.acquire()
+        for _ in range(self.max_inflight):
+            self.slots.release()
+
+    def close(self):
+        self.wait()
+        with self.lock:
+            if self.sock is not None:
+                self.sock.close()
+                self.sock = None
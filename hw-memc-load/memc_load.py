@@ -1,25 +1,31 @@
 import argparse
 from collections import defaultdict
+import ctypes
 import glob
 import gzip
 import logging
 import threading
-import memcache
 import multiprocessing
-from Queue import Queue
+from multiprocessing.sharedctypes import RawArray
+from Queue import Queue, Empty
 
-from memc_load_single import parse_appsinstalled, dot_rename, prototest
-import appsinstalled_pb2
+from memc_binary import BinaryMemcClient, ITEM_OVERHEAD, MEMC_SOCKET_TIMEOUT
+from memc_load_single import parse_appsinstalled_block, serialize_user_apps, dot_rename, prototest
 
 
-MEMC_SOCKET_TIMEOUT = 1.5
-MEMC_CHUNK_SIZE = 1000
+# batch of items for one memcache is sent when it reaches this size in bytes
+MEMC_BATCH_BYTES = 256 * 1024
+# batches waiting for one memcache thread
+MEMC_QUEUE_SIZE = 16
+# file is read and parsed by blocks of lines
+BLOCK_SIZE = 1024 * 1024
+# shared buffers for blocks in flight
+BLOCKS_PER_PARSER = 2
 TASK_DONE_MSG = None
 
 
 def memc_thread(addr, job_queue, stats_queue, dry):
-    mc = memcache.Client([addr], socket_timeout=MEMC_SOCKET_TIMEOUT)
-    success = errors = 0
+    mc = BinaryMemcClient(addr, timeout=MEMC_SOCKET_TIMEOUT)
     while True:
         job = job_queue.get()
         if job == TASK_DONE_MSG:
@@ -27,87 +33,191 @@ def memc_thread(addr, job_queue, stats_queue, dry):
             break
 
         if not dry:
-            notset_keys = mc.set_multi(dict(job))
-            if notset_keys:
-                logging.info("Couldn't set keys")
-                errors += len(notset_keys)
-                success += len(job) - len(notset_keys)
-            else:
-                success += len(job)
+            # replies are read by client thread, errors are counted there
+            mc.set_batch(job)
         job_queue.task_done()
-    stats_queue.put((success, errors))
+    mc.close()
+    if mc.errors:
+        logging.info("Couldn't set %d keys", mc.errors)
+    stats_queue.put((mc.success, mc.errors))
+
+
+class MemcWriters(object):
+    """Thread with own connection for every memcache, jobs are batched by
+    device type. Queues are bounded, so producer waits for slow memcache"""
+
+    def __init__(self, memc_addr, dry):
+        self.queues = {}
+        self.stat_queue = Queue()
+        self.chunks = defaultdict(list)
+        self.chunks_bytes = defaultdict(int)
+        # lines loaded without non-digit apps
+        self.bad_apps = 0
+        for memc_name, addr in memc_addr.items():
+            self.queues[memc_name] = Queue(MEMC_QUEUE_SIZE)
+            mc_thread = threading.Thread(target=memc_thread,
+                                         args=(addr, self.queues[memc_name], self.stat_queue, dry),
+                                         name=memc_name)
+            mc_thread.daemon = True
+            mc_thread.start()
+
+    def process_block(self, block):
+        """Parse lines, send jobs for memcache threads.
+        Returns amount of processed lines and errors"""
+        parsed = parse_appsinstalled_block(block)
+        errors = parsed.errors
+        self.bad_apps += parsed.bad_apps
+        offsets = parsed.offsets
+        for i, memc_name in enumerate(parsed.dev_type):
+            # get appropriate job queue
+            job_queue = self.queues.get(memc_name)
+            if not job_queue:
+                errors += 1
+                continue
+
+            # send job, msg is serialized UserApps
+            key = "%s:%s" % (memc_name, parsed.dev_id[i])
+            msg = serialize_user_apps(parsed.apps[offsets[i]:offsets[i + 1]], parsed.lat[i], parsed.lon[i])
+            self.chunks[memc_name].append((key, msg))
+            self.chunks_bytes[memc_name] += len(key) + len(msg) + ITEM_OVERHEAD
+            if self.chunks_bytes[memc_name] >= MEMC_BATCH_BYTES:
+                job_queue.put(self.chunks[memc_name])
+                self.chunks[memc_name] = []
+                self.chunks_bytes[memc_name] = 0
+        return parsed.lines, errors
+
+    def finish(self):
+        """Send rest in chunks, wait all threads. Returns success and errors"""
+        if self.bad_apps:
+            logging.info("Not all user apps are digits in %d lines", self.bad_apps)
+        for memc_name, jobs in self.chunks.items():
+            if jobs:
+                self.queues[memc_name].put(jobs)
+
+        # notify all threads that tasks done and wait them
+        for _, q in self.queues.items():
+            q.put(TASK_DONE_MSG)
+            q.join()
+
+        # collect statistics
+        success = errors = 0
+        for _ in self.queues:
+            s, err = self.stat_queue.get()
+            success += s
+            errors += err
+        return success, errors
+
+
+def read_blocks(fd, block_size):
+    """Yields blocks of whole lines not longer than block_size,
+    only line longer than block_size is yielded as bigger block"""
+    tail = ""
+    while True:
+        data = fd.read(block_size - len(tail) if len(tail) < block_size else block_size)
+        if not data:
+            break
+        data = tail + data
+        end = data.rfind("\n") + 1
+        if not end:
+            tail = data
+            continue
+        tail = data[end:]
+        yield data[:end]
+    if tail:
+        yield tail
 
 
 # executes in single process and produces threads for io tasks
 def process_file_worker((fn, memc_addr, dry)):
-    # make jobs queues for every thread and run threads
-    queues = defaultdict(Queue)
-    stat_queue = Queue()
-    for memc_name, addr in memc_addr.items():
-        mc_thread = threading.Thread(target=memc_thread,
-                                     args=(addr, queues[memc_name], stat_queue, dry),
-                                     name=memc_name)
-        mc_thread.daemon = True
-        mc_thread.start()
-
-    # process file and produce job for memcache threads
-    k = 0
-    chunks = defaultdict(list)
+    writers = MemcWriters(memc_addr, dry)
     processed = errors = 0
     logging.info('Processing %s' % fn)
     with gzip.open(fn) as fd:
-        for line in fd:
-            line = line.strip()
-            if not line:
-                continue
-            processed += 1
+        for block in read_blocks(fd, BLOCK_SIZE):
+            p, e = writers.process_block(block)
+            processed += p
+            errors += e
+            logging.info("%s : Processed lines: %d", fn, processed)
 
-            apps_line = parse_appsinstalled(line)
-            if not apps_line:
-                errors += 1
-                continue
+    success, memc_errors = writers.finish()
+    errors += memc_errors
+    logging.info('File %s processed. Lines: %d, success: %d, errors: %d',
+                 fn, processed, success, errors)
 
-            # get appropriate job queue
-            memc_name = apps_line.dev_type
-            job_queue = queues.get(memc_name)
-            if not job_queue:
-                errors += 1
+    return fn, processed, success, errors
+
+
+def parser_worker(memc_addr, dry, buffers, block_queue, free_queue, result_queue):
+    """Takes blocks from shared buffers until TASK_DONE_MSG"""
+    writers = MemcWriters(memc_addr, dry)
+    processed = errors = 0
+    while True:
+        task = block_queue.get()
+        if task == TASK_DONE_MSG:
+            break
+        slot, block = task
+        if slot is not None:
+            # copy out and give buffer back to reader before parsing
+            block = buffers[slot][:block]
+            free_queue.put(slot)
+        p, e = writers.process_block(block)
+        processed += p
+        errors += e
+
+    success, memc_errors = writers.finish()
+    result_queue.put((processed, success, errors + memc_errors))
+
+
+def get_from_parsers(queue, parsers):
+    """Queue.get which does not hang if some parser died"""
+    while True:
+        try:
+            return queue.get(timeout=1)
+        except Empty:
+            if any(p.exitcode for p in parsers):
+                raise RuntimeError("Parser process failed")
+
+
+# one reader decompresses file and gives blocks of lines to parser processes
+def process_file_parallel((fn, memc_addr, dry), parsers_count, block_size):
+    slots = parsers_count * BLOCKS_PER_PARSER
+    buffers = [RawArray('c', block_size) for _ in range(slots)]
+    block_queue = multiprocessing.Queue(slots)
+    free_queue = multiprocessing.Queue()
+    result_queue = multiprocessing.Queue()
+    for slot in range(slots):
+        free_queue.put(slot)
+
+    parsers = []
+    for i in range(parsers_count):
+        parser = multiprocessing.Process(
+            target=parser_worker, name="parser-%d" % i,
+            args=(memc_addr, dry, buffers, block_queue, free_queue, result_queue))
+        parser.daemon = True
+        parser.start()
+        parsers.append(parser)
+
+    logging.info('Processing %s with %d parsers' % (fn, parsers_count))
+    with gzip.open(fn) as fd:
+        for block in read_blocks(fd, block_size):
+            if len(block) > block_size:
+                # too long line, send it through queue
+                block_queue.put((None, block))
                 continue
+            slot = get_from_parsers(free_queue, parsers)
+            ctypes.memmove(buffers[slot], block, len(block))
+            block_queue.put((slot, len(block)))
 
-            # make proto msg
-            apps_proto = appsinstalled_pb2.UserApps()
-            apps_proto.lat = apps_line.lat
-            apps_proto.lon = apps_line.lon
-            apps_proto.apps.extend(apps_line.apps)
-
-            # send job
-            key = "%s:%s" % (memc_name, apps_line.dev_id)
-            msg = apps_proto.SerializeToString()
-            job = (key, msg)
-            chunks[memc_name].append(job)
-            if len(chunks[memc_name]) == MEMC_CHUNK_SIZE:
-                job_queue.put(chunks[memc_name])
-                chunks[memc_name] = []
-                k += 1
-                logging.info("%s : Processed lines: %d", fn, MEMC_CHUNK_SIZE * k)
-
-    # process rest in chunks
-    for memc_name, jobs in chunks.items():
-        if jobs:
-            queues[memc_name].put(jobs)
-
-    # notify all threads that tasks done and wait them
-    for _, q in queues.items():
-        q.put(TASK_DONE_MSG)
-        q.join()
-
-    # collect statistics
-    success = 0
-    for _ in queues:
-        stat = stat_queue.get()
-        s, err = stat
+    for _ in parsers:
+        block_queue.put(TASK_DONE_MSG)
+    processed = success = errors = 0
+    for _ in parsers:
+        p, s, e = get_from_parsers(result_queue, parsers)
+        processed += p
         success += s
-        errors += err
+        errors += e
+    for parser in parsers:
+        parser.join()
 
     logging.info('File %s processed. Lines: %d, success: %d, errors: %d',
                  fn, processed, success, errors)
@@ -129,9 +239,15 @@ def main(options):
     # process older files first
     worker_args = sorted(worker_args, key=lambda x: x[0])
 
-    workers_pool = multiprocessing.Pool(options.workers)
+    if options.parsers:
+        # files one by one, every file is parsed by several processes
+        results = (process_file_parallel(args, options.parsers, options.block_size * 1024)
+                   for args in worker_args)
+    else:
+        workers_pool = multiprocessing.Pool(options.workers)
+        results = workers_pool.imap(process_file_worker, worker_args)
     processed = success = errors = 0
-    for res in workers_pool.imap(process_file_worker, worker_args):
+    for res in results:
         fn, p, s, e = res
         logging.info('Process %s done. Processed: %d, success: %d, errors: %d',
                      fn, p, s, e)
@@ -147,6 +263,10 @@ def main(options):
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Parallel memcache loader')
     parser.add_argument('-w', '--workers', type=int, action='store', default=2)
+    parser.add_argument('-p', '--parsers', type=int, action='store', default=0,
+                        help='parse every file in several processes, workers are not used')
+    parser.add_argument('--block-size', type=int, action='store', default=BLOCK_SIZE // 1024,
+                        help='block of lines for parser, KB')
     parser.add_argument('-t', '--test', action='store_true', default=False)
     parser.add_argument('-l', '--log', action='store', default=None)
     parser.add_argument('--dry', action='store_true', default=False)
@@ -5,17 +5,148 @@ import gzip
 import sys
 import glob
 import logging
+import random
+import socket
+import time
 import collections
+import json
+import struct
+from array import array
+from itertools import repeat
 from optparse import OptionParser
 # brew install protobuf
 # protoc  --python_out=. ./appsinstalled.proto
 # pip install protobuf
 import appsinstalled_pb2
-# pip install python-memcached
-import memcache
 
 NORMAL_ERR_RATE = 0.01
+MEMC_SOCKET_TIMEOUT = 3.0
+MEMC_RETRIES = 3
+# delay before first retry, doubled for every next one
+MEMC_BACKOFF = 0.1
+MEMC_BACKOFF_MAX = 5.0
+# block with bad lines is bisected down to parts of this size parsed line by line
+BISECT_MIN_LINES = 8
 AppsInstalled = collections.namedtuple("AppsInstalled", ["dev_type", "dev_id", "lat", "lon", "apps"])
+APPS_CHARS = "0123456789,"
+# UserApps wire format: apps - field 1, varint; lat, lon - fields 2, 3, fixed64
+APPS_TAG = "\x08"
+GEO_FIELDS = struct.Struct("<BdBd")
+LAT_TAG = 0x11
+LON_TAG = 0x19
+# columns of parsed block, apps of line i are apps[offsets[i]:offsets[i + 1]]
+AppsInstalledBlock = collections.namedtuple("AppsInstalledBlock", [
+    "dev_type", "dev_id", "lat", "lon", "apps", "offsets", "lines", "errors", "bad_apps"])
+
+
+class MemcServerError(Exception):
+    pass
+
+
+class MemcConnection(object):
+    """Persistent connection to memcached, text protocol. Connection is
+    dropped after any socket error and reopened on next command"""
+
+    def __init__(self, addr, timeout=MEMC_SOCKET_TIMEOUT):
+        host, _, port = addr.rpartition(":")
+        self.address = (host, int(port))
+        self.timeout = timeout
+        self.sock = None
+        self.reader = None
+
+    def connect(self):
+        self.sock = socket.create_connection(self.address, timeout=self.timeout)
+        self.reader = self.sock.makefile("rb")
+
+    def close(self):
+        if self.sock is not None:
+            self.reader.close()
+            self.sock.close()
+        self.sock = self.reader = None
+
+    def set(self, key, value):
+        try:
+            if self.sock is None:
+                self.connect()
+            self.sock.sendall("set %s 0 0 %d\r\n%s\r\n" % (key, len(value), value))
+            reply = self.reader.readline()
+        except socket.error:
+            self.close()
+            raise
+        if not reply:
+            self.close()
+            raise socket.error("Connection closed by server")
+        if reply != "STORED\r\n":
+            raise MemcServerError(reply.strip())
+
+
+class MemcPool(object):
+    """Persistent connections by memc_addr. Failed writes are retried with
+    exponential backoff and jitter, failures are counted by kind"""
+
+    def __init__(self, timeout=MEMC_SOCKET_TIMEOUT, retries=MEMC_RETRIES, backoff=MEMC_BACKOFF):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.connections = {}
+        self.stats = collections.Counter()
+
+    def get(self, memc_addr):
+        conn = self.connections.get(memc_addr)
+        if conn is None:
+            conn = self.connections[memc_addr] = MemcConnection(memc_addr, self.timeout)
+        return conn
+
+    def set(self, memc_addr, key, value):
+        """Raises last error if all attempts failed"""
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self.stats["retries"] += 1
+                delay = min(self.backoff * 2 ** (attempt - 1), MEMC_BACKOFF_MAX)
+                time.sleep(random.uniform(delay / 2, delay))
+            try:
+                self.get(memc_addr).set(key, value)
+                return
+            except socket.timeout:
+                self.stats["timeouts"] += 1
+                if attempt == self.retries:
+                    raise
+            except socket.error:
+                self.stats["connection_errors"] += 1
+                if attempt == self.retries:
+                    raise
+            except MemcServerError:
+                self.stats["server_errors"] += 1
+                if attempt == self.retries:
+                    raise
+
+    def close(self):
+        for conn in self.connections.values():
+            conn.close()
+        self.connections.clear()
+
+
+def encode_varint(value):
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return str(out)
+
+
+# encoded apps field for app ids used in practice
+APP_FIELDS = [APPS_TAG + encode_varint(app) for app in xrange(1 << 14)]
+
+
+def serialize_user_apps(apps, lat, lon):
+    """Same bytes as UserApps.SerializeToString with all fields set"""
+    try:
+        encoded_apps = "".join(map(APP_FIELDS.__getitem__, apps))
+    except IndexError:
+        encoded_apps = "".join([APP_FIELDS[app] if app < len(APP_FIELDS) else APPS_TAG + encode_varint(app)
+                                for app in apps])
+    return encoded_apps + GEO_FIELDS.pack(LAT_TAG, lat, LON_TAG, lon)
 
 
 def dot_rename(path):
@@ -24,21 +155,18 @@ def dot_rename(path):
     os.rename(path, os.path.join(head, "." + fn))
 
 
-def insert_appsinstalled(memc_addr, appsinstalled, dry_run=False):
+def insert_appsinstalled(memc_pool, memc_addr, appsinstalled, dry_run=False):
     ua = appsinstalled_pb2.UserApps()
     ua.lat = appsinstalled.lat
     ua.lon = appsinstalled.lon
     key = "%s:%s" % (appsinstalled.dev_type, appsinstalled.dev_id)
     ua.apps.extend(appsinstalled.apps)
     packed = ua.SerializeToString()
-    # @TODO persistent connection
-    # @TODO retry and timeouts!
     try:
         if dry_run:
             logging.debug("%s - %s -> %s" % (memc_addr, key, str(ua).replace("\n", " ")))
         else:
-            memc = memcache.Client([memc_addr])
-            memc.set(key, packed)
+            memc_pool.set(memc_addr, key, packed)
     except Exception, e:
         logging.exception("Cannot write to memc %s: %s" % (memc_addr, e))
         return False
@@ -55,7 +183,7 @@ def parse_appsinstalled(line):
     try:
         apps = [int(a.strip()) for a in raw_apps.split(",")]
     except ValueError:
-        apps = [int(a.strip()) for a in raw_apps.split(",") if a.isidigit()]
+        apps = [int(a.strip()) for a in raw_apps.split(",") if a.strip().isdigit()]
         logging.info("Not all user apps are digits: `%s`" % line)
     try:
         lat, lon = float(lat), float(lon)
@@ -64,6 +192,115 @@ def parse_appsinstalled(line):
     return AppsInstalled(dev_type, dev_id, lat, lon, apps)
 
 
+def parse_appsinstalled_block(block):
+    """Parse block of lines into columns. Malformed lines (not 5 fields, empty
+    dev_type or dev_id) are dropped and counted as errors, the rest of block
+    is converted at once. If lat, lon or apps of some line can't be converted,
+    block is bisected, so only a few lines around the bad one are parsed
+    line by line. Lines with non-digit apps are loaded with the rest of apps.
+    Every line is stripped and empty lines are skipped, as in main"""
+    lines = [line for line in map(str.strip, block.split("\n")) if line]
+    fields = well_formed_fields(lines)
+    parts = []
+    parse_fields_bisect(fields, parts)
+    result = merge_blocks(parts)
+    return result._replace(lines=len(lines), errors=result.errors + len(lines) - len(fields) // 5)
+
+
+def well_formed_fields(lines):
+    """Fields of lines with 5 fields and non-empty dev_type, dev_id, 5 per line"""
+    counts = map(str.count, lines, repeat("\t", len(lines)))
+    if set(counts) - {4}:
+        lines = [line for line, count in zip(lines, counts) if count == 4]
+    if not lines:
+        return []
+    fields = "\t".join(lines).split("\t")
+    if "" in fields[0::5] or "" in fields[1::5]:
+        rows = [fields[i:i + 5] for i in xrange(0, len(fields), 5)]
+        fields = [field for row in rows if row[0] and row[1] for field in row]
+    return fields
+
+
+def parse_fields_bisect(fields, parts):
+    """Append columns of fields to parts. If conversion fails, halves are
+    parsed separately, down to BISECT_MIN_LINES lines parsed line by line"""
+    try:
+        parts.append(parse_fields(fields))
+        return
+    except (ValueError, OverflowError):
+        pass
+    lines = len(fields) // 5
+    if lines <= BISECT_MIN_LINES:
+        parts.append(parse_rows_by_line([fields[i:i + 5] for i in xrange(0, len(fields), 5)]))
+        return
+    middle = lines // 2 * 5
+    parse_fields_bisect(fields[:middle], parts)
+    parse_fields_bisect(fields[middle:], parts)
+
+
+def parse_fields(fields):
+    """Columns of well formed lines, 5 fields per line, all at once"""
+    dev_type, dev_id, raw_apps = fields[0::5], fields[1::5], fields[4::5]
+    lat = array("d", map(float, fields[2::5]))
+    lon = array("d", map(float, fields[3::5]))
+    raw_apps_list = ",".join(raw_apps)
+    # only digits and commas, so json gives list of non-negative ints much faster than int()
+    if raw_apps_list.translate(None, APPS_CHARS):
+        raise ValueError("Not all user apps are digits")
+    apps = array("I", json.loads("[" + raw_apps_list + "]"))
+    offsets = array("I", [0])
+    end = 0
+    for count in map(str.count, raw_apps, repeat(",", len(raw_apps))):
+        end += count + 1
+        offsets.append(end)
+    return AppsInstalledBlock(dev_type, dev_id, lat, lon, apps, offsets, len(dev_type), 0, 0)
+
+
+def merge_blocks(parts):
+    """Concatenate columns of parsed parts of block"""
+    if len(parts) == 1:
+        return parts[0]
+    result = AppsInstalledBlock([], [], array("d"), array("d"), array("I"), array("I", [0]), 0, 0, 0)
+    for part in parts:
+        result.dev_type.extend(part.dev_type)
+        result.dev_id.extend(part.dev_id)
+        result.lat.extend(part.lat)
+        result.lon.extend(part.lon)
+        start = len(result.apps)
+        result.apps.extend(part.apps)
+        result.offsets.extend(array("I", [start + offset for offset in part.offsets[1:]]))
+    return result._replace(lines=sum(part.lines for part in parts),
+                           errors=sum(part.errors for part in parts),
+                           bad_apps=sum(part.bad_apps for part in parts))
+
+
+def parse_rows_by_line(rows):
+    result = AppsInstalledBlock([], [], array("d"), array("d"), array("I"), array("I", [0]), len(rows), 0, 0)
+    errors = bad_apps = 0
+    for row in rows:
+        if len(row) != 5 or not row[0] or not row[1]:
+            errors += 1
+            continue
+        dev_type, dev_id, lat, lon, raw_apps = row
+        try:
+            lat, lon = float(lat), float(lon)
+            try:
+                apps = array("I", [int(a) for a in raw_apps.split(",")])
+            except ValueError:
+                apps = array("I", [int(a) for a in raw_apps.split(",") if a.strip().isdigit()])
+                bad_apps += 1
+        except (ValueError, OverflowError):
+            errors += 1
+            continue
+        result.dev_type.append(dev_type)
+        result.dev_id.append(dev_id)
+        result.lat.append(lat)
+        result.lon.append(lon)
+        result.apps.extend(apps)
+        result.offsets.append(len(result.apps))
+    return result._replace(errors=errors, bad_apps=bad_apps)
+
+
 def main(options):
     device_memc = {
         "idfa": options.idfa,
@@ -71,6 +308,7 @@ def main(options):
         "adid": options.adid,
         "dvid": options.dvid,
     }
+    memc_pool = MemcPool(options.timeout, options.retries)
     for fn in glob.iglob(options.pattern):
         processed = errors = 0
         logging.info('Processing %s' % fn)
@@ -88,7 +326,7 @@ def main(options):
                 errors += 1
                 logging.error("Unknown device type: %s" % appsinstalled.dev_type)
                 continue
-            ok = insert_appsinstalled(memc_addr, appsinstalled, options.dry)
+            ok = insert_appsinstalled(memc_pool, memc_addr, appsinstalled, options.dry)
             if ok:
                 processed += 1
             else:
@@ -105,6 +343,10 @@ def main(options):
             logging.error("High error rate (%s > %s). Failed load" % (err_rate, NORMAL_ERR_RATE))
         fd.close()
         dot_rename(fn)
+    memc_pool.close()
+    logging.info("Memc retries: %d, timeouts: %d, connection errors: %d, server errors: %d" % (
+        memc_pool.stats["retries"], memc_pool.stats["timeouts"],
+        memc_pool.stats["connection_errors"], memc_pool.stats["server_errors"]))
 
 
 def prototest():
@@ -121,6 +363,16 @@ def prototest():
         unpacked = appsinstalled_pb2.UserApps()
         unpacked.ParseFromString(packed)
         assert ua == unpacked
+        assert serialize_user_apps(apps, lat, lon) == packed
+
+    # varint lengths, large app ids and empty apps
+    for apps, lat, lon in (([0, 1, 127, 128, 16383, 16384, 2 ** 21, 2 ** 32 - 1], -55.55, 0.0),
+                           ([], 0.0, -42.42)):
+        ua = appsinstalled_pb2.UserApps()
+        ua.lat = lat
+        ua.lon = lon
+        ua.apps.extend(apps)
+        assert serialize_user_apps(array("I", apps), lat, lon) == ua.SerializeToString()
 
 
 if __name__ == '__main__':
@@ -133,6 +385,8 @@ if __name__ == '__main__':
     op.add_option("--gaid", action="store", default="127.0.0.1:33014")
     op.add_option("--adid", action="store", default="127.0.0.1:33015")
     op.add_option("--dvid", action="store", default="127.0.0.1:33016")
+    op.add_option("--timeout", action="store", type="float", default=MEMC_SOCKET_TIMEOUT)
+    op.add_option("--retries", action="store", type="int", default=MEMC_RETRIES)
     (opts, args) = op.parse_args()
     logging.basicConfig(filename=opts.log, level=logging.INFO if not opts.dry else logging.DEBUG,
                         format='[%(asctime)s] %(levelname).1s %(message)s', datefmt='%Y.%m.%d %H:%M:%S')
@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+
+# $ python -m unittest test
+
+from StringIO import StringIO
+import socket
+import threading
+import unittest
+
+from memc_binary import BinaryMemcClient, HEADER, MAGIC_RESPONSE, OP_NOOP
+from memc_load import read_blocks
+import memc_load_single
+from memc_load_single import MemcPool, MemcServerError, parse_appsinstalled_block
+
+LINES = [
+    "idfa\taaa\t55.55\t42.42\t1423,43,567",
+    "idfa\tbbb\t1.0\t2.0\t",
+    "   ",
+    "gaid\tccc\t3.0\t4.0\t7423,424\r",
+    "",
+    "adid\tddd\t5.0\t6.0\t1,x,2",
+    "dvid\t\t7.0\t8.0\t1",
+    "dvid\teee\tlat\t8.0\t1",
+    " dvid\tfff\t9.0\t10.0\t5 ",
+    "idfa\tggg\t11.0\t12.0\t9",
+]
+
+
+def parse_blocks(blocks):
+    """Rows, lines, errors and lines with bad apps of all blocks"""
+    rows = []
+    lines = errors = bad_apps = 0
+    for block in blocks:
+        parsed = parse_appsinstalled_block(block)
+        for i in range(len(parsed.dev_type)):
+            apps = tuple(parsed.apps[parsed.offsets[i]:parsed.offsets[i + 1]])
+            rows.append((parsed.dev_type[i], parsed.dev_id[i], parsed.lat[i], parsed.lon[i], apps))
+        lines += parsed.lines
+        errors += parsed.errors
+        bad_apps += parsed.bad_apps
+    return rows, lines, errors, bad_apps
+
+
+class TestBlockParser(unittest.TestCase):
+    def test_whole_block(self):
+        rows, lines, errors, bad_apps = parse_blocks(["\n".join(LINES) + "\n"])
+        self.assertEqual(rows, [
+            ("idfa", "aaa", 55.55, 42.42, (1423, 43, 567)),
+            ("gaid", "ccc", 3.0, 4.0, (7423, 424)),
+            ("adid", "ddd", 5.0, 6.0, (1, 2)),
+            ("dvid", "fff", 9.0, 10.0, (5,)),
+            ("idfa", "ggg", 11.0, 12.0, (9,)),
+        ])
+        # whitespace-only and empty lines are skipped, trailing tab makes line malformed
+        self.assertEqual((lines, errors, bad_apps), (8, 3, 1))
+
+    def test_valid_block(self):
+        valid = [LINES[0], LINES[3], LINES[8], LINES[9]]
+        rows, lines, errors, _ = parse_blocks(["\n".join(valid)])
+        self.assertEqual((len(rows), lines, errors), (4, 4, 0))
+
+    def parse_counting_by_line(self, block):
+        self.by_line = []
+        parse_rows_by_line = memc_load_single.parse_rows_by_line
+
+        def counting(rows):
+            self.by_line.append(len(rows))
+            return parse_rows_by_line(rows)
+        memc_load_single.parse_rows_by_line = counting
+        try:
+            return parse_appsinstalled_block(block)
+        finally:
+            memc_load_single.parse_rows_by_line = parse_rows_by_line
+
+    def test_bad_lines_in_large_block(self):
+        valid = ["idfa\tid%d\t%d.5\t-%d.25\t%d,%d" % (i, i, i, i, i + 1) for i in range(1000)]
+        for bad in LINES[1], LINES[5], LINES[6], LINES[7]:
+            block = list(valid)
+            block[517] = bad
+            block[518] = bad
+            block = "\n".join(block)
+            by_line = memc_load_single.parse_rows_by_line([line.strip().split("\t") for line in block.split("\n")])
+            self.assertEqual(self.parse_counting_by_line(block), by_line, bad)
+            # only lines around bad ones are parsed line by line
+            self.assertLessEqual(sum(self.by_line), 2 * memc_load_single.BISECT_MIN_LINES, bad)
+        self.assertEqual(parse_blocks(["\n".join(valid + LINES + valid)])[1:], (2008, 3, 1))
+
+    def test_results_do_not_depend_on_block_boundaries(self):
+        expected = parse_blocks(["\n".join(LINES) + "\n"])
+        for i in range(len(LINES) + 1):
+            blocks = ["\n".join(LINES[:i]), "\n".join(LINES[i:])]
+            self.assertEqual(parse_blocks(blocks), expected, i)
+        self.assertEqual(parse_blocks(LINES), expected)
+        data = "\n".join(LINES) + "\n"
+        for block_size in (1, 7, 16, 64, 1024):
+            self.assertEqual(parse_blocks(read_blocks(StringIO(data), block_size)), expected, block_size)
+
+
+class StubMemcServer(object):
+    """Binary protocol memcached stub: stores SETQ items, replies only to NOOP
+    and to SETQ with keys from fail_keys (status NOT_STORED)"""
+    NOT_STORED = 0x05
+
+    def __init__(self, fail_keys=()):
+        self.fail_keys = set(fail_keys)
+        self.data = {}
+        self.listener = socket.socket()
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(5)
+        self.addr = "127.0.0.1:%d" % self.listener.getsockname()[1]
+        thread = threading.Thread(target=self.serve)
+        thread.daemon = True
+        thread.start()
+
+    def serve(self):
+        conn, _ = self.listener.accept()
+        reader = conn.makefile("rb")
+        while True:
+            header = reader.read(HEADER.size)
+            if len(header) < HEADER.size:
+                break
+            _, opcode, key_len, extras_len, _, _, body_len, opaque, _ = HEADER.unpack(header)
+            body = reader.read(body_len)
+            if opcode == OP_NOOP:
+                conn.sendall(HEADER.pack(MAGIC_RESPONSE, OP_NOOP, 0, 0, 0, 0, 0, opaque, 0))
+                continue
+            key = body[extras_len:extras_len + key_len]
+            if key in self.fail_keys:
+                msg = "Not stored."
+                conn.sendall(HEADER.pack(MAGIC_RESPONSE, opcode, 0, 0, 0, self.NOT_STORED, len(msg), opaque, 0) + msg)
+            else:
+                self.data[key] = body[extras_len + key_len:]
+        conn.close()
+
+    def close(self):
+        self.listener.close()
+
+
+class TestBinaryMemcClient(unittest.TestCase):
+    def items(self, count):
+        return [("idfa:%d" % i, "value %d" % i) for i in range(count)]
+
+    def test_success(self):
+        server = StubMemcServer()
+        mc = BinaryMemcClient(server.addr, max_inflight=2)
+        for i in range(5):
+            mc.set_batch(self.items(100)[i * 20:(i + 1) * 20])
+        mc.close()
+        server.close()
+        self.assertEqual((mc.success, mc.errors), (100, 0))
+        self.assertEqual(server.data, dict(self.items(100)))
+
+    def test_not_stored_quiet_set(self):
+        server = StubMemcServer(fail_keys=["idfa:3", "idfa:17"])
+        mc = BinaryMemcClient(server.addr)
+        mc.set_batch(self.items(10))
+        mc.set_batch(self.items(20)[10:])
+        mc.close()
+        server.close()
+        self.assertEqual((mc.success, mc.errors), (18, 2))
+        self.assertNotIn("idfa:3", server.data)
+
+    def test_connection_refused(self):
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        addr = "127.0.0.1:%d" % listener.getsockname()[1]
+        listener.close()
+        mc = BinaryMemcClient(addr, max_inflight=1)
+        mc.set_batch(self.items(10))
+        mc.set_batch(self.items(5))
+        mc.close()
+        self.assertEqual((mc.success, mc.errors), (0, 15))
+
+
+class StubTextMemcServer(object):
+    """Text protocol memcached stub. Every set takes next action from actions:
+    "stored", "error" (SERVER_ERROR reply), "close" (connection is closed
+    without reply) or "hang" (no reply), "stored" when actions are over"""
+
+    def __init__(self, actions=()):
+        self.actions = list(actions)
+        self.data = {}
+        self.connections = 0
+        self.listener = socket.socket()
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(5)
+        self.addr = "127.0.0.1:%d" % self.listener.getsockname()[1]
+        thread = threading.Thread(target=self.serve)
+        thread.daemon = True
+        thread.start()
+
+    def serve(self):
+        while True:
+            try:
+                conn, _ = self.listener.accept()
+            except socket.error:
+                break
+            self.connections += 1
+            thread = threading.Thread(target=self.handle, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def handle(self, conn):
+        reader = conn.makefile("rb")
+        while True:
+            line = reader.readline()
+            if not line:
+                break
+            _, key, _, _, size = line.split()
+            value = reader.read(int(size) + 2)[:-2]
+            action = self.actions.pop(0) if self.actions else "stored"
+            if action == "close":
+                break
+            elif action == "error":
+                conn.sendall("SERVER_ERROR out of memory\r\n")
+            elif action == "stored":
+                self.data[key] = value
+                conn.sendall("STORED\r\n")
+        reader.close()
+        conn.close()
+
+    def close(self):
+        self.listener.close()
+
+
+class FakeTime(object):
+    def __init__(self):
+        self.delays = []
+
+    def sleep(self, delay):
+        self.delays.append(delay)
+
+
+class TestMemcPool(unittest.TestCase):
+    def setUp(self):
+        self.time = memc_load_single.time
+        memc_load_single.time = FakeTime()
+
+    def tearDown(self):
+        memc_load_single.time = self.time
+
+    def test_success_reuses_connection(self):
+        server = StubTextMemcServer()
+        pool = MemcPool()
+        for i in range(3):
+            pool.set(server.addr, "k%d" % i, "v%d" % i)
+        pool.close()
+        server.close()
+        self.assertEqual(server.data, {"k0": "v0", "k1": "v1", "k2": "v2"})
+        self.assertEqual(server.connections, 1)
+        self.assertEqual(sum(pool.stats.values()), 0)
+
+    def test_timeout_retried(self):
+        server = StubTextMemcServer(["hang"])
+        pool = MemcPool(timeout=0.2, retries=1, backoff=0.1)
+        pool.set(server.addr, "k", "v")
+        pool.close()
+        server.close()
+        self.assertEqual(server.data, {"k": "v"})
+        self.assertEqual(pool.stats, {"timeouts": 1, "retries": 1})
+        # connection with timed out command is not reused
+        self.assertEqual(server.connections, 2)
+
+    def test_reconnect_after_dropped_connection(self):
+        server = StubTextMemcServer(["stored", "close"])
+        pool = MemcPool(retries=1)
+        pool.set(server.addr, "k1", "v1")
+        pool.set(server.addr, "k2", "v2")
+        pool.close()
+        server.close()
+        self.assertEqual(server.data, {"k1": "v1", "k2": "v2"})
+        self.assertEqual(pool.stats, {"connection_errors": 1, "retries": 1})
+        self.assertEqual(server.connections, 2)
+
+    def test_server_error_raised_after_retries(self):
+        server = StubTextMemcServer(["error"] * 3)
+        pool = MemcPool(retries=2, backoff=0.1)
+        with self.assertRaises(MemcServerError):
+            pool.set(server.addr, "k", "v")
+        pool.close()
+        server.close()
+        self.assertEqual(pool.stats, {"server_errors": 3, "retries": 2})
+        # exponential backoff with jitter
+        delays = memc_load_single.time.delays
+        self.assertEqual(len(delays), 2)
+        self.assertTrue(0.05 <= delays[0] <= 0.1 and 0.1 <= delays[1] <= 0.2, delays)
+        # server errors do not drop the connection
+        self.assertEqual(server.connections, 1)
+
+    def test_connection_refused_raised_after_retries(self):
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        addr = "127.0.0.1:%d" % listener.getsockname()[1]
+        listener.close()
+        pool = MemcPool(retries=3, backoff=1)
+        with self.assertRaises(socket.error) as ctx:
+            pool.set(addr, "k", "v")
+        self.assertNotIsInstance(ctx.exception, socket.timeout)
+        self.assertEqual(pool.stats, {"connection_errors": 4, "retries": 3})
+        self.assertEqual(len(memc_load_single.time.delays), 3)
+        self.assertLessEqual(max(memc_load_single.time.delays), memc_load_single.MEMC_BACKOFF_MAX)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -78,19 +78,41 @@
 # $ curl -X POST  -H "Content-Type: application/json" -d '{"account": "horns&hoofs", "login": "admin", "method": "clients_interests", "token": "d3573aff1555cd67dccf21b95fe8c4dc8732f33fd4e32461b7fe6a71d83c947688515e36774c00fb630b039fe2223c991f045f13f24091386050205c324687a0", "arguments": {"client_ids": [1,2,3,4], "date": "20.07.2017"}}' http://127.0.0.1:8080/method/
 # -> {"code": 200, "response": {"1": ["books", "hi-tech"], "2": ["pets", "tv"], "3": ["travel", "music"], "4": ["cinema", "geek"]}}
 
+# Метод online_score_batch.
+# Аргументы:
+# items - массив словарей с аргументами online_score, обязательно, не пустое, не больше 10000 элементов
+
+# Каждый элемент валидируется и скорится отдельно, ошибка в одном элементе не влияет на остальные.
+
+# Контекст
+# в словарь контекста прописывается запись "has" - список списков непустых полей для каждого элемента
+
+# Ответ:
+# {"scores": [{"code": 200, "score": <число>}, {"code": 422, "error": "<невалидные поля>"}, ...]}
+# порядок элементов совпадает с порядком в запросе
+
 # Требование: в результате в git должно быть только два(2!) файлика: api.py, test.py.
 # Deadline: следующее занятие
 
 import abc
 import json
 import random
+import re
 import datetime
 import logging
 import hashlib
+import hmac
+import threading
 import uuid
 from optparse import OptionParser
 from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
 
+import metrics
+from interests import InterestsIndex
+from metrics import timed
+from scoring import get_score, get_interests
+from store import Store, LRUBackend, MemcacheBackend
+
 
 SALT = "Otus"
 ADMIN_LOGIN = "admin"
@@ -99,12 +121,14 @@ OK = 200
 BAD_REQUEST = 400
 FORBIDDEN = 403
 NOT_FOUND = 404
+REQUEST_ENTITY_TOO_LARGE = 413
 INVALID_REQUEST = 422
 INTERNAL_ERROR = 500
 ERRORS = {
     BAD_REQUEST: "Bad Request",
     FORBIDDEN: "Forbidden",
     NOT_FOUND: "Not Found",
+    REQUEST_ENTITY_TOO_LARGE: "Request Entity Too Large",
     INVALID_REQUEST: "Invalid Request",
     INTERNAL_ERROR: "Internal Server Error",
 }
@@ -116,6 +140,11 @@ GENDERS = {
     MALE: "male",
     FEMALE: "female",
 }
+MAX_BATCH_SIZE = 10000
+MAX_BODY_SIZE = 8 * 1024 * 1024
+READ_BLOCK_SIZE = 64 * 1024
+MAX_CHUNK_LINE = 1024
+AUTH_CACHE_SIZE = 10000
 
 
 class Field(object):
@@ -160,28 +189,33 @@ class EmailField(CharField):
 
 class PhoneField(Field):
     empty_values = ('', 0, None)
+    phone_re = re.compile(r'7\d{10}\Z')
 
     def parse_validate(self, value):
         if not isinstance(value, (str, unicode, int, long)):
             raise ValueError("PhoneField must be a string or integer")
         value = str(value)
-        if not (len(value) == 11 and value.startswith('7') and value.isdigit()):
+        if not self.phone_re.match(value):
             raise ValueError("PhoneField must contains 7 with 11 character length")
         return value
         
 
 class DateField(Field):
     empty_values = ('', None)
+    # same as strptime with '%d.%m.%Y', but without parsing format on every call
+    date_re = re.compile(r'(\d{1,2})\.(\d{1,2})\.(\d{4})\Z')
 
     def parse_validate(self, value):
         if not isinstance(value, (str, unicode)):
             raise ValueError("DateField must be a string")
-        value = str(value)
+        match = self.date_re.match(value)
+        if not match:
+            raise ValueError("DateField does not match %d.%m.%Y")
+        day, month, year = match.groups()
         try:
-            dt = datetime.datetime.strptime(value, '%d.%m.%Y')
+            return datetime.date(int(year), int(month), int(day))
         except ValueError:
             raise ValueError("DateField does not match %d.%m.%Y")
-        return dt.date()
 
 
 class BirthDayField(DateField):
@@ -210,6 +244,52 @@ class ClientIDsField(Field):
         return value
 
 
+class ArgumentsListField(Field):
+    empty_values = ([], None)
+
+    def __init__(self, max_length=None, **kwargs):
+        super(ArgumentsListField, self).__init__(**kwargs)
+        self.max_length = max_length
+
+    def parse_validate(self, value):
+        if not (isinstance(value, list) and all(isinstance(a, dict) for a in value)):
+            raise ValueError("ArgumentsListField must be a list of dicts")
+        if self.max_length is not None and len(value) > self.max_length:
+            raise ValueError("ArgumentsListField must contain at most %d items" % self.max_length)
+        return value
+
+
+def compile_clean_fields(fields):
+    """Generate function which does the same as Request.clean_fields_generic,
+    but with loop over fields unrolled and field attributes bound as constants"""
+    namespace = {}
+    lines = ["def clean_fields(self):",
+             "    request = self.request",
+             "    invalid = self.invalid_fieldnames"]
+    for i, field in enumerate(fields):
+        empty_values, parse_validate = "empty_values_%d" % i, "parse_validate_%d" % i
+        namespace[empty_values] = field.empty_values
+        namespace[parse_validate] = field.parse_validate
+        lines.append("    if %r not in request:" % field.name)
+        if field.required:
+            lines.append("        invalid.append(%r)" % field.name)
+        lines.append("        self.%s = None" % field.name)
+        lines.append("    else:")
+        lines.append("        value = request[%r]" % field.name)
+        lines.append("        if value in %s:" % empty_values)
+        if not field.nullable:
+            lines.append("            invalid.append(%r)" % field.name)
+        lines.append("            self.%s = value" % field.name)
+        lines.append("        else:")
+        lines.append("            try:")
+        lines.append("                self.%s = %s(value)" % (field.name, parse_validate))
+        lines.append("            except ValueError:")
+        lines.append("                invalid.append(%r)" % field.name)
+    code = compile("\n".join(lines), "<clean_fields>", "exec")
+    exec code in namespace
+    return namespace["clean_fields"]
+
+
 class RequestMeta(type):
     def __new__(mcs, name, bases, attr_dict):
         fields = []
@@ -219,11 +299,12 @@ class RequestMeta(type):
                 fields.append(v)
         cls = type.__new__(mcs, name, bases, attr_dict)
         cls.fields = fields
+        cls.clean_fields = compile_clean_fields(fields)
         return cls
 
 
 class Request(object):
-    __metaclass__ = RequestMeta   # creates cls.fields = [field1, ...]
+    __metaclass__ = RequestMeta   # creates cls.fields = [field1, ...] and cls.clean_fields
 
     def __init__(self, request):
         self.request = request
@@ -233,6 +314,11 @@ class Request(object):
     def clean(self):
         """Parse fields and set values to instance:
         e.x. self.fieldname = parsed_value"""
+        self.clean_fields()
+        self.clean_done = True
+
+    def clean_fields_generic(self):
+        """Reference implementation of clean_fields generated by RequestMeta"""
         for field in self.fields:
             field_name = field.name
 
@@ -256,7 +342,6 @@ class Request(object):
                 self.invalid_fieldnames.append(field_name)
                 continue
             setattr(self, field_name, parsed_value)
-        self.clean_done = True
 
     def is_valid(self):
         if not self.clean_done:
@@ -327,12 +412,59 @@ class OnlineScoreRequest(Request):
             self.clean_done = True
 
 
+class OnlineScoreBatchRequest(Request):
+    items = ArgumentsListField(required=True, max_length=MAX_BATCH_SIZE)
+
+
+class AuthCache(object):
+    """Successfully verified (account, login, token) with hit/miss counters.
+    Failed checks are never cached, so size is bounded by amount of valid users"""
+
+    def __init__(self, maxsize=AUTH_CACHE_SIZE):
+        self.tokens = LRUBackend(maxsize)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def check(self, key):
+        found = self.tokens.get(key) is not None
+        with self.lock:
+            if found:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return found
+
+    def add(self, key, expire=None):
+        self.tokens.set(key, True, expire)
+
+
+auth_cache = AuthCache()
+
+
+def seconds_to_next_hour(now):
+    next_hour = now.replace(minute=0, second=0, microsecond=0) + datetime.timedelta(hours=1)
+    return (next_hour - now).total_seconds()
+
+
 def check_auth(request):
+    token = request.token or ""
+    if isinstance(token, unicode):
+        token = token.encode("utf-8")
+    key = (request.account, request.login, token)
+    if auth_cache.check(key):
+        return True
+
     if request.login == ADMIN_LOGIN:
-        digest = hashlib.sha512(datetime.datetime.now().strftime("%Y%m%d%H") + ADMIN_SALT).hexdigest()
+        # admin token changes every hour
+        now = datetime.datetime.now()
+        digest = hashlib.sha512(now.strftime("%Y%m%d%H") + ADMIN_SALT).hexdigest()
+        expire = seconds_to_next_hour(now)
     else:
-        digest = hashlib.sha512(request.account + request.login + SALT).hexdigest()
-    if digest == request.token:
+        digest = hashlib.sha512((request.account or "") + request.login + SALT).hexdigest()
+        expire = None
+    if hmac.compare_digest(digest, token):
+        auth_cache.add(key, expire)
         return True
     return False
 
@@ -340,19 +472,23 @@ def check_auth(request):
 class MethodHandler(object):
     __metaclass__ = abc.ABCMeta
 
-    def __init__(self, method_request, ctx):
+    def __init__(self, method_request, ctx, store):
         assert isinstance(method_request, MethodRequest)
         assert isinstance(ctx, dict)
         assert issubclass(self.cls_request, Request)
 
         self.method_request = method_request
         self.ctx = ctx
+        self.store = store
         self.request = self.cls_request(method_request.arguments)
 
     def handle(self):
-        if not self.request.is_valid():
+        with timed(self.ctx, "validation"):
+            is_valid = self.request.is_valid()
+        if not is_valid:
             return self.request.errors_text(), INVALID_REQUEST
-        return self.process_request()
+        with timed(self.ctx, "handler"):
+            return self.process_request()
 
     @abc.abstractproperty
     def cls_request(self):
@@ -368,94 +504,261 @@ class MethodHandlerOnlineScore(MethodHandler):
 
     def process_request(self):
         self.ctx['has'] = self.request.not_empty_fieldnames
+        return {'score': self.get_score(self.request)}, OK
+
+    def get_score(self, request):
         if self.method_request.is_admin:
-            return {'score': 42}, OK
-        else:
-            return {'score': random.randrange(0, 100)}, OK
+            return 42
+        return get_score(self.store,
+                         phone=request.phone,
+                         email=request.email,
+                         first_name=request.first_name,
+                         last_name=request.last_name,
+                         birthday=request.birthday,
+                         gender=request.gender)
+
+
+class MethodHandlerOnlineScoreBatch(MethodHandlerOnlineScore):
+    """Scores list of online_score arguments in one call.
+    Every item is validated and scored on its own, the response keeps items order:
+    {"scores": [{"code": 200, "score": 5.0}, {"code": 422, "error": "phone"}, ...]}
+    ctx["has"] contains not empty fieldnames of every item (empty list for invalid one)"""
+    cls_request = OnlineScoreBatchRequest
+
+    def process_request(self):
+        scores = []
+        has = []
+        for arguments in self.request.items:
+            request = OnlineScoreRequest(arguments)
+            if not request.is_valid():
+                scores.append({'code': INVALID_REQUEST, 'error': request.errors_text()})
+                has.append([])
+                continue
+            scores.append({'code': OK, 'score': self.get_score(request)})
+            has.append(request.not_empty_fieldnames)
+        self.ctx['has'] = has
+        return {'scores': scores}, OK
 
 
 class MethodHandlerClientsInterests(MethodHandler):
     cls_request = ClientsInterestsRequest
+    # used for clients without interests in store
+    random_interests = ['coding', 'sport', 'tv', 'books', 'education']
 
     def process_request(self):
-        interests = ['coding', 'sport', 'tv', 'books', 'education']
-
-        res = {c: random.sample(interests, random.randint(1, len(interests)))
-               for c in self.request.client_ids}
+        if interests_index is not None:
+            res = interests_index.get_interests(self.request.client_ids)
+            self.ctx['nclients'] = len(self.request.client_ids)
+            return res, OK
+
+        res = {}
+        for c in self.request.client_ids:
+            interests = get_interests(self.store, c)
+            if not interests:
+                interests = random.sample(self.random_interests, random.randint(1, len(self.random_interests)))
+            res[c] = interests
         self.ctx['nclients'] = len(self.request.client_ids)
         return res, OK
 
 
-def method_handler(request_raw, ctx):
+default_store = Store(LRUBackend())
+# set at startup with --interests option, otherwise interests are read from store
+interests_index = None
+api_handler_class = {
+    'online_score': MethodHandlerOnlineScore,
+    'online_score_batch': MethodHandlerOnlineScoreBatch,
+    'clients_interests': MethodHandlerClientsInterests
+}
+
+
+def method_handler(request_raw, ctx, store=None):
+    if store is None:
+        store = default_store
     request = MethodRequest(request_raw['body'])
 
-    if not request.is_valid():
+    with timed(ctx, "validation"):
+        is_valid = request.is_valid()
+    if not is_valid:
         return request.errors_text(), INVALID_REQUEST
-    if not request.check_auth():
+    with timed(ctx, "auth"):
+        is_authorized = request.check_auth()
+    if not is_authorized:
         return None, FORBIDDEN
 
-    api_handler_class = {
-        'online_score': MethodHandlerOnlineScore,
-        'clients_interests': MethodHandlerClientsInterests
-    }
-
     if request.method not in api_handler_class:
         return None, NOT_FOUND
 
-    return api_handler_class[request.method](request, ctx).handle()
+    return api_handler_class[request.method](request, ctx, store).handle()
+
+
+class RequestBodyError(Exception):
+    def __init__(self, code):
+        super(RequestBodyError, self).__init__(ERRORS[code])
+        self.code = code
+
+
+def read_body(rfile, headers, max_size=MAX_BODY_SIZE):
+    """Read request body by blocks. Raise RequestBodyError with 413 as soon
+    as body is known to be larger than max_size, before reading the rest of it"""
+    if headers.get("Transfer-Encoding", "").lower() == "chunked":
+        return read_chunked_body(rfile, max_size)
+    try:
+        length = int(headers.get("Content-Length"))
+    except (TypeError, ValueError):
+        raise RequestBodyError(BAD_REQUEST)
+    if length < 0:
+        raise RequestBodyError(BAD_REQUEST)
+    if length > max_size:
+        raise RequestBodyError(REQUEST_ENTITY_TOO_LARGE)
+    return read_exactly(rfile, length)
+
+
+def read_exactly(rfile, length):
+    blocks = []
+    while length:
+        block = rfile.read(min(length, READ_BLOCK_SIZE))
+        if not block:
+            raise RequestBodyError(BAD_REQUEST)
+        blocks.append(block)
+        length -= len(block)
+    return "".join(blocks)
+
+
+def read_chunked_body(rfile, max_size):
+    blocks = []
+    size = 0
+    while True:
+        line = rfile.readline(MAX_CHUNK_LINE)
+        try:
+            # chunk extensions after ';' are ignored
+            chunk_size = int(line.split(";", 1)[0].strip(), 16)
+        except ValueError:
+            raise RequestBodyError(BAD_REQUEST)
+        if chunk_size == 0:
+            break
+        size += chunk_size
+        if size > max_size:
+            raise RequestBodyError(REQUEST_ENTITY_TOO_LARGE)
+        blocks.append(read_exactly(rfile, chunk_size))
+        if rfile.readline(MAX_CHUNK_LINE).strip():
+            raise RequestBodyError(BAD_REQUEST)
+    # skip trailer headers
+    while rfile.readline(MAX_CHUNK_LINE).strip():
+        pass
+    return "".join(blocks)
+
+
+def get_request_id(headers):
+    return headers.get('HTTP_X_REQUEST_ID', uuid.uuid4().hex)
+
+
+def process_http_request(router, path, data_string, headers, store=None):
+    """Route raw POST body to handler. Returns status code and response dict.
+    Shared by threaded and async servers"""
+    start = metrics.timer()
+    response, code = {}, OK
+    context = {"request_id": get_request_id(headers)}
+    request = None
+    try:
+        with timed(context, "parse"):
+            request = json.loads(data_string, 'utf8')
+    except Exception:
+        code = BAD_REQUEST
+
+    if request:
+        logging.info("%s: %s %s" % (path, data_string, context["request_id"]))
+        route = path.strip("/")
+        if route in router:
+            try:
+                response, code = router[route]({"body": request, "headers": headers}, context, store)
+            except Exception, e:
+                logging.exception("Unexpected error: %s" % e)
+                code = INTERNAL_ERROR
+        else:
+            code = NOT_FOUND
+
+    if code not in ERRORS:
+        r = {"response": response, "code": code}
+    else:
+        r = {"error": response or ERRORS.get(code, "Unknown Error"), "code": code}
+    timings = context.setdefault("timings", {})
+    timings["total"] = metrics.timer() - start
+    metrics.observe_request(get_method_label(request), code, timings)
+    context.update(r)
+    logging.info(context)
+    return code, r
+
+
+def get_method_label(request):
+    """Method name for metrics, only known methods to keep labels bounded"""
+    method = request.get("method") if isinstance(request, dict) else None
+    if isinstance(method, basestring) and method in api_handler_class:
+        return method
+    return "unknown"
+
+
+def make_store(memc_addr=None):
+    if not memc_addr:
+        return Store(LRUBackend())
+    host, port = memc_addr.rsplit(":", 1)
+    return Store(MemcacheBackend(host, int(port)))
 
 
 class MainHTTPHandler(BaseHTTPRequestHandler):
     router = {
         "method": method_handler
     }
+    store = None
+    max_body_size = MAX_BODY_SIZE
 
     def get_request_id(self, headers):
-        return headers.get('HTTP_X_REQUEST_ID', uuid.uuid4().hex)
+        return get_request_id(headers)
 
     def do_POST(self):
-        response, code = {}, OK
-        context = {"request_id": self.get_request_id(self.headers)}
-        request = None
         try:
-            data_string = self.rfile.read(int(self.headers['Content-Length']))
-            request = json.loads(data_string, 'utf8')
-        except Exception as e:
-            code = BAD_REQUEST
-
-        if request:
-            path = self.path.strip("/")
-            logging.info("%s: %s %s" % (self.path, data_string, context["request_id"]))
-            if path in self.router:
-                try:
-                    response, code = self.router[path]({"body": request, "headers": self.headers}, context)
-                except Exception, e:
-                    logging.exception("Unexpected error: %s" % e)
-                    code = INTERNAL_ERROR
-            else:
-                code = NOT_FOUND
-
+            data_string = read_body(self.rfile, self.headers, self.max_body_size)
+        except RequestBodyError as e:
+            logging.info("%s: %s" % (self.path, e))
+            # the rest of body is not read, connection can't be reused
+            self.close_connection = 1
+            self.send_json(e.code, {"error": ERRORS[e.code], "code": e.code})
+            return
+        code, r = process_http_request(self.router, self.path, data_string, self.headers, self.store)
+        self.send_json(code, r)
+
+    def send_json(self, code, r):
         self.send_response(code)
         self.send_header("Content-Type", "application/json")
         self.end_headers()
-        if code not in ERRORS:
-            r = {"response": response, "code": code}
-        else:
-            r = {"error": response or ERRORS.get(code, "Unknown Error"), "code": code}
-        context.update(r)
-        logging.info(context)
         self.wfile.write(json.dumps(r))
-        return
+
+    def do_GET(self):
+        if self.path.strip("/") != "metrics":
+            self.send_error(NOT_FOUND)
+            return
+        body = metrics.render()
+        self.send_response(OK)
+        self.send_header("Content-Type", metrics.CONTENT_TYPE)
+        self.send_header("Content-Length", len(body))
+        self.end_headers()
+        self.wfile.write(body)
 
 
 if __name__ == "__main__":
     op = OptionParser()
     op.add_option("-p", "--port", action="store", type=int, default=8080)
     op.add_option("-l", "--log", action="store", default=None)
+    op.add_option("--memc", action="store", default=None, help="memcached host:port, in-process cache if not set")
+    op.add_option("--interests", action="store", default=None, help="interests index built by interests.py")
+    op.add_option("--max-body-size", action="store", type=int, default=MAX_BODY_SIZE)
     (opts, args) = op.parse_args()
     logging.basicConfig(filename=opts.log, level=logging.INFO,
                         format='[%(asctime)s] %(levelname).1s %(message)s',
                         datefmt='%Y.%m.%d %H:%M:%S')
+    MainHTTPHandler.store = make_store(opts.memc)
+    MainHTTPHandler.max_body_size = opts.max_body_size
+    if opts.interests:
+        interests_index = InterestsIndex(opts.interests)
     server = HTTPServer(("localhost", opts.port), MainHTTPHandler)
     logging.info("Starting server at %s" % opts.port)
     try:
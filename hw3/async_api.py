@@ -0,0 +1,389 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Альтернативная точка входа для api.py: тот же роутер /method, но все соединения
+# обслуживаются в одном event loop (asyncore/asynchat), без треда на соединение.
+# Поддерживается HTTP/1.1 keep-alive и pipelining: запросы из одного соединения
+# разбираются по очереди из входного буфера, ответы отправляются в том же порядке.
+# Тело запроса читается по Content-Length или Transfer-Encoding: chunked,
+# другие Transfer-Encoding отклоняются с 501 и закрытием соединения.
+# Запросы к /method выполняются в пуле тредов (-w), потому что хранилище может
+# блокироваться (сокеты memcached, паузы между повторами); результат возвращается
+# в event loop через pipe. Пока запрос соединения выполняется, следующие запросы
+# из того же соединения не разбираются, так что порядок ответов сохраняется.
+
+# $ python async_api.py -p 8080
+
+import asynchat
+import asyncore
+import errno
+import fcntl
+import json
+import logging
+import mimetools
+import os
+import socket
+import threading
+from optparse import OptionParser
+from Queue import Queue, Empty
+from StringIO import StringIO
+from BaseHTTPServer import BaseHTTPRequestHandler
+
+import api
+import metrics
+from api import method_handler, process_http_request, make_store
+from api import BAD_REQUEST, NOT_FOUND, OK, REQUEST_ENTITY_TOO_LARGE, MAX_BODY_SIZE, MAX_CHUNK_LINE
+from api import ERRORS, INTERNAL_ERROR
+
+
+MAX_HEADERS_SIZE = 64 * 1024
+SERVER_VERSION = "otus-scoring-async"
+NOT_IMPLEMENTED = 501
+WORKERS = 8
+
+# what is read now: headers, body by Content-Length, chunked body parts
+HEADERS, BODY, CHUNK_SIZE, CHUNK_DATA, TRAILER = range(5)
+
+
+class HTTPChannel(asynchat.async_chat):
+    """One client connection. Reads request line and headers up to the empty
+    line, then exactly Content-Length bytes of body or chunks up to the last
+    one, handles the request and starts over with the rest of the input buffer"""
+
+    responses = BaseHTTPRequestHandler.responses
+
+    def __init__(self, sock, workers, max_body_size=MAX_BODY_SIZE):
+        asynchat.async_chat.__init__(self, sock)
+        self.workers = workers
+        self.max_body_size = max_body_size
+        self.ibuffer = []
+        self.ibuffer_size = 0
+        self.closing = False
+        # request is processed by a worker, input after it waits in deferred_input
+        self.pending = False
+        self.deferred_input = ""
+        self.resuming = False
+        self.reset()
+
+    def reset(self):
+        self.command = None
+        self.path = None
+        self.request_version = None
+        self.headers = None
+        self.state = HEADERS
+        self.body = []
+        self.body_size = 0
+        self.set_terminator("\r\n\r\n")
+
+    def readable(self):
+        return not self.pending and asynchat.async_chat.readable(self)
+
+    def recv(self, buffer_size):
+        if self.resuming:
+            # handle_read called to parse deferred input, nothing new is read
+            return ""
+        return asynchat.async_chat.recv(self, buffer_size)
+
+    def collect_incoming_data(self, data):
+        if self.closing:
+            # ignore everything after the request which closes connection
+            return
+        self.ibuffer.append(data)
+        self.ibuffer_size += len(data)
+        if self.state == HEADERS and self.ibuffer_size > MAX_HEADERS_SIZE:
+            self.send_error(BAD_REQUEST, close=True)
+        elif self.state in (CHUNK_SIZE, TRAILER) and self.ibuffer_size > MAX_CHUNK_LINE:
+            self.send_error(BAD_REQUEST, close=True)
+
+    def pop_data(self):
+        data = "".join(self.ibuffer)
+        self.ibuffer = []
+        self.ibuffer_size = 0
+        return data
+
+    def found_terminator(self):
+        if self.closing:
+            return
+        if self.state == HEADERS:
+            self.found_headers(self.pop_data())
+        elif self.state == BODY:
+            self.handle_body(self.pop_data())
+        elif self.state == CHUNK_SIZE:
+            self.found_chunk_size(self.pop_data())
+        elif self.state == CHUNK_DATA:
+            data = self.pop_data()
+            if not data.endswith("\r\n"):
+                self.send_error(BAD_REQUEST, close=True)
+                return
+            self.body.append(data[:-2])
+            self.state = CHUNK_SIZE
+            self.set_terminator("\r\n")
+        elif self.state == TRAILER:
+            # trailer headers are skipped up to the empty line
+            if not self.pop_data().strip():
+                self.handle_body("".join(self.body))
+
+    def found_headers(self, data):
+        if not self.parse_headers(data):
+            self.send_error(BAD_REQUEST, close=True)
+            return
+        if self.command not in ("GET", "POST"):
+            self.send_error(NOT_IMPLEMENTED, close=True)
+            return
+
+        transfer_encoding = self.headers.get("Transfer-Encoding")
+        if transfer_encoding is not None:
+            if transfer_encoding.strip().lower() != "chunked":
+                self.send_error(NOT_IMPLEMENTED, close=True)
+                return
+            self.state = CHUNK_SIZE
+            self.set_terminator("\r\n")
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            self.send_error(BAD_REQUEST, close=True)
+            return
+        if length < 0:
+            self.send_error(BAD_REQUEST, close=True)
+            return
+        if length > self.max_body_size:
+            self.send_error(REQUEST_ENTITY_TOO_LARGE, close=True)
+            return
+        if length > 0:
+            self.state = BODY
+            self.set_terminator(length)
+        else:
+            self.handle_body("")
+
+    def found_chunk_size(self, line):
+        try:
+            # chunk extensions after ';' are ignored
+            size = int(line.split(";", 1)[0].strip(), 16)
+        except ValueError:
+            self.send_error(BAD_REQUEST, close=True)
+            return
+        if size < 0:
+            self.send_error(BAD_REQUEST, close=True)
+            return
+        if size == 0:
+            self.state = TRAILER
+            self.set_terminator("\r\n")
+            return
+        self.body_size += size
+        if self.body_size > self.max_body_size:
+            self.send_error(REQUEST_ENTITY_TOO_LARGE, close=True)
+            return
+        # chunk data with CRLF after it
+        self.state = CHUNK_DATA
+        self.set_terminator(size + 2)
+
+    def handle_body(self, data):
+        if self.command == "GET":
+            self.handle_get()
+        else:
+            self.handle_request(data)
+
+    def parse_headers(self, data):
+        # skip empty lines between pipelined requests
+        data = data.lstrip("\r\n")
+        requestline, _, headers = data.partition("\r\n")
+        words = requestline.split()
+        if len(words) != 3 or not words[2].startswith("HTTP/"):
+            return False
+        self.command, self.path, self.request_version = words
+        self.headers = mimetools.Message(StringIO(headers))
+        return True
+
+    @property
+    def keep_alive(self):
+        connection = (self.headers.get("Connection", "") if self.headers else "").lower()
+        if self.request_version == "HTTP/1.1":
+            return connection != "close"
+        return connection == "keep-alive"
+
+    def handle_request(self, data_string):
+        self.pending = True
+        # stop asynchat from parsing pipelined requests until the response is sent
+        self.deferred_input, self.ac_in_buffer = self.ac_in_buffer, ""
+        self.workers.submit(self, self.path, data_string, self.headers)
+
+    def finish_request(self, code, r):
+        """Called in the event loop with result of handle_request"""
+        self.pending = False
+        if not self.connected:
+            return
+        self.send_response(code, json.dumps(r))
+        if self.closing:
+            return
+        self.ac_in_buffer, self.deferred_input = self.deferred_input + self.ac_in_buffer, ""
+        if self.ac_in_buffer:
+            self.resuming = True
+            try:
+                asynchat.async_chat.handle_read(self)
+            finally:
+                self.resuming = False
+
+    def handle_get(self):
+        if self.path.strip("/") != "metrics":
+            self.send_error(NOT_FOUND)
+            return
+        self.send_response(OK, metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+    def send_error(self, code, close=False):
+        body = json.dumps({"error": self.responses[code][0], "code": code})
+        self.send_response(code, body, close)
+
+    def send_response(self, code, body, close=False, content_type="application/json"):
+        close = close or not self.keep_alive
+        lines = [
+            "HTTP/1.1 %d %s" % (code, self.responses.get(code, ("",))[0]),
+            "Server: %s" % SERVER_VERSION,
+            "Content-Type: %s" % content_type,
+            "Content-Length: %d" % len(body),
+            "Connection: %s" % ("close" if close else "keep-alive"),
+            "", "",
+        ]
+        self.push("\r\n".join(lines) + body)
+        if close:
+            self.closing = True
+            self.set_terminator(None)
+            self.close_when_done()
+        else:
+            self.reset()
+
+    def handle_error(self):
+        logging.exception("Unexpected error in channel")
+        self.close()
+
+
+class Waker(asyncore.file_dispatcher):
+    """Read end of a pipe in the event loop: worker writes a byte after putting
+    a result to the queue, the loop sends responses for all queued results"""
+
+    def __init__(self, results):
+        rfd, self.wfd = os.pipe()
+        # file_dispatcher works with a nonblocking copy of the descriptor
+        asyncore.file_dispatcher.__init__(self, rfd)
+        os.close(rfd)
+        fcntl.fcntl(self.wfd, fcntl.F_SETFL, fcntl.fcntl(self.wfd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.results = results
+
+    def writable(self):
+        return False
+
+    def wake(self):
+        try:
+            os.write(self.wfd, "x")
+        except OSError as e:
+            # pipe is full, the loop is going to be woken anyway
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def handle_read(self):
+        self.recv(4096)
+        while True:
+            try:
+                channel, code, r = self.results.get_nowait()
+            except Empty:
+                break
+            try:
+                channel.finish_request(code, r)
+            except Exception:
+                channel.handle_error()
+
+    def close(self):
+        asyncore.file_dispatcher.close(self)
+        os.close(self.wfd)
+
+
+class RequestWorkers(object):
+    """Threads running process_http_request, so calls to the store never
+    block the event loop"""
+
+    def __init__(self, router, store=None, size=WORKERS):
+        self.router = router
+        self.store = store
+        self.tasks = Queue()
+        self.results = Queue()
+        self.waker = Waker(self.results)
+        for i in range(size):
+            t = threading.Thread(target=self.run, name="request-worker-%d" % i)
+            t.daemon = True
+            t.start()
+
+    def submit(self, channel, path, data_string, headers):
+        self.tasks.put((channel, path, data_string, headers))
+
+    def run(self):
+        while True:
+            channel, path, data_string, headers = self.tasks.get()
+            try:
+                code, r = process_http_request(self.router, path, data_string, headers, self.store)
+            except Exception, e:
+                logging.exception("Unexpected error: %s" % e)
+                code, r = INTERNAL_ERROR, {"error": ERRORS[INTERNAL_ERROR], "code": INTERNAL_ERROR}
+            self.results.put((channel, code, r))
+            self.waker.wake()
+
+    def close(self):
+        self.waker.close()
+
+
+class AsyncHTTPServer(asyncore.dispatcher):
+    router = {
+        "method": method_handler
+    }
+
+    def __init__(self, host, port, store=None, max_body_size=MAX_BODY_SIZE, backlog=1024, workers=WORKERS):
+        asyncore.dispatcher.__init__(self)
+        self.workers = RequestWorkers(self.router, store, workers)
+        self.max_body_size = max_body_size
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((host, port))
+        self.listen(backlog)
+
+    @property
+    def port(self):
+        return self.socket.getsockname()[1]
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is None:
+            return
+        sock, _ = pair
+        HTTPChannel(sock, self.workers, self.max_body_size)
+
+    def serve_forever(self, timeout=1.0):
+        asyncore.loop(timeout=timeout, use_poll=True)
+
+    def close(self):
+        asyncore.dispatcher.close(self)
+        self.workers.close()
+
+
+if __name__ == "__main__":
+    op = OptionParser()
+    op.add_option("-p", "--port", action="store", type=int, default=8080)
+    op.add_option("-l", "--log", action="store", default=None)
+    op.add_option("--memc", action="store", default=None, help="memcached host:port, in-process cache if not set")
+    op.add_option("--interests", action="store", default=None, help="interests index built by interests.py")
+    op.add_option("--max-body-size", action="store", type=int, default=MAX_BODY_SIZE)
+    op.add_option("-w", "--workers", action="store", type=int, default=WORKERS,
+                  help="threads for requests to the store")
+    (opts, args) = op.parse_args()
+    logging.basicConfig(filename=opts.log, level=logging.INFO,
+                        format='[%(asctime)s] %(levelname).1s %(message)s',
+                        datefmt='%Y.%m.%d %H:%M:%S')
+    if opts.interests:
+        api.interests_index = api.InterestsIndex(opts.interests)
+    server = AsyncHTTPServer("localhost", opts.port, make_store(opts.memc), opts.max_body_size,
+                             workers=opts.workers)
+    logging.info("Starting async server at %s" % opts.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.close()
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Нагрузочный тест API скоринга.
+# Запускает локально api.py (или async_api.py), в нескольких процессах отправляет
+# смесь запросов online_score, clients_interests, невалидных и неавторизованных,
+# пишет пропускную способность, перцентили задержки и долю ошибок в JSON.
+# Если указан baseline, сравнивает с ним и завершается с кодом 1 при регрессии.
+
+# $ python bench.py --server async -c 8 -d 10 -o results.json
+# $ python bench.py --server async -c 8 -d 10 --baseline results.json
+
+import datetime
+import hashlib
+import httplib
+import json
+import multiprocessing
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+from optparse import OptionParser
+
+import api
+from benchstats import choose, compare_summaries, summarize, wait_port
+
+SERVERS = {
+    "threaded": "api.py",
+    "async": "async_api.py",
+}
+DEFAULT_MIX = "online_score=70,clients_interests=20,invalid=5,forbidden=5"
+EXPECTED_CODES = {
+    "online_score": api.OK,
+    "clients_interests": api.OK,
+    "invalid": api.INVALID_REQUEST,
+    "forbidden": api.FORBIDDEN,
+}
+ACCOUNT = "horns&hoofs"
+LOGIN = "h&f"
+
+
+def make_request(kind, rnd):
+    request = {"account": ACCOUNT, "login": LOGIN,
+               "token": hashlib.sha512(ACCOUNT + LOGIN + api.SALT).hexdigest()}
+    if kind == "online_score":
+        request["method"] = "online_score"
+        request["arguments"] = {"phone": "7%010d" % rnd.randint(0, 10 ** 10 - 1), "email": "bench@otus.ru",
+                                "gender": rnd.choice([0, 1, 2]), "birthday": "01.01.1990"}
+    elif kind == "clients_interests":
+        request["method"] = "clients_interests"
+        request["arguments"] = {"client_ids": rnd.sample(xrange(100000), rnd.randint(1, 20)),
+                                "date": datetime.date.today().strftime("%d.%m.%Y")}
+    elif kind == "invalid":
+        request["method"] = "online_score"
+        request["arguments"] = {"phone": "89175002040", "email": "bench.otus.ru"}
+    elif kind == "forbidden":
+        request["method"] = "online_score"
+        request["token"] = "bad"
+        request["arguments"] = {"first_name": "a", "last_name": "b"}
+    return json.dumps(request)
+
+
+def parse_mix(mix):
+    weights = []
+    for part in mix.split(","):
+        kind, _, weight = part.partition("=")
+        if kind not in EXPECTED_CODES:
+            raise ValueError("Unknown request kind %s" % kind)
+        weights.append((kind, int(weight)))
+    return weights
+
+
+def client_worker((port, weights, duration, seed)):
+    """Send requests until duration is over. Returns list of (kind, latency, ok)"""
+    rnd = random.Random(seed)
+    conn = httplib.HTTPConnection("127.0.0.1", port, timeout=10)
+    results = []
+    deadline = time.time() + duration
+    while time.time() < deadline:
+        kind = choose(weights, rnd)
+        body = make_request(kind, rnd)
+        start = time.time()
+        try:
+            conn.request("POST", "/method/", body, {"Content-Type": "application/json"})
+            response = conn.getresponse()
+            code = json.loads(response.read()).get("code")
+            ok = code == EXPECTED_CODES[kind]
+        except (socket.error, httplib.HTTPException, ValueError):
+            conn.close()
+            ok = False
+        results.append((kind, time.time() - start, ok))
+    conn.close()
+    return results
+
+
+def start_server(server, port, args):
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), SERVERS[server])
+    cmd = [sys.executable, path, "-p", str(port), "-l", os.devnull] + args
+    with open(os.devnull, "w") as devnull:
+        proc = subprocess.Popen(cmd, stdout=devnull, stderr=devnull)
+    wait_port(port)
+    return proc
+
+
+def run(opts):
+    weights = parse_mix(opts.mix)
+    proc = None
+    if not opts.no_start:
+        proc = start_server(opts.server, opts.port, opts.server_args.split() if opts.server_args else [])
+    try:
+        pool = multiprocessing.Pool(opts.concurrency)
+        started = time.time()
+        worker_args = [(opts.port, weights, opts.duration, opts.seed + i) for i in range(opts.concurrency)]
+        per_worker = pool.map(client_worker, worker_args)
+        elapsed = time.time() - started
+        pool.close()
+    finally:
+        if proc:
+            proc.terminate()
+            proc.wait()
+
+    results = [r for worker_results in per_worker for r in worker_results]
+    by_kind = {}
+    for kind, _ in weights:
+        by_kind[kind] = summarize_results([r for r in results if r[0] == kind], elapsed)
+    return {
+        "config": {"server": opts.server, "concurrency": opts.concurrency,
+                   "duration": opts.duration, "mix": opts.mix},
+        "total": summarize_results(results, elapsed),
+        "by_kind": by_kind,
+    }
+
+
+def summarize_results(results, duration):
+    return summarize([latency for _, latency, _ in results], sum(1 for _, _, ok in results if not ok), duration)
+
+
+def compare(results, baseline, tolerance):
+    """Returns list of regressions messages"""
+    return compare_summaries(results["total"], baseline["total"], tolerance)
+
+
+if __name__ == "__main__":
+    op = OptionParser()
+    op.add_option("--server", action="store", choices=SERVERS.keys(), default="threaded")
+    op.add_option("--server-args", action="store", default="", help="extra args for server, e.g. '--memc host:port'")
+    op.add_option("--no-start", action="store_true", default=False, help="use already running server")
+    op.add_option("-p", "--port", action="store", type=int, default=8090)
+    op.add_option("-c", "--concurrency", action="store", type=int, default=4)
+    op.add_option("-d", "--duration", action="store", type=float, default=10)
+    op.add_option("-m", "--mix", action="store", default=DEFAULT_MIX)
+    op.add_option("-s", "--seed", action="store", type=int, default=0)
+    op.add_option("-o", "--output", action="store", default="bench_results.json")
+    op.add_option("-b", "--baseline", action="store", default=None)
+    op.add_option("-t", "--tolerance", action="store", type=float, default=0.1)
+    (opts, args) = op.parse_args()
+
+    results = run(opts)
+    with open(opts.output, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    total = results["total"]
+    print "%s: %d requests, %.1f rps, p50 %.2fms, p99 %.2fms, errors %.2f%%" % (
+        opts.server, total["requests"], total["rps"], total["latency_ms"]["p50"],
+        total["latency_ms"]["p99"], total["error_rate"] * 100)
+
+    if opts.baseline:
+        with open(opts.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, opts.tolerance)
+        for msg in regressions:
+            print "REGRESSION: %s" % msg
+        if regressions:
+            sys.exit(1)
+        print "No regressions against %s" % opts.baseline
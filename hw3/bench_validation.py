@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Стоимость валидации одного запроса: исходная проверка (обход полей в цикле,
+# PhoneField через str-проверки, DateField через strptime), обход полей в цикле
+# (clean_fields_generic) с новыми полями и функция, сгенерированная RequestMeta
+# (clean_fields).
+
+# $ python bench_validation.py -n 100000
+
+import datetime
+import timeit
+from optparse import OptionParser
+
+import api
+
+
+CASES = [
+    ("MethodRequest", api.MethodRequest, {
+        "account": "horns&hoofs", "login": "h&f", "method": "online_score",
+        "token": "55cc9ce545bcd144300fe9efc28e65d415b923ebb6be1e19d2750a2c03e80dd2",
+        "arguments": {"phone": "79175002040"},
+    }),
+    ("OnlineScoreRequest", api.OnlineScoreRequest, {
+        "phone": "79175002040", "email": "stupnikov@otus.ru", "first_name": "a", "last_name": "b",
+        "birthday": "01.01.1990", "gender": 1,
+    }),
+    ("OnlineScoreRequest (invalid)", api.OnlineScoreRequest, {
+        "phone": "89175002040", "email": "stupnikovotus.ru", "birthday": "XXX", "gender": 5,
+    }),
+]
+
+
+class OriginalPhoneField(api.PhoneField):
+    def parse_validate(self, value):
+        if not isinstance(value, (str, unicode, int, long)):
+            raise ValueError("PhoneField must be a string or integer")
+        value = str(value)
+        if not (len(value) == 11 and value.startswith('7') and value.isdigit()):
+            raise ValueError("PhoneField must contains 7 with 11 character length")
+        return value
+
+
+class OriginalDateField(api.DateField):
+    def parse_validate(self, value):
+        if not isinstance(value, (str, unicode)):
+            raise ValueError("DateField must be a string")
+        value = str(value)
+        try:
+            dt = datetime.datetime.strptime(value, '%d.%m.%Y')
+        except ValueError:
+            raise ValueError("DateField does not match %d.%m.%Y")
+        return dt.date()
+
+
+class OriginalBirthDayField(OriginalDateField):
+    def parse_validate(self, value):
+        date = super(OriginalBirthDayField, self).parse_validate(value)
+        today = datetime.date.today()
+        if date > today or today.year - date.year > 70:
+            raise ValueError("BirthDayField must be in [today-70 ... today]")
+        return date
+
+
+ORIGINAL_FIELDS = {
+    api.PhoneField: OriginalPhoneField,
+    api.DateField: OriginalDateField,
+    api.BirthDayField: OriginalBirthDayField,
+}
+
+
+def original_request_class(cls):
+    """cls with fields checked as before the regexes"""
+    attrs = {}
+    for field in cls.fields:
+        field_cls = ORIGINAL_FIELDS.get(type(field), type(field))
+        attrs[field.name] = field_cls(required=field.required, nullable=field.nullable)
+    return api.RequestMeta("Original" + cls.__name__, (cls,), attrs)
+
+
+def run(cls, arguments, method_name, number):
+    def validate():
+        request = cls(arguments)
+        getattr(request, method_name)()
+    return min(timeit.repeat(validate, number=number, repeat=3)) / number * 1e6
+
+
+if __name__ == "__main__":
+    op = OptionParser()
+    op.add_option("-n", "--number", action="store", type=int, default=100000)
+    (opts, args) = op.parse_args()
+    print "%-30s %12s %12s %12s %8s" % ("request", "original, us", "generic, us", "compiled, us", "speedup")
+    for name, cls, arguments in CASES:
+        original = run(original_request_class(cls), arguments, "clean_fields_generic", opts.number)
+        generic = run(cls, arguments, "clean_fields_generic", opts.number)
+        compiled = run(cls, arguments, "clean_fields", opts.number)
+        print "%-30s %12.2f %12.2f %12.2f %7.2fx" % (name, original, generic, compiled, original / compiled)
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Индекс интересов клиентов: client_id -> битовая маска id интересов.
+# Файл отображается в память (mmap) один раз при старте сервера, маски читаются
+# прямо из отображения без копирования. Колонка client_id при старте копируется
+# в array, по которому бинарный поиск идет без вызовов питоновского кода.
+# Имена интересов подставляются только при формировании ответа, одинаковые маски
+# разделяют один список имен (кеш имен ограничен по размеру).
+
+# Формат файла (little-endian):
+# header: magic (8 байт), количество клиентов (uint64), размер таблицы имен (uint32)
+# таблица имен интересов в utf-8, разделитель "\n", id интереса = номер строки
+# выравнивание до 8 байт
+# отсортированные client_id, int64 на клиента
+# маски интересов, uint64 на клиента, в том же порядке, что и client_id
+
+# Построение индекса из tsv файла "<client_id>\t<interest1>,<interest2>,...":
+# $ python interests.py -i interests.tsv -o interests.idx
+
+import bisect
+import mmap
+import struct
+import sys
+from array import array
+from optparse import OptionParser
+
+from store import LRUBackend
+
+MAGIC = "INTIDX2\0"
+HEADER = struct.Struct("<8sQI")
+CLIENT_ID = struct.Struct("<q")
+# array type of int64 client_id, 'l' is 8 bytes on 64-bit linux
+CLIENT_ID_TYPECODE = "l"
+BITSET = struct.Struct("<Q")
+MAX_INTERESTS = BITSET.size * 8
+NAMES_CACHE_SIZE = 10000
+
+
+class InterestsIndexError(Exception):
+    pass
+
+
+def write_index(path, clients, names):
+    """clients is a dict client_id -> list of interest names,
+    names is a list of all interest names"""
+    if len(names) > MAX_INTERESTS:
+        raise InterestsIndexError("At most %d interests supported" % MAX_INTERESTS)
+    interest_ids = {name: i for i, name in enumerate(names)}
+    names_data = "\n".join(n.encode("utf-8") for n in names)
+    client_ids = sorted(clients)
+    with open(path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, len(client_ids), len(names_data)))
+        f.write(names_data)
+        f.write("\0" * (-f.tell() % BITSET.size))
+        for cid in client_ids:
+            f.write(CLIENT_ID.pack(cid))
+        for cid in client_ids:
+            bits = 0
+            for name in clients[cid]:
+                bits |= 1 << interest_ids[name]
+            f.write(BITSET.pack(bits))
+
+
+class InterestsIndex(object):
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, names_size = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            raise InterestsIndexError("%s is not an interests index" % path)
+        names_offset = HEADER.size
+        names_data = self.mm[names_offset:names_offset + names_size]
+        self.names = [n.decode("utf-8") for n in names_data.split("\n")] if names_size else []
+        offset = names_offset + names_size
+        self.ids_offset = offset + (-offset % BITSET.size)
+        self.offset = self.ids_offset + self.count * CLIENT_ID.size
+        if self.offset + self.count * BITSET.size > len(self.mm):
+            raise InterestsIndexError("%s is truncated" % path)
+        self.client_ids = load_client_ids(self.mm, self.ids_offset, self.count)
+        # bitset -> names, filled lazily at serialization
+        self.names_cache = LRUBackend(NAMES_CACHE_SIZE)
+
+    def lookup(self, client_ids):
+        """Interests bitsets for client_ids, 0 for unknown clients"""
+        ids, count = self.client_ids, self.count
+        unpack_from, mm, offset, size = BITSET.unpack_from, self.mm, self.offset, BITSET.size
+        result = []
+        for cid in client_ids:
+            i = bisect.bisect_left(ids, cid)
+            result.append(unpack_from(mm, offset + i * size)[0] if i < count and ids[i] == cid else 0)
+        return result
+
+    def bits_to_names(self, bits):
+        names = self.names_cache.get(bits)
+        if names is None:
+            names = [name for i, name in enumerate(self.names) if bits >> i & 1]
+            self.names_cache.set(bits, names)
+        return names
+
+    def get_interests(self, client_ids):
+        """Dict client_id -> list of interest names"""
+        # names of bitsets seen in this request, without the lock of names_cache
+        names = {}
+        result = {}
+        for cid, bits in zip(client_ids, self.lookup(client_ids)):
+            bits_names = names.get(bits)
+            if bits_names is None:
+                bits_names = names[bits] = self.bits_to_names(bits)
+            result[cid] = bits_names
+        return result
+
+    def close(self):
+        self.mm.close()
+
+
+def load_client_ids(mm, offset, count):
+    """Sorted client_id column as array"""
+    ids = array(CLIENT_ID_TYPECODE)
+    if ids.itemsize != CLIENT_ID.size:
+        raise InterestsIndexError("array('%s') is not 64-bit on this platform" % CLIENT_ID_TYPECODE)
+    ids.fromstring(mm[offset:offset + count * CLIENT_ID.size])
+    if sys.byteorder == "big":
+        ids.byteswap()
+    return ids
+
+
+def read_tsv(path):
+    clients, names = {}, []
+    known = set()
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            cid, _, raw_interests = line.partition("\t")
+            interests = [i.strip().decode("utf-8") for i in raw_interests.split(",") if i.strip()]
+            for name in interests:
+                if name not in known:
+                    known.add(name)
+                    names.append(name)
+            clients[int(cid)] = interests
+    return clients, names
+
+
+if __name__ == "__main__":
+    op = OptionParser()
+    op.add_option("-i", "--input", action="store", help="tsv file: client_id<TAB>interest1,interest2")
+    op.add_option("-o", "--output", action="store", default="interests.idx")
+    (opts, args) = op.parse_args()
+    if not opts.input:
+        op.error("input file is required")
+    clients, names = read_tsv(opts.input)
+    write_index(opts.output, clients, names)
+    print "Index %s: %d clients, %d interests" % (opts.output, len(clients), len(names))
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+# Гистограммы времени обработки запросов по методу, коду ответа и стадии
+# (parse, auth, validation, handler, total).
+# Каждый поток пишет только в свои счетчики, блокировка берется один раз при
+# регистрации потока. Сбор данных для /metrics суммирует счетчики всех потоков.
+# Счетчики завершившихся потоков переносятся в общий итог, чтобы реестр не рос
+# вместе с числом когда-либо созданных потоков.
+
+import bisect
+import contextlib
+import threading
+import timeit
+import weakref
+
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+STAGES = ("parse", "auth", "validation", "handler", "total")
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+timer = timeit.default_timer
+
+
+class LatencyHistograms(object):
+    def __init__(self, name, buckets=BUCKETS):
+        self.name = name
+        self.buckets = buckets
+        self.local = threading.local()
+        self.registry_lock = threading.Lock()
+        # (weakref to thread, its counters)
+        self.registry = []
+        # counters of finished threads
+        self.retired = {}
+
+    def thread_counters(self):
+        counters = getattr(self.local, "counters", None)
+        if counters is None:
+            counters = self.local.counters = {}
+            with self.registry_lock:
+                self.prune()
+                self.registry.append((weakref.ref(threading.current_thread()), counters))
+        return counters
+
+    def prune(self):
+        """Move counters of finished threads to retired, registry_lock must be held"""
+        alive = []
+        for thread_ref, counters in self.registry:
+            thread = thread_ref()
+            if thread is not None and thread.is_alive():
+                alive.append((thread_ref, counters))
+            else:
+                merge_counters(self.retired, counters)
+        self.registry = alive
+
+    def observe(self, labels, seconds):
+        """labels is a tuple of (name, value) pairs"""
+        counters = self.thread_counters()
+        hist = counters.get(labels)
+        if hist is None:
+            # counts per bucket, +Inf bucket, sum
+            hist = counters[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        hist[bisect.bisect_left(self.buckets, seconds)] += 1
+        hist[-1] += seconds
+
+    def collect(self):
+        with self.registry_lock:
+            self.prune()
+            total = {}
+            merge_counters(total, self.retired)
+            registry = list(self.registry)
+        for _, counters in registry:
+            merge_counters(total, counters)
+        return total
+
+    def render(self):
+        """Prometheus text exposition format"""
+        lines = [
+            "# HELP %s Request processing time by stage in seconds" % self.name,
+            "# TYPE %s histogram" % self.name,
+        ]
+        for labels, hist in sorted(self.collect().items()):
+            labels_str = ",".join('%s="%s"' % (k, v) for k, v in labels)
+            cumulative = 0
+            for le, count in zip(self.buckets + ("+Inf",), hist[:-1]):
+                cumulative += count
+                lines.append('%s_bucket{%s,le="%s"} %d' % (self.name, labels_str, le, cumulative))
+            lines.append("%s_sum{%s} %.6f" % (self.name, labels_str, hist[-1]))
+            lines.append("%s_count{%s} %d" % (self.name, labels_str, cumulative))
+        return "\n".join(lines) + "\n"
+
+
+def merge_counters(total, counters):
+    for labels, hist in counters.items():
+        merged = total.setdefault(labels, [0] * len(hist))
+        for i, v in enumerate(hist):
+            merged[i] += v
+
+
+request_latency = LatencyHistograms("api_request_duration_seconds")
+
+
+@contextlib.contextmanager
+def timed(ctx, stage):
+    """Add time spent in block to ctx["timings"][stage]"""
+    start = timer()
+    try:
+        yield
+    finally:
+        timings = ctx.setdefault("timings", {})
+        timings[stage] = timings.get(stage, 0.0) + timer() - start
+
+
+def observe_request(method, code, timings):
+    for stage, seconds in timings.items():
+        request_latency.observe((("method", str(method)), ("code", code), ("stage", stage)), seconds)
+
+
+def render():
+    return request_latency.render()
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+
+SCORE_CACHE_TIME = 60 * 60
+
+
+def get_score_key(phone=None, email=None, first_name=None, last_name=None, birthday=None, gender=None):
+    key_parts = [
+        first_name or "",
+        last_name or "",
+        phone or "",
+        email or "",
+        birthday.strftime("%Y%m%d") if birthday is not None else "",
+        gender or "",
+    ]
+    key = u"\t".join(unicode(p) for p in key_parts).encode("utf-8")
+    return "uid:" + hashlib.md5(key).hexdigest()
+
+
+def get_score(store, phone=None, email=None, first_name=None, last_name=None, birthday=None, gender=None):
+    key = get_score_key(phone, email, first_name, last_name, birthday, gender)
+    score = store.cache_get(key)
+    if score is not None:
+        return float(score)
+
+    score = 0
+    if phone:
+        score += 1.5
+    if email:
+        score += 1.5
+    if birthday and gender:
+        score += 1.5
+    if first_name and last_name:
+        score += 0.5
+    store.cache_set(key, score, SCORE_CACHE_TIME)
+    return score
+
+
+def get_interests(store, cid):
+    r = store.get("i:%s" % cid)
+    return json.loads(r) if r else []
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+
+# Хранилище для API скоринга.
+# Store.get - чтение из постоянного хранилища: при недоступности бэкенда после
+# нескольких попыток бросает StoreError.
+# Store.cache_get/cache_set - работа с кешем: ошибки бэкенда только логируются,
+# вызывающий код продолжает работу так, как будто в кеше ничего нет.
+
+import collections
+import logging
+import socket
+import threading
+import time
+from Queue import Queue, Empty, Full
+
+
+class StoreError(Exception):
+    pass
+
+
+class LRUBackend(object):
+    """In-process cache with bounded size and per-key expiration"""
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.data = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.data.pop(key, None)
+            if item is None:
+                return None
+            value, expire_at = item
+            if expire_at is not None and expire_at < time.time():
+                return None
+            # move to the end: most recently used
+            self.data[key] = item
+            return value
+
+    def set(self, key, value, expire=None):
+        expire_at = time.time() + expire if expire else None
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = (value, expire_at)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+        return True
+
+
+class MemcacheBackend(object):
+    """Memcached text protocol client over a pool of persistent connections"""
+
+    def __init__(self, host="127.0.0.1", port=11211, timeout=0.5, pool_size=10):
+        self.address = (host, port)
+        self.timeout = timeout
+        self.pool = Queue(maxsize=pool_size)
+
+    def connect(self):
+        return socket.create_connection(self.address, timeout=self.timeout)
+
+    def acquire(self):
+        try:
+            return self.pool.get_nowait()
+        except Empty:
+            return self.connect()
+
+    def release(self, sock):
+        try:
+            self.pool.put_nowait(sock)
+        except Full:
+            sock.close()
+
+    def command(self, cmd, terminators):
+        """Send cmd and read reply until it ends with one of terminators.
+        Connection with failed command is dropped, not returned to pool"""
+        sock = self.acquire()
+        try:
+            sock.sendall(cmd)
+            reply = ""
+            while not reply.endswith(terminators):
+                chunk = sock.recv(4096)
+                if not chunk:
+                    raise socket.error("Connection closed by memcached")
+                reply += chunk
+        except Exception:
+            sock.close()
+            raise
+        self.release(sock)
+        if reply.startswith(("ERROR", "CLIENT_ERROR", "SERVER_ERROR")):
+            raise StoreError(reply.strip())
+        return reply
+
+    def get(self, key):
+        reply = self.command("get %s\r\n" % key, ("END\r\n", "ERROR\r\n"))
+        if not reply.startswith("VALUE"):
+            return None
+        header, _, rest = reply.partition("\r\n")
+        length = int(header.split()[3])
+        return rest[:length]
+
+    def set(self, key, value, expire=None):
+        value = str(value)
+        cmd = "set %s 0 %d %d\r\n%s\r\n" % (key, expire or 0, len(value), value)
+        reply = self.command(cmd, ("\r\n",))
+        return reply.startswith("STORED")
+
+
+class Store(object):
+    def __init__(self, backend, retries=3, retry_delay=0.05):
+        self.backend = backend
+        self.retries = retries
+        self.retry_delay = retry_delay
+
+    def _call(self, method, *args):
+        delay = self.retry_delay
+        for attempt in range(self.retries):
+            try:
+                return getattr(self.backend, method)(*args)
+            except (socket.error, StoreError) as e:
+                logging.warning("Store %s failed (attempt %d): %s", method, attempt + 1, e)
+                if attempt + 1 < self.retries:
+                    time.sleep(delay)
+                    delay *= 2
+        raise StoreError("Store is unavailable")
+
+    def get(self, key):
+        return self._call("get", key)
+
+    def cache_get(self, key):
+        try:
+            return self.backend.get(key)
+        except (socket.error, StoreError) as e:
+            logging.warning("Cache get failed: %s", e)
+            return None
+
+    def cache_set(self, key, value, expire=None):
+        try:
+            return self.backend.set(key, value, expire)
+        except (socket.error, StoreError) as e:
+            logging.warning("Cache set failed: %s", e)
+            return False
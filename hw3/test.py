@@ -1,9 +1,25 @@
+# -*- coding: utf-8 -*-
 import hashlib
 import datetime
 import functools
+import json
+import socket
+import os
+import tempfile
+from StringIO import StringIO
+import threading
+import time
 import unittest
 
 import api
+import async_api
+import bench
+import bench_validation
+import benchstats
+import interests
+import metrics
+import scoring
+import store
 
 
 def cases(cases):
@@ -70,6 +86,8 @@ class TestSuite(unittest.TestCase):
          "first_name": "s", "last_name": 2},
         {"phone": "79175002040", "birthday": "01.01.2000", "first_name": "s"},
         {"email": "stupnikov@otus.ru", "gender": 1, "last_name": 2},
+        {"phone": "79175002040\n", "email": "stupnikov@otus.ru"},
+        {"gender": 1, "birthday": "01.01.2000\n"},
     ])
     def test_invalid_score_request(self, arguments):
         request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score", "arguments": arguments}
@@ -136,6 +154,452 @@ class TestSuite(unittest.TestCase):
                         for v in response.values()))
         self.assertEqual(self.context.get("nclients"), len(arguments["client_ids"]))
 
+    def test_ok_score_batch_request(self):
+        items = [
+            {"phone": "79175002040", "email": "stupnikov@otus.ru"},
+            {"phone": "79175002040"},
+            {"first_name": "a", "last_name": "b"},
+        ]
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score_batch",
+                   "arguments": {"items": items}}
+        self.set_valid_auth(request)
+        response, code = self.get_response(request)
+        self.assertEqual(api.OK, code)
+        scores = response["scores"]
+        self.assertEqual([s["code"] for s in scores], [api.OK, api.INVALID_REQUEST, api.OK])
+        self.assertTrue(scores[0]["score"] >= 0 and scores[2]["score"] >= 0)
+        self.assertTrue(scores[1]["error"])
+        self.assertEqual([sorted(h) for h in self.context["has"]], [["email", "phone"], [], ["first_name", "last_name"]])
+
+    @cases([
+        {},
+        {"items": []},
+        {"items": {"phone": "79175002040"}},
+        {"items": [1, 2]},
+        {"items": [{"first_name": "a", "last_name": "b"}] * (api.MAX_BATCH_SIZE + 1)},
+    ])
+    def test_invalid_score_batch_request(self, arguments):
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score_batch", "arguments": arguments}
+        self.set_valid_auth(request)
+        response, code = self.get_response(request)
+        self.assertEqual(api.INVALID_REQUEST, code)
+        self.assertTrue(len(response))
+
+    @cases([
+        {},
+        {"phone": "79175002040", "email": "stupnikov@otus.ru"},
+        {"phone": 79175002040, "email": "stupnikov@otus.ru", "gender": 1, "birthday": "01.01.2000",
+         "first_name": "a", "last_name": "b"},
+        {"phone": "89175002040", "email": "stupnikovotus.ru", "gender": "1", "birthday": "31.02.2000"},
+        {"phone": "", "email": "", "first_name": 1, "last_name": None, "birthday": "XXX", "gender": 0},
+    ])
+    def test_compiled_clean_fields(self, arguments):
+        self.check_clean_fields(api.OnlineScoreRequest, arguments)
+
+    @cases([
+        {},
+        {"account": "horns&hoofs", "login": "h&f", "token": "", "arguments": {}, "method": "online_score"},
+        {"account": None, "login": None, "token": None, "arguments": None, "method": None},
+        {"account": 1, "login": [], "token": {}, "arguments": [], "method": ""},
+        {"login": "admin", "token": "x", "arguments": {"phone": "79175002040\n"}, "method": "clients_interests"},
+    ])
+    def test_compiled_clean_fields_method_request(self, request):
+        self.check_clean_fields(api.MethodRequest, request)
+
+    def check_clean_fields(self, request_cls, arguments):
+        compiled = request_cls(arguments)
+        compiled.clean_fields()
+        generic = request_cls(arguments)
+        generic.clean_fields_generic()
+        # fields checked as before the regexes
+        original = bench_validation.original_request_class(request_cls)(arguments)
+        original.clean_fields_generic()
+        self.assertEqual(sorted(compiled.invalid_fieldnames), sorted(generic.invalid_fieldnames))
+        self.assertEqual(sorted(compiled.invalid_fieldnames), sorted(original.invalid_fieldnames))
+        for field in request_cls.fields:
+            self.assertEqual(getattr(compiled, field.name), getattr(generic, field.name))
+            if field.name not in compiled.invalid_fieldnames:
+                self.assertEqual(getattr(compiled, field.name), getattr(original, field.name))
+
+
+class TestAuthCache(unittest.TestCase):
+    def setUp(self):
+        self.auth_cache = api.auth_cache
+        api.auth_cache = api.AuthCache()
+
+    def tearDown(self):
+        api.auth_cache = self.auth_cache
+
+    def make_request(self, login, token):
+        request = api.MethodRequest({"account": "horns&hoofs", "login": login, "token": token,
+                                     "method": "online_score", "arguments": {}})
+        self.assertTrue(request.is_valid())
+        return request
+
+    def test_valid_token_cached(self):
+        token = hashlib.sha512("horns&hoofs" + "h&f" + api.SALT).hexdigest()
+        self.assertTrue(api.check_auth(self.make_request("h&f", token)))
+        self.assertTrue(api.check_auth(self.make_request("h&f", unicode(token))))
+        self.assertEqual((api.auth_cache.hits, api.auth_cache.misses), (1, 1))
+
+    def test_invalid_token_not_cached(self):
+        for _ in range(2):
+            self.assertFalse(api.check_auth(self.make_request("h&f", "bad")))
+        self.assertEqual((api.auth_cache.hits, api.auth_cache.misses), (0, 2))
+
+    def test_admin_token_expires_at_hour_boundary(self):
+        now = datetime.datetime(2017, 7, 20, 10, 59, 30)
+        self.assertEqual(api.seconds_to_next_hour(now), 30)
+        token = hashlib.sha512(datetime.datetime.now().strftime("%Y%m%d%H") + api.ADMIN_SALT).hexdigest()
+        self.assertTrue(api.check_auth(self.make_request("admin", token)))
+        expire_at = api.auth_cache.tokens.data.values()[0][1]
+        self.assertTrue(0 < expire_at - time.time() <= 3600)
+
+
+class TestInterestsIndex(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        names = [u"books", u"tv", u"кино"]
+        clients = {0: [u"tv"], 2: [u"books", u"кино"], 5: [u"tv"]}
+        interests.write_index(self.path, clients, names)
+        self.index = interests.InterestsIndex(self.path)
+
+    def tearDown(self):
+        self.index.close()
+        os.remove(self.path)
+
+    def test_lookup(self):
+        self.assertEqual(self.index.get_interests([0, 1, 2, 5, 100, -1]), {
+            0: [u"tv"], 1: [], 2: [u"books", u"кино"], 5: [u"tv"], 100: [], -1: [],
+        })
+        # same bitsets share names list
+        result = self.index.get_interests([0, 5])
+        self.assertIs(result[0], result[5])
+
+    def test_sparse_client_ids(self):
+        names = [u"books", u"tv"]
+        clients = {10 ** 12: [u"tv"], 7: [u"books"], -3: [u"books", u"tv"]}
+        interests.write_index(self.path, clients, names)
+        index = interests.InterestsIndex(self.path)
+        try:
+            # header, names and 16 bytes per client
+            self.assertEqual(os.path.getsize(self.path), 32 + 3 * 16)
+            self.assertEqual(index.get_interests([10 ** 12, 7, -3, 8, 0, 10 ** 13, 10 ** 20, -10 ** 20]), {
+                10 ** 12: [u"tv"], 7: [u"books"], -3: [u"books", u"tv"], 8: [], 0: [], 10 ** 13: [],
+                10 ** 20: [], -10 ** 20: [],
+            })
+            self.assertEqual(list(index.client_ids), [-3, 7, 10 ** 12])
+        finally:
+            index.close()
+
+    def test_names_cache_bounded(self):
+        self.index.names_cache.maxsize = 2
+        self.index.get_interests([0, 1, 2, 5])
+        self.assertEqual(len(self.index.names_cache.data), 2)
+        self.assertEqual(self.index.get_interests([2]), {2: [u"books", u"кино"]})
+
+    def test_bad_file(self):
+        with open(self.path, "wb") as f:
+            f.write("x" * 64)
+        with self.assertRaises(interests.InterestsIndexError):
+            interests.InterestsIndex(self.path)
+
+    def test_interests_request_with_index(self):
+        api.interests_index = self.index
+        try:
+            request = {"account": "horns&hoofs", "login": "h&f", "method": "clients_interests",
+                       "arguments": {"client_ids": [2, 3]},
+                       "token": hashlib.sha512("horns&hoofs" + "h&f" + api.SALT).hexdigest()}
+            context = {}
+            response, code = api.method_handler({"body": request, "headers": {}}, context)
+        finally:
+            api.interests_index = None
+        self.assertEqual(api.OK, code)
+        self.assertEqual(response, {2: [u"books", u"кино"], 3: []})
+        self.assertEqual(context["nclients"], 2)
+
+
+class TestReadBody(unittest.TestCase):
+    def test_content_length(self):
+        rfile = StringIO('{"a": 1}next')
+        self.assertEqual(api.read_body(rfile, {"Content-Length": "8"}), '{"a": 1}')
+        self.assertEqual(rfile.read(), "next")
+
+    def test_chunked(self):
+        rfile = StringIO("4\r\n{\"a\"\r\n4;ext=1\r\n: 1}\r\n0\r\nX-Trailer: 1\r\n\r\nnext")
+        self.assertEqual(api.read_body(rfile, {"Transfer-Encoding": "chunked"}), '{"a": 1}')
+        self.assertEqual(rfile.read(), "next")
+
+    @cases([
+        ({"Content-Length": "100"}, "x" * 10, api.REQUEST_ENTITY_TOO_LARGE),
+        ({"Transfer-Encoding": "chunked"}, "5\r\nxxxxx\r\n6\r\nxxxxxx\r\n0\r\n\r\n", api.REQUEST_ENTITY_TOO_LARGE),
+        ({"Transfer-Encoding": "chunked"}, "zz\r\nxx\r\n", api.BAD_REQUEST),
+        ({"Content-Length": "5"}, "xx", api.BAD_REQUEST),
+        ({"Content-Length": "-1"}, "", api.BAD_REQUEST),
+        ({}, "xx", api.BAD_REQUEST),
+    ])
+    def test_bad_body(self, headers, data, code):
+        with self.assertRaises(api.RequestBodyError) as cm:
+            api.read_body(StringIO(data), headers, max_size=10)
+        self.assertEqual(cm.exception.code, code)
+
+
+class TestStore(unittest.TestCase):
+    def setUp(self):
+        self.context = {}
+        self.store = store.Store(store.LRUBackend(maxsize=2))
+
+    def get_unavailable_store(self):
+        # nothing listens on port 1
+        return store.Store(store.MemcacheBackend("127.0.0.1", 1, timeout=0.1), retries=2, retry_delay=0)
+
+    def test_lru_evicts_oldest(self):
+        self.store.cache_set("a", 1)
+        self.store.cache_set("b", 2)
+        self.store.cache_get("a")
+        self.store.cache_set("c", 3)
+        self.assertEqual(self.store.cache_get("a"), 1)
+        self.assertIsNone(self.store.cache_get("b"))
+        self.assertEqual(self.store.cache_get("c"), 3)
+
+    def test_lru_expire(self):
+        self.store.cache_set("a", 1, -1)
+        self.assertIsNone(self.store.cache_get("a"))
+
+    def test_score_served_from_cache(self):
+        arguments = {"phone": "79175002040", "email": "stupnikov@otus.ru"}
+        key = scoring.get_score_key(phone=arguments["phone"], email=arguments["email"])
+        self.store.cache_set(key, 77)
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score", "arguments": arguments,
+                   "token": hashlib.sha512("horns&hoofs" + "h&f" + api.SALT).hexdigest()}
+        response, code = api.method_handler({"body": request, "headers": {}}, self.context, self.store)
+        self.assertEqual(api.OK, code)
+        self.assertEqual(response["score"], 77)
+
+    def test_score_cached_after_compute(self):
+        score = scoring.get_score(self.store, first_name="a", last_name="b")
+        self.assertEqual(score, 0.5)
+        self.assertEqual(self.store.cache_get(scoring.get_score_key(first_name="a", last_name="b")), 0.5)
+
+    def test_cache_degrades_when_unavailable(self):
+        unavailable = self.get_unavailable_store()
+        self.assertIsNone(unavailable.cache_get("a"))
+        self.assertFalse(unavailable.cache_set("a", 1))
+        self.assertEqual(scoring.get_score(unavailable, phone="79175002040", email="a@b"), 3.0)
+
+    def test_get_raises_when_unavailable(self):
+        with self.assertRaises(store.StoreError):
+            self.get_unavailable_store().get("i:1")
+
+
+class TestMetrics(unittest.TestCase):
+    def test_histograms_merged_across_threads(self):
+        hist = metrics.LatencyHistograms("test_seconds", buckets=(0.1, 1.0))
+        labels = (("method", "online_score"), ("code", 200), ("stage", "auth"))
+        hist.observe(labels, 0.05)
+        t = threading.Thread(target=hist.observe, args=(labels, 0.5))
+        t.start()
+        t.join()
+        hist.observe(labels, 5)
+        text = hist.render()
+        labels_str = 'method="online_score",code="200",stage="auth"'
+        self.assertIn('test_seconds_bucket{%s,le="0.1"} 1' % labels_str, text)
+        self.assertIn('test_seconds_bucket{%s,le="1.0"} 2' % labels_str, text)
+        self.assertIn('test_seconds_bucket{%s,le="+Inf"} 3' % labels_str, text)
+        self.assertIn('test_seconds_count{%s} 3' % labels_str, text)
+
+    def test_finished_threads_are_merged(self):
+        hist = metrics.LatencyHistograms("test_seconds", buckets=(0.1, 1.0))
+        labels = (("method", "online_score"), ("code", 200), ("stage", "auth"))
+        for _ in range(10):
+            t = threading.Thread(target=hist.observe, args=(labels, 0.5))
+            t.start()
+            t.join()
+        self.assertEqual(hist.collect()[labels][:3], [0, 10, 0])
+        self.assertEqual(hist.registry, [])
+        hist.observe(labels, 0.05)
+        self.assertEqual(len(hist.registry), 1)
+        self.assertEqual(hist.collect()[labels][:3], [1, 10, 0])
+
+    def test_stages_timed(self):
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score",
+                   "arguments": {"first_name": "a", "last_name": "b"},
+                   "token": hashlib.sha512("horns&hoofs" + "h&f" + api.SALT).hexdigest()}
+        code, _ = api.process_http_request({"method": api.method_handler}, "/method/", json.dumps(request), {})
+        self.assertEqual(api.OK, code)
+        text = metrics.render()
+        for stage in metrics.STAGES:
+            self.assertIn('{method="online_score",code="200",stage="%s"}' % stage, text)
+
+
+class TestBench(unittest.TestCase):
+    def make_results(self, rps, p50, p99, error_rate=0.0):
+        return {"total": {"rps": rps, "error_rate": error_rate, "latency_ms": {"p50": p50, "p99": p99}}}
+
+    def test_percentile(self):
+        values = range(1, 101)
+        self.assertEqual(benchstats.percentile(values, 50), 51)
+        self.assertEqual(benchstats.percentile(values, 99), 99)
+        self.assertIsNone(benchstats.percentile([], 50))
+
+    def test_summarize(self):
+        summary = benchstats.summarize([0.003, 0.001, 0.002, 0.004], 1, 2.0)
+        self.assertEqual((summary["requests"], summary["rps"], summary["error_rate"]), (4, 2.0, 0.25))
+        self.assertEqual(summary["latency_ms"]["p50"], 3.0)
+        self.assertEqual(summary["latency_ms"]["max"], 4.0)
+        self.assertIsNone(benchstats.summarize([], 0, 1.0)["latency_ms"]["p99"])
+
+    def test_compare_with_baseline(self):
+        baseline = self.make_results(1000, 1.0, 5.0)
+        self.assertEqual(bench.compare(self.make_results(950, 1.05, 5.2), baseline, 0.1), [])
+        regressions = bench.compare(self.make_results(800, 1.0, 6.0, 0.05), baseline, 0.1)
+        self.assertEqual(len(regressions), 3)
+
+    def test_requests_get_expected_codes(self):
+        rnd = bench.random.Random(0)
+        for kind, expected in bench.EXPECTED_CODES.items():
+            _, code = api.method_handler({"body": json.loads(bench.make_request(kind, rnd)), "headers": {}}, {})
+            self.assertEqual(code, expected, kind)
+
+
+class SlowBackend(store.LRUBackend):
+    """Blocks on get of keys from slow_keys like memcached which does not reply"""
+    delay = 0.5
+
+    def __init__(self):
+        super(SlowBackend, self).__init__()
+        self.slow_keys = set()
+
+    def get(self, key):
+        if key in self.slow_keys:
+            time.sleep(self.delay)
+        return super(SlowBackend, self).get(key)
+
+
+class TestAsyncServer(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.backend = SlowBackend()
+        cls.server = async_api.AsyncHTTPServer("127.0.0.1", 0, store.Store(cls.backend), workers=4)
+        t = threading.Thread(target=cls.server.serve_forever, kwargs={"timeout": 0.1})
+        t.daemon = True
+        t.start()
+
+    def make_request(self, body, version="HTTP/1.1", connection=None):
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score", "arguments": body}
+        request["token"] = hashlib.sha512(request["account"] + request["login"] + api.SALT).hexdigest()
+        data = json.dumps(request)
+        headers = ["POST /method/ %s" % version, "Content-Length: %d" % len(data)]
+        if connection:
+            headers.append("Connection: %s" % connection)
+        return "\r\n".join(headers) + "\r\n\r\n" + data
+
+    def read_responses(self, sock):
+        data = []
+        while True:
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            data.append(chunk)
+        responses = []
+        rest = "".join(data)
+        while rest:
+            head, _, rest = rest.partition("\r\n\r\n")
+            length = int([h for h in head.split("\r\n") if h.startswith("Content-Length")][0].split(":")[1])
+            responses.append((head.split("\r\n")[0], json.loads(rest[:length])))
+            rest = rest[length:]
+        return responses
+
+    def test_pipelined_keep_alive(self):
+        sock = socket.create_connection(("127.0.0.1", self.server.port), timeout=5)
+        sock.sendall(self.make_request({"first_name": "a", "last_name": "b"}) +
+                     self.make_request({"phone": "79175002040"}) +
+                     self.make_request({"gender": 1, "birthday": "01.01.2000"}, connection="close"))
+        responses = self.read_responses(sock)
+        sock.close()
+        self.assertEqual([r["code"] for _, r in responses], [api.OK, api.INVALID_REQUEST, api.OK])
+        self.assertTrue(all(status.startswith("HTTP/1.1 %d" % r["code"]) for status, r in responses))
+
+    def test_slow_store_does_not_block_other_connections(self):
+        self.backend.slow_keys.add(scoring.get_score_key(first_name="slow", last_name="b"))
+        slow = socket.create_connection(("127.0.0.1", self.server.port), timeout=5)
+        slow.sendall(self.make_request({"first_name": "slow", "last_name": "b"}) +
+                     self.make_request({"phone": "79175002040"}, connection="close"))
+        time.sleep(0.05)
+        started = time.time()
+        sock = socket.create_connection(("127.0.0.1", self.server.port), timeout=5)
+        sock.sendall(self.make_request({"first_name": "a", "last_name": "b"}, connection="close"))
+        responses = self.read_responses(sock)
+        sock.close()
+        self.assertLess(time.time() - started, SlowBackend.delay / 2)
+        self.assertEqual(responses[0][1]["code"], api.OK)
+        # pipelined request waits for the slow one, responses keep the order
+        responses = self.read_responses(slow)
+        slow.close()
+        self.assertEqual([r["code"] for _, r in responses], [api.OK, api.INVALID_REQUEST])
+
+    def test_http10_closes_connection(self):
+        sock = socket.create_connection(("127.0.0.1", self.server.port), timeout=5)
+        sock.sendall(self.make_request({"first_name": "a", "last_name": "b"}, version="HTTP/1.0"))
+        responses = self.read_responses(sock)
+        sock.close()
+        self.assertEqual(len(responses), 1)
+        self.assertEqual(responses[0][1]["code"], api.OK)
+
+    def test_metrics(self):
+        sock = socket.create_connection(("127.0.0.1", self.server.port), timeout=5)
+        sock.sendall(self.make_request({"first_name": "a", "last_name": "b"}) +
+                     "GET /metrics HTTP/1.1\r\nConnection: close\r\n\r\n")
+        data = []
+        while True:
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            data.append(chunk)
+        sock.close()
+        self.assertIn('api_request_duration_seconds_count{method="online_score",code="200",stage="total"}',
+                      "".join(data))
+
+    def test_too_large(self):
+        sock = socket.create_connection(("127.0.0.1", self.server.port), timeout=5)
+        sock.sendall("POST /method/ HTTP/1.1\r\nContent-Length: %d\r\n\r\n" % (api.MAX_BODY_SIZE + 1))
+        responses = self.read_responses(sock)
+        sock.close()
+        self.assertEqual(responses[0][1]["code"], api.REQUEST_ENTITY_TOO_LARGE)
+
+    def test_bad_request(self):
+        sock = socket.create_connection(("127.0.0.1", self.server.port), timeout=5)
+        sock.sendall("POST /method/ HTTP/1.1\r\nContent-Length: 3\r\nConnection: close\r\n\r\n{{{")
+        responses = self.read_responses(sock)
+        sock.close()
+        self.assertEqual(responses[0][1]["code"], api.BAD_REQUEST)
+
+    def test_chunked_pipelined(self):
+        data = self.make_request({"first_name": "a", "last_name": "b"})
+        head, _, body = data.partition("\r\n\r\n")
+        head = head.replace("Content-Length: %d" % len(body), "Transfer-Encoding: chunked")
+        chunked = "%s\r\n\r\n%x;ext=1\r\n%s\r\n%x\r\n%s\r\n0\r\nX-Trailer: 1\r\n\r\n" % (
+            head, 10, body[:10], len(body) - 10, body[10:])
+        sock = socket.create_connection(("127.0.0.1", self.server.port), timeout=5)
+        sock.sendall(chunked + self.make_request({"phone": "79175002040"}, connection="close"))
+        responses = self.read_responses(sock)
+        sock.close()
+        self.assertEqual([r["code"] for _, r in responses], [api.OK, api.INVALID_REQUEST])
+
+    @cases([
+        ("Transfer-Encoding: gzip\r\n\r\n", 501),
+        ("Transfer-Encoding: chunked\r\n\r\nzz\r\n", api.BAD_REQUEST),
+        ("Transfer-Encoding: chunked\r\n\r\n3\r\nabcd\r\n", api.BAD_REQUEST),
+        ("Transfer-Encoding: chunked\r\n\r\n%x\r\n" % (api.MAX_BODY_SIZE + 1), api.REQUEST_ENTITY_TOO_LARGE),
+    ])
+    def test_bad_transfer_encoding(self, headers, code):
+        sock = socket.create_connection(("127.0.0.1", self.server.port), timeout=5)
+        sock.sendall("POST /method/ HTTP/1.1\r\n" + headers + "POST /method/ HTTP/1.1\r\n\r\n")
+        responses = self.read_responses(sock)
+        sock.close()
+        self.assertEqual([r["code"] for _, r in responses], [code])
+
 
 if __name__ == "__main__":
     unittest.main()
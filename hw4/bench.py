@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Нагрузочный тест httpd.
+# Создает временный DOCUMENT_ROOT с файлами разного размера, по очереди запускает
+# httpd в каждом из режимов и в нескольких процессах отправляет смесь GET и HEAD
+# запросов (с keep-alive или новым соединением на каждый запрос).
+# Пишет RPS, перцентили задержки, байты в секунду и ошибки по каждому режиму в JSON.
+# Если указан baseline, сравнивает с ним и завершается с кодом 1 при регрессии.
+
+# $ python bench.py --modes thread,epoll -w 4 -c 50 -d 10 --keep-alive -o results.json
+# $ python bench.py --modes thread,epoll -w 4 -c 50 -d 10 --keep-alive --baseline results.json
+
+import argparse
+import httplib
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpd
+from benchstats import choose, compare_summaries, summarize, wait_port
+
+DEFAULT_FILES = "small=1024:70,medium=65536:25,large=1048576:5"
+
+
+def parse_files(files):
+    """List of (name, size, weight) from "name=size:weight,..." """
+    result = []
+    for part in files.split(","):
+        name, _, spec = part.partition("=")
+        size, _, weight = spec.partition(":")
+        result.append((name, int(size), int(weight or 1)))
+    return result
+
+
+def make_document_root(files):
+    root = tempfile.mkdtemp(prefix="httpd-bench-")
+    for name, size, _ in files:
+        with open(os.path.join(root, name + ".bin"), "wb") as f:
+            f.write(os.urandom(size))
+    return root
+
+
+def client_worker((port, files, head_ratio, keep_alive, duration, seed)):
+    """Send requests until duration is over. Returns list of (kind, method, latency, body bytes, ok)"""
+    rnd = random.Random(seed)
+    sizes = {name: size for name, size, _ in files}
+    weights = [(name, weight) for name, _, weight in files]
+    headers = {} if keep_alive else {"Connection": "close"}
+    conn = None
+    results = []
+    deadline = time.time() + duration
+    while time.time() < deadline:
+        kind = choose(weights, rnd)
+        method = "HEAD" if rnd.random() < head_ratio else "GET"
+        start = time.time()
+        body = ""
+        try:
+            if conn is None:
+                conn = httplib.HTTPConnection("127.0.0.1", port, timeout=10)
+            conn.request(method, "/%s.bin" % kind, headers=headers)
+            response = conn.getresponse()
+            body = response.read()
+            ok = (response.status == 200 and
+                  int(response.getheader("content-length", -1)) == sizes[kind] and
+                  len(body) == (sizes[kind] if method == "GET" else 0))
+            if not keep_alive or response.getheader("connection", "").lower() == "close":
+                conn.close()
+                conn = None
+        except (socket.error, httplib.HTTPException, ValueError):
+            if conn is not None:
+                conn.close()
+                conn = None
+            ok = False
+        results.append((kind, method, time.time() - start, len(body), ok))
+    if conn is not None:
+        conn.close()
+    return results
+
+
+def start_server(mode, root, opts):
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "httpd.py")
+    cmd = [sys.executable, path, "-m", mode, "-w", str(opts.workers), "-t", str(opts.threads),
+           "-r", root, "-p", str(opts.port)] + opts.server_args.split()
+    with open(os.devnull, "w") as devnull:
+        proc = subprocess.Popen(cmd, stdout=devnull, stderr=devnull)
+    wait_port(opts.port)
+    return proc
+
+
+def run_mode(mode, root, files, opts):
+    proc = start_server(mode, root, opts)
+    try:
+        pool = multiprocessing.Pool(opts.concurrency)
+        started = time.time()
+        worker_args = [(opts.port, files, opts.head_ratio, opts.keep_alive, opts.duration, opts.seed + i)
+                       for i in range(opts.concurrency)]
+        per_worker = pool.map(client_worker, worker_args)
+        elapsed = time.time() - started
+        pool.close()
+    finally:
+        proc.terminate()
+        proc.wait()
+
+    results = [r for worker_results in per_worker for r in worker_results]
+    by_kind = {}
+    for name, _, _ in files:
+        by_kind[name] = summarize_results([r for r in results if r[0] == name], elapsed)
+    return {
+        "total": summarize_results(results, elapsed),
+        "by_kind": by_kind,
+        "by_method": {method: summarize_results([r for r in results if r[1] == method], elapsed)
+                      for method in ("GET", "HEAD")},
+    }
+
+
+def summarize_results(results, duration):
+    summary = summarize([r[2] for r in results], sum(1 for r in results if not r[4]), duration)
+    summary["bytes_per_sec"] = sum(r[3] for r in results) / float(duration)
+    return summary
+
+
+def run(opts):
+    files = parse_files(opts.files)
+    root = make_document_root(files)
+    try:
+        results = {}
+        for mode in opts.modes.split(","):
+            results[mode] = run_mode(mode, root, files, opts)
+    finally:
+        shutil.rmtree(root)
+    return {
+        "config": {"workers": opts.workers, "threads": opts.threads, "concurrency": opts.concurrency,
+                   "duration": opts.duration, "keep_alive": opts.keep_alive,
+                   "head_ratio": opts.head_ratio, "files": opts.files},
+        "modes": results,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Returns list of regressions messages, modes missing in baseline are skipped"""
+    regressions = []
+    for mode, mode_results in sorted(results["modes"].items()):
+        if mode in baseline["modes"]:
+            regressions.extend("%s: %s" % (mode, msg) for msg in compare_summaries(
+                mode_results["total"], baseline["modes"][mode]["total"], tolerance))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test for httpd")
+    parser.add_argument('--modes', default=",".join((httpd.THREAD_MODE, httpd.EPOLL_MODE)),
+                        help="Comma separated worker modes to compare")
+    parser.add_argument('-w', '--workers', type=int, default=4, help="Amount of workers, 1 - without pre-fork")
+    parser.add_argument('-t', '--threads', type=int, default=httpd.THREADS, help="Threads in every worker")
+    parser.add_argument('--server-args', default="", help="Extra args for httpd, e.g. '-c 0'")
+    parser.add_argument('-p', '--port', type=int, default=8091)
+    parser.add_argument('-c', '--concurrency', type=int, default=8, help="Amount of client processes")
+    parser.add_argument('-d', '--duration', type=float, default=10, help="Seconds per mode")
+    parser.add_argument('-k', '--keep-alive', action="store_true", help="Reuse connections")
+    parser.add_argument('-f', '--files', default=DEFAULT_FILES, help="File mix: name=size:weight,...")
+    parser.add_argument('--head-ratio', type=float, default=0.1, help="Share of HEAD requests")
+    parser.add_argument('-s', '--seed', type=int, default=0)
+    parser.add_argument('-o', '--output', default="bench_results.json")
+    parser.add_argument('-b', '--baseline', default=None)
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    opts = parser.parse_args()
+    for mode in opts.modes.split(","):
+        if mode not in (httpd.THREAD_MODE, httpd.EPOLL_MODE):
+            parser.error("unknown mode %s" % mode)
+
+    results = run(opts)
+    with open(opts.output, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    for mode, mode_results in sorted(results["modes"].items()):
+        total = mode_results["total"]
+        print "%s: %d requests, %.1f rps, %.1f MB/s, p50 %.2fms, p99 %.2fms, errors %.2f%%" % (
+            mode, total["requests"], total["rps"], total["bytes_per_sec"] / 1024 / 1024,
+            total["latency_ms"]["p50"], total["latency_ms"]["p99"], total["error_rate"] * 100)
+
+    if opts.baseline:
+        with open(opts.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, opts.tolerance)
+        for msg in regressions:
+            print "REGRESSION: %s" % msg
+        if regressions:
+            sys.exit(1)
+        print "No regressions against %s" % opts.baseline
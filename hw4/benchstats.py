@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+# Общие функции нагрузочного теста (bench.py) и тестов (test.py): выбор файла
+# по весам, перцентили и сводка по задержкам, ожидание порта, сравнение с baseline.
+
+import socket
+import time
+
+
+def choose(weights, rnd):
+    """Kind from list of (kind, weight)"""
+    n = rnd.randint(1, sum(w for _, w in weights))
+    for kind, w in weights:
+        n -= w
+        if n <= 0:
+            return kind
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(p / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize(latencies, errors, duration):
+    """Throughput, error rate and latency percentiles of requests"""
+    latencies = sorted(latencies)
+    return {
+        "requests": len(latencies),
+        "rps": len(latencies) / float(duration),
+        "errors": errors,
+        "error_rate": float(errors) / len(latencies) if latencies else 0.0,
+        "latency_ms": {
+            "p50": percentile(latencies, 50) * 1000 if latencies else None,
+            "p90": percentile(latencies, 90) * 1000 if latencies else None,
+            "p99": percentile(latencies, 99) * 1000 if latencies else None,
+            "max": latencies[-1] * 1000 if latencies else None,
+        },
+    }
+
+
+def wait_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+    raise RuntimeError("Server did not start on port %d" % port)
+
+
+def compare_summaries(new, old, tolerance):
+    """Returns list of regressions messages of new summary against old one"""
+    regressions = []
+    if new["rps"] < old["rps"] * (1 - tolerance):
+        regressions.append("rps %.1f < baseline %.1f" % (new["rps"], old["rps"]))
+    for p in ("p50", "p99"):
+        if new["latency_ms"][p] > old["latency_ms"][p] * (1 + tolerance):
+            regressions.append("%s %.2fms > baseline %.2fms" % (p, new["latency_ms"][p], old["latency_ms"][p]))
+    if new["error_rate"] > old["error_rate"] + tolerance / 10:
+        regressions.append("error rate %.4f > baseline %.4f" % (new["error_rate"], old["error_rate"]))
+    return regressions
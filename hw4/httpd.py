@@ -1,19 +1,207 @@
 # coding: utf-8
 
 import argparse
+import cgi
+import collections
+import ctypes
+import ctypes.util
+import errno
 import os
+import select
+import signal
 import socket
+import stat
+import sys
 import threading
+import time
+import traceback
 import urllib
-import multiprocessing
-from email.utils import formatdate
+import urlparse
+import zlib
+from array import array
+from email.utils import formatdate, mktime_tz, parsedate_tz
+from Queue import Queue
 
-DEBUG = True
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+DEBUG = False
 
 DOCUMENT_ROOT = os.getcwd()
+HOST = ""
+PORT = 80
+WORKERS = 1
+THREADS = 16
+BACKLOG = 128
+# worker which dies faster is respawned with delay to avoid fork loop
+MIN_WORKER_LIFETIME = 1.0
+
+THREAD_MODE = "thread"
+EPOLL_MODE = "epoll"
+MODE = THREAD_MODE
+# initial size of connection receive buffer, grows up to MAX_HEADERS_SIZE
+REQUEST_BUFFER_SIZE = 4096
+MAX_HEADERS_SIZE = 64 * 1024
+# connections without any activity during this time are closed
+KEEP_ALIVE_TIMEOUT = 5
+# connection is closed after this amount of requests
+MAX_KEEP_ALIVE_REQUESTS = 100
+# used when sendfile is not available
+FILE_BLOCK_SIZE = 64 * 1024
+# open files cache: max entries per worker and how often entry is checked against file mtime
+FILE_CACHE_SIZE = 1024
+FILE_CACHE_CHECK_INTERVAL = 1.0
+# on-the-fly gzip: compressible types, file size limits, cache size in bytes per worker
+GZIP_TYPES = ("text/html", "text/css", "text/javascript")
+GZIP_MIN_SIZE = 256
+GZIP_MAX_SIZE = 1024 * 1024
+GZIP_LEVEL = 6
+GZIP_CACHE_SIZE = 16 * 1024 * 1024
+# charged to cache size for every entry, so entries of not compressible files are bounded too
+GZIP_ENTRY_OVERHEAD = 512
+# generated directory indexes: cached directories per worker, entries per page
+DIR_CACHE_SIZE = 16 * 1024 * 1024
+# charged to cache size for every listing, names and rendered pages are added as is
+DIR_ENTRY_OVERHEAD = 512
+LISTING_PAGE_SIZE = 1000
+# access log is written by background thread of every worker with this interval
+ACCESS_LOG_FLUSH_INTERVAL = 0.5
 
 GET = "GET"
 HEAD = "HEAD"
+# parse_range result for range outside of file
+RANGE_NOT_SATISFIABLE = "not satisfiable"
+
+
+def get_libc():
+    if not sys.platform.startswith("linux"):
+        return None
+    return ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+
+
+def get_sendfile():
+    """os.sendfile is only in python 3, call libc directly on linux"""
+    if hasattr(os, "sendfile"):
+        return os.sendfile
+    libc = get_libc()
+    if libc is None:
+        return None
+    libc_sendfile = getattr(libc, "sendfile64", None) or libc.sendfile
+    libc_sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    libc_sendfile.restype = ctypes.c_ssize_t
+
+    def sendfile(out_fd, in_fd, offset, count):
+        offset = ctypes.c_int64(offset)
+        sent = libc_sendfile(out_fd, in_fd, ctypes.byref(offset), count)
+        if sent < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return sent
+    return sendfile
+
+
+sendfile = get_sendfile()
+
+
+class IOVec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+
+def get_writev():
+    """socket.sendmsg is only in python 3, call libc writev directly on linux"""
+    libc = get_libc()
+    if libc is None:
+        return None
+    libc_writev = libc.writev
+    libc_writev.argtypes = [ctypes.c_int, ctypes.POINTER(IOVec), ctypes.c_int]
+    libc_writev.restype = ctypes.c_ssize_t
+
+    def writev(fd, parts):
+        """parts is a list of (str, offset), strings are not copied"""
+        iov = (IOVec * len(parts))()
+        for i, (part, offset) in enumerate(parts):
+            iov[i].iov_base = ctypes.cast(ctypes.c_char_p(part), ctypes.c_void_p).value + offset
+            iov[i].iov_len = len(part) - offset
+        while True:
+            sent = libc_writev(fd, iov, len(parts))
+            if sent >= 0:
+                return sent
+            err = ctypes.get_errno()
+            if err != errno.EINTR:
+                raise OSError(err, os.strerror(err))
+    return writev
+
+
+writev = get_writev()
+
+
+def http_date():
+    """Date header value, formatted once per second"""
+    global cached_date
+    now = int(time.time())
+    second, date = cached_date
+    if second != now:
+        date = formatdate(now, usegmt=True)
+        cached_date = (now, date)
+    return date
+
+
+cached_date = (0, "")
+
+
+class RequestBuffer(object):
+    """Receive buffer of connection. Data is received with recv_into right
+    into bytearray, end of headers is searched only in new bytes (and 3 before
+    them), so headers split between reads are found without rescanning"""
+
+    def __init__(self, size=REQUEST_BUFFER_SIZE):
+        self.data = bytearray(size)
+        # unconsumed data is data[start:end], no end of headers before scanned
+        self.start = 0
+        self.end = 0
+        self.scanned = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def recv_from(self, sock, flags=0):
+        """Receive into free space, returns 0 if peer closed connection"""
+        if self.end == len(self.data):
+            self.make_room()
+        received = sock.recv_into(memoryview(self.data)[self.end:], 0, flags)
+        self.end += received
+        return received
+
+    def make_room(self):
+        size = self.end - self.start
+        if self.start == 0:
+            data = bytearray(len(self.data) * 2)
+            data[:size] = self.data
+            self.data = data
+        else:
+            self.data[:size] = self.data[self.start:self.end]
+        self.scanned -= self.start
+        self.start, self.end = 0, size
+
+    def pop_request(self):
+        """Headers of first complete request as str, None if end of headers
+        is not received yet"""
+        pos = self.data.find("\r\n\r\n", max(self.scanned - 3, self.start), self.end)
+        if pos < 0:
+            self.scanned = self.end
+            return None
+        request_end = pos + 4
+        request_msg = str(buffer(self.data, self.start, request_end - self.start))
+        if request_end == self.end:
+            self.start = self.end = self.scanned = 0
+        else:
+            self.start = self.scanned = request_end
+        return request_msg
 
 
 class HTTPRequest(object):
@@ -21,164 +209,893 @@ class HTTPRequest(object):
         self.request_msg = request_msg
         self.method_type = None
         self.uri = None
+        self.version = None
         self.query_str = None
+        self.parsed_headers = None
         self.parse_request_msg()
 
     def parse_request_msg(self):
-        request = self.request_msg.split("\r\n")
-        self.method_type, uri, _ = request[0].split(" ")
-        uri = urllib.unquote(uri)
+        """Only request line, headers are parsed on first access"""
+        line_end = self.request_msg.find("\r\n")
+        self.method_type, uri, self.version = self.request_msg[:line_end].split(" ")
         query_index = uri.find('?')
         if query_index > 0:
-            self.uri = uri[:query_index]
-        else:
-            self.uri = uri
+            self.query_str = uri[query_index + 1:]
+            uri = uri[:query_index]
+        self.uri = urllib.unquote(uri)
+
+    @property
+    def headers(self):
+        """Dict of headers with lowercase names"""
+        if self.parsed_headers is None:
+            self.parsed_headers = {}
+            line_end = self.request_msg.find("\r\n")
+            for line in self.request_msg[line_end + 2:].split("\r\n"):
+                if not line:
+                    break
+                name, _, value = line.partition(":")
+                self.parsed_headers[name.strip().lower()] = value.strip()
+        return self.parsed_headers
+
+    @property
+    def keep_alive(self):
+        connection = self.headers.get("connection", "").lower()
+        if self.version == "HTTP/1.1":
+            return connection != "close"
+        return connection == "keep-alive"
+
+    @property
+    def has_body(self):
+        """Request body is never read, so connection can't be reused after it"""
+        return self.headers.get("content-length", "0") != "0" or "transfer-encoding" in self.headers
 
 
 class HTTPResponse(object):
     STATUS_TEXT = {
         200: "OK",
+        206: "Partial content",
+        304: "Not modified",
         400: "Bad request",
         404: "Not found",
         403: "Forbidden",
-        405: "Method not allowed"
+        405: "Method not allowed",
+        416: "Range not satisfiable",
+        500: "Internal server error"
     }
 
-    def __init__(self, status, content_type=None, body_msg=None, only_headers=False):
+    def __init__(self, status, content_type=None, body_msg=None, only_headers=False, body_file=None,
+                 file_range=None, content_encoding=None):
+        """body_file is a FileCacheEntry sent after headers, response releases it on close.
+        file_range is (first, last) byte positions of body_file for 206 response.
+        content_encoding is set for compressed body, content_type is then type of original"""
         self.status = status
         self.content_type = content_type
+        self.content_encoding = content_encoding
         self.body_msg = body_msg
         self.only_headers = only_headers
+        self.body_file = body_file
+        self.body_file_offset = 0
+        self.body_file_end = 0
+        self.file_headers_msg = ""
+        self.keep_alive = False
+        # for access log
+        self.request_line = ""
+        self.request = None
+        if body_file is not None:
+            if status == 304:
+                # no body, only validators of the cached copy
+                self.file_headers_msg = body_file.validators_msg
+            elif file_range is not None:
+                first, last = file_range
+                self.body_file_offset, self.body_file_end = first, last + 1
+                self.file_headers_msg = body_file.range_headers_msg(first, last)
+            elif content_encoding is not None:
+                self.body_file_end = body_file.size
+                self.file_headers_msg = body_file.encoded_headers_msg(content_type, content_encoding)
+            else:
+                self.body_file_end = body_file.size
+                self.file_headers_msg = body_file.headers_msg
+            if only_headers:
+                self.close()
         self.headers = {}
         self.set_common_headers()
 
     def set_common_headers(self):
-        self.headers["Date"] = formatdate(usegmt=True)
+        self.headers["Date"] = http_date()
         self.headers["Server"] = "otus-simple-server"
+        if self.file_headers_msg:
+            # Content-Type, Content-Length and validators are rendered by file cache
+            return
+        if self.status == 304:
+            return
+        if self.content_encoding:
+            self.headers["Content-Encoding"] = self.content_encoding
         if self.content_type:
             self.headers["Content-Type"] = self.content_type
         else:
             self.headers["Content-Type"] = "text/html"
         if self.body_msg:
             self.headers["Content-Length"] = len(self.body_msg)
+        else:
+            self.headers["Content-Length"] = 0
+        self.set_keep_alive(False)
 
-    def get_response_msg(self):
-        msg = "HTTP/1.1 {} {}\r\n".format(self.status, self.STATUS_TEXT[self.status])
+    def set_keep_alive(self, keep_alive):
+        self.keep_alive = keep_alive
+        self.headers["Connection"] = "keep-alive" if keep_alive else "close"
+
+    def get_response_parts(self):
+        """Headers and in-memory body as separate strings for writev,
+        body_file is not included"""
+        lines = ["HTTP/1.1 {} {}\r\n".format(self.status, self.STATUS_TEXT[self.status])]
         for name, text in self.headers.items():
-            msg += "{}: {}\r\n".format(name, text)
-        msg += "\r\n"
+            lines.append("{}: {}\r\n".format(name, text))
+        lines.append(self.file_headers_msg)
+        lines.append("\r\n")
+        parts = ["".join(lines)]
         if self.body_msg and not self.only_headers:
-            msg += "{}\r\n".format(self.body_msg)
-        return msg
+            parts.append(self.body_msg)
+        return parts
+
+    def get_response_msg(self):
+        return "".join(self.get_response_parts())
+
+    def close(self):
+        if self.body_file is not None:
+            self.body_file.close()
+            self.body_file = None
+
+
+def send_parts(s, parts, offset):
+    """Send strings from offset in their concatenation with one writev call
+    without joining them. Returns amount of sent bytes"""
+    pending = []
+    for part in parts:
+        if offset >= len(part):
+            offset -= len(part)
+            continue
+        pending.append((part, offset))
+        offset = 0
+    if writev is not None:
+        return writev(s.fileno(), pending)
+    part, offset = pending[0]
+    return s.send(buffer(part, offset))
+
+
+def send_file_part(s, f, offset, count):
+    """Send up to count bytes of file f from offset without reading it
+    into memory when sendfile is available. Returns amount of sent bytes"""
+    if sendfile is not None:
+        try:
+            return sendfile(s.fileno(), f.fileno(), offset, count)
+        except OSError as e:
+            if e.errno not in (errno.EINVAL, errno.ENOSYS):
+                raise
+    return s.send(f.read(offset, min(count, FILE_BLOCK_SIZE)))
+
+
+class FileCacheEntry(object):
+    """Open file with its metadata and pre-rendered headers.
+    fd is shared by concurrent responses: sendfile is called with explicit
+    offset, so file position is not used. fd is closed when entry is
+    evicted from cache and not used by any response"""
+
+    def __init__(self, cache, path, fd, st):
+        self.cache = cache
+        self.path = path
+        self.fd = fd
+        self.size = st.st_size
+        self.mtime = st.st_mtime
+        self.ino = st.st_ino
+        self.content_type = get_content_type(path)
+        self.last_modified = formatdate(st.st_mtime, usegmt=True)
+        self.etag = '"{:x}-{:x}-{:x}"'.format(st.st_ino, int(st.st_mtime), st.st_size)
+        self.validators_msg = "Last-Modified: {}\r\nETag: {}\r\n".format(self.last_modified, self.etag)
+        self.headers_msg = (
+            "Content-Type: {}\r\n"
+            "Content-Length: {}\r\n"
+            "Accept-Ranges: bytes\r\n"
+        ).format(self.content_type, self.size) + self.validators_msg
+        self.checked_at = time.time()
+        self.users = 0
+        self.stale = False
+        self.read_lock = threading.Lock()
+
+    def range_headers_msg(self, first, last):
+        return (
+            "Content-Type: {}\r\n"
+            "Content-Length: {}\r\n"
+            "Content-Range: bytes {}-{}/{}\r\n"
+        ).format(self.content_type, last - first + 1, first, last, self.size) + self.validators_msg
+
+    def encoded_headers_msg(self, content_type, content_encoding):
+        """Headers for pre-compressed file served as content_type"""
+        return (
+            "Content-Type: {}\r\n"
+            "Content-Length: {}\r\n"
+            "Content-Encoding: {}\r\n"
+        ).format(content_type, self.size, content_encoding) + self.validators_msg
+
+    def is_same_file(self, st):
+        return (st.st_mtime, st.st_size, st.st_ino) == (self.mtime, self.size, self.ino)
+
+    def fileno(self):
+        return self.fd
+
+    def read(self, offset, count):
+        """Read without sendfile, fd position is shared between threads"""
+        with self.read_lock:
+            os.lseek(self.fd, offset, os.SEEK_SET)
+            return os.read(self.fd, count)
+
+    def close(self):
+        self.cache.release(self)
+
+
+class FileCache(object):
+    """LRU of FileCacheEntry by normalized path. Entry is checked against
+    file on disk not more often than check_interval, hot files are served
+    without stat/open calls"""
+
+    def __init__(self, maxsize=FILE_CACHE_SIZE, check_interval=FILE_CACHE_CHECK_INTERVAL):
+        self.maxsize = maxsize
+        self.check_interval = check_interval
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        """Acquired entry for regular file or None, entry must be closed after use"""
+        now = time.time()
+        with self.lock:
+            entry = self.entries.pop(path, None)
+            if entry is not None:
+                self.entries[path] = entry
+                if now - entry.checked_at < self.check_interval:
+                    entry.users += 1
+                    return entry
+
+        if entry is not None:
+            try:
+                st = os.stat(path)
+            except OSError:
+                st = None
+            with self.lock:
+                if st is not None and entry.is_same_file(st) and not entry.stale:
+                    entry.checked_at = now
+                    entry.users += 1
+                    return entry
+                self.evict(entry)
+
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            return None
+        try:
+            st = os.fstat(fd)
+        except OSError:
+            os.close(fd)
+            return None
+        if not stat.S_ISREG(st.st_mode):
+            os.close(fd)
+            return None
+
+        entry = FileCacheEntry(self, path, fd, st)
+        entry.users = 1
+        with self.lock:
+            old = self.entries.get(path)
+            if old is not None:
+                self.evict(old)
+            if self.maxsize > 0:
+                self.entries[path] = entry
+            else:
+                entry.stale = True
+            while len(self.entries) > self.maxsize:
+                self.evict(next(self.entries.itervalues()))
+        return entry
+
+    def evict(self, entry):
+        """Must be called with lock held"""
+        if entry.stale:
+            return
+        if self.entries.get(entry.path) is entry:
+            del self.entries[entry.path]
+        entry.stale = True
+        if entry.users == 0:
+            os.close(entry.fd)
+
+    def release(self, entry):
+        with self.lock:
+            entry.users -= 1
+            if entry.stale and entry.users == 0:
+                os.close(entry.fd)
+
+
+file_cache = FileCache()
+
+
+class GzipCacheEntry(object):
+    """Compressed copy of file, data is None if compression doesn't reduce size"""
+
+    def __init__(self, body_file, data):
+        self.data = data
+        self.size = len(data) if data is not None else 0
+        self.cost = self.size + GZIP_ENTRY_OVERHEAD
+        self.mtime = body_file.mtime
+        self.etag = body_file.etag[:-1] + '-gz"'
+        self.validators = {"Last-Modified": body_file.last_modified, "ETag": self.etag}
+
+
+class GzipCache(object):
+    """LRU of compressed files by path, mtime and size, bounded by total
+    compressed size plus fixed overhead per entry. Every version of file
+    is compressed once"""
+
+    def __init__(self, maxsize=GZIP_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.size = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, body_file):
+        key = (body_file.path, body_file.mtime, body_file.size)
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.entries[key] = entry
+                return entry
+
+        # compress outside of lock, concurrent misses may compress twice
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        data = compressor.compress(body_file.read(0, body_file.size)) + compressor.flush()
+        entry = GzipCacheEntry(body_file, data if len(data) < body_file.size else None)
+        if entry.cost > self.maxsize:
+            return entry
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old.cost
+            self.entries[key] = entry
+            self.size += entry.cost
+            while self.size > self.maxsize:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= evicted.cost
+        return entry
+
+
+gzip_cache = GzipCache()
+
+
+def list_dir(path, nlink=0):
+    """Sorted names of directory entries, subdirectories first and with
+    trailing slash. scandir gets entry type without stat call per entry.
+    nlink is st_nlink of directory: 2 means no subdirectories (like find does),
+    then entries are not stat'ed"""
+    if nlink == 2:
+        return sorted(os.listdir(path))
+    if scandir is not None:
+        entries = ((not entry.is_dir(), entry.name) for entry in scandir(path))
+    else:
+        entries = ((not os.path.isdir(os.path.join(path, name)), name) for name in os.listdir(path))
+    return [name if is_file else name + "/" for is_file, name in sorted(entries)]
+
+
+class DirNames(object):
+    """Sorted names of directory in one str, name i is
+    data[offsets[i]:offsets[i + 1]]. Takes a few bytes per name instead
+    of a str object per name"""
+
+    def __init__(self, names):
+        self.data = "".join(names)
+        self.offsets = array("L", [0])
+        end = 0
+        for name in names:
+            end += len(name)
+            self.offsets.append(end)
+        self.size = len(self.data) + len(self.offsets) * self.offsets.itemsize
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def get_range(self, start, stop):
+        """List of names from start to stop"""
+        data, offsets = self.data, self.offsets
+        stop = min(stop, len(self))
+        return [data[offsets[i]:offsets[i + 1]] for i in xrange(start, stop)]
+
+
+class DirListing(object):
+    """Entries of directory, html pages are rendered on first request.
+    size is memory taken by names and rendered pages"""
+
+    def __init__(self, path, title, st):
+        self.path = path
+        self.title = title
+        self.mtime = st.st_mtime
+        self.checked_at = time.time()
+        self.names = DirNames(list_dir(path, st.st_nlink))
+        self.pages_count = max((len(self.names) + LISTING_PAGE_SIZE - 1) // LISTING_PAGE_SIZE, 1)
+        self.pages = {}
+        self.size = DIR_ENTRY_OVERHEAD + self.names.size
+        # size accounted in cache
+        self.charged = 0
+
+    def get_page(self, page):
+        """Html of page, numbered from 1, or None if there is no such page"""
+        if not 1 <= page <= self.pages_count:
+            return None
+        html = self.pages.get(page)
+        if html is None:
+            html = self.render_page(page)
+            if page not in self.pages:
+                self.pages[page] = html
+                self.size += len(html)
+        return html
+
+    def render_page(self, page):
+        title = cgi.escape(self.title)
+        lines = ["<html><head><title>Index of {0}</title></head><body><h1>Index of {0}</h1><ul>".format(title)]
+        if self.title != "/":
+            lines.append('<li><a href="../">../</a></li>')
+        start = (page - 1) * LISTING_PAGE_SIZE
+        for name in self.names.get_range(start, start + LISTING_PAGE_SIZE):
+            lines.append('<li><a href="{}">{}</a></li>'.format(urllib.quote(name), cgi.escape(name)))
+        lines.append("</ul>")
+        if self.pages_count > 1:
+            nav = []
+            if page > 1:
+                nav.append('<a href="?page={}">previous</a>'.format(page - 1))
+            nav.append("page {} of {}".format(page, self.pages_count))
+            if page < self.pages_count:
+                nav.append('<a href="?page={}">next</a>'.format(page + 1))
+            lines.append("<p>{}</p>".format(" | ".join(nav)))
+        lines.append("</body></html>")
+        return "\n".join(lines)
+
+
+class DirListingCache(object):
+    """LRU of DirListing by normalized path, bounded by total size of names
+    and rendered pages. Listing is rebuilt when directory mtime changes,
+    mtime is checked not more often than check_interval. Listing larger than
+    the whole cache is served without caching"""
+
+    def __init__(self, maxsize=DIR_CACHE_SIZE, check_interval=FILE_CACHE_CHECK_INTERVAL):
+        self.maxsize = maxsize
+        self.check_interval = check_interval
+        self.size = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_page(self, path, title, page):
+        """Html of listing page, None if path is not a readable directory
+        or there is no such page"""
+        listing = self.get(path, title)
+        if listing is None:
+            return None
+        html = listing.get_page(page)
+        if listing.size != listing.charged:
+            # page was rendered
+            with self.lock:
+                if self.entries.get(path) is listing:
+                    self.size += listing.size - listing.charged
+                    listing.charged = listing.size
+                    self.evict()
+        return html
+
+    def get(self, path, title):
+        """DirListing or None if path is not a readable directory"""
+        now = time.time()
+        with self.lock:
+            listing = self.entries.pop(path, None)
+            if listing is not None:
+                self.entries[path] = listing
+                if now - listing.checked_at < self.check_interval:
+                    return listing
+
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if not stat.S_ISDIR(st.st_mode):
+            return None
+        if listing is not None and listing.mtime == st.st_mtime:
+            listing.checked_at = now
+            return listing
+
+        # directory is listed outside of lock, concurrent misses may list it twice
+        try:
+            listing = DirListing(path, title, st)
+        except OSError:
+            return None
+        if listing.size <= self.maxsize:
+            with self.lock:
+                old = self.entries.pop(path, None)
+                if old is not None:
+                    self.size -= old.charged
+                self.entries[path] = listing
+                listing.charged = listing.size
+                self.size += listing.charged
+                self.evict()
+        return listing
+
+    def evict(self):
+        """Must be called with lock held"""
+        while self.size > self.maxsize:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= evicted.charged
+
+
+dir_cache = DirListingCache()
+
 
+def resolve_path(uri):
+    """Normalized path of uri in DOCUMENT_ROOT, None if uri points outside of it.
+    Raises ValueError if uri has NUL or is not valid UTF-8 after unquoting"""
+    if "\0" in uri:
+        raise ValueError("NUL in uri")
+    uri.decode("utf-8")
+    root = os.path.normpath(DOCUMENT_ROOT)
+    path = os.path.normpath(os.path.join(root, uri.lstrip("/")))
+    if path != root and not path.startswith(root.rstrip(os.sep) + os.sep):
+        return None
+    return path
 
-def handle_client(s):
-    chunks = []
-    method_type = None
-    uri = None
+
+def send_response(s, response):
+    """Send response to blocking socket. Returns amount of sent body bytes"""
+    try:
+        parts = response.get_response_parts()
+        size = sum(len(part) for part in parts)
+        sent = 0
+        while sent < size:
+            sent += send_parts(s, parts, sent)
+        body_bytes = size - len(parts[0])
+        if response.body_file is None:
+            return body_bytes
+        offset = response.body_file_offset
+        while offset < response.body_file_end:
+            sent = send_file_part(s, response.body_file, offset, response.body_file_end - offset)
+            if not sent:
+                # file was truncated after fstat
+                break
+            offset += sent
+        return body_bytes + offset - response.body_file_offset
+    finally:
+        response.close()
+
+
+class PooledConnection(object):
+    """Client connection in thread mode, kept between pool threads and
+    idle connections poller"""
+
+    def __init__(self, sock, addr):
+        self.sock = sock
+        self.addr = addr
+        self.buf = RequestBuffer()
+        self.served = 0
+        self.idle_since = 0
+
+    def close(self):
+        self.sock.close()
+
+
+def handle_client(conn, idle):
+    """Serve requests from blocking socket while they are already received.
+    When there is nothing to read, connection is parked in idle poller
+    instead of waiting in pool thread. Pipelined requests are taken from
+    the same buffer"""
+    s, buf = conn.sock, conn.buf
     while True:
-        chunk = s.recv(1024)
-        chunks.append(chunk)
-        if chunk.endswith("\r\n\r\n") or not chunk:
+        request_msg = buf.pop_request()
+        while request_msg is None:
+            if len(buf) > MAX_HEADERS_SIZE:
+                started = time.time()
+                response = HTTPResponse(400)
+                access_log.log(conn.addr, response, send_response(s, response), started)
+                conn.close()
+                return
+            try:
+                received = buf.recv_from(s, socket.MSG_DONTWAIT)
+            except socket.error as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+                idle.park(conn)
+                return
+            if not received:
+                conn.close()
+                return
+            request_msg = buf.pop_request()
+        conn.served += 1
+        started = time.time()
+        response = make_response(request_msg, conn.served < MAX_KEEP_ALIVE_REQUESTS)
+        access_log.log(conn.addr, response, send_response(s, response), started)
+        if not response.keep_alive:
             break
+    conn.close()
+
+
+class IdleConnections(object):
+    """Thread mode connections waiting for next request. They are watched
+    by one epoll thread and go back to pool queue when readable, so idle
+    keep-alive clients don't hold pool threads. Closed after KEEP_ALIVE_TIMEOUT"""
+
+    def __init__(self, clients):
+        self.clients = clients
+        self.epoll = select.epoll()
+        self.lock = threading.Lock()
+        self.connections = {}
+
+    def park(self, conn):
+        conn.idle_since = time.time()
+        fd = conn.sock.fileno()
+        with self.lock:
+            self.connections[fd] = conn
+        self.epoll.register(fd, select.EPOLLIN | select.EPOLLONESHOT)
+
+    def take(self, fd):
+        with self.lock:
+            conn = self.connections.pop(fd, None)
+        if conn is not None:
+            self.epoll.unregister(fd)
+        return conn
 
-    request_msg = "".join(chunks)
+    def run(self):
+        last_sweep = time.time()
+        while True:
+            try:
+                events = self.epoll.poll(1)
+            except IOError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            for fd, _ in events:
+                conn = self.take(fd)
+                if conn is not None:
+                    # readable, closed or error: pool thread finds out which
+                    self.clients.put(conn)
 
-    debug_print("Current process: {}, thread: {}".format(os.getpid(), threading.currentThread().ident))
-    debug_print("<-")
-    debug_print("".join(request_msg))
+            now = time.time()
+            if now - last_sweep > 1:
+                last_sweep = now
+                with self.lock:
+                    expired = [fd for fd, conn in self.connections.items()
+                               if now - conn.idle_since > KEEP_ALIVE_TIMEOUT]
+                for fd in expired:
+                    conn = self.take(fd)
+                    if conn is not None:
+                        conn.close()
+
+
+def make_response(request_msg, keep_alive=False):
+    """HTTPResponse for request message, shared by all server modes.
+    Connection is kept alive if keep_alive is allowed and client asks for it"""
+    if DEBUG:
+        debug_print("Current process: {}, thread: {}".format(os.getpid(), threading.currentThread().ident))
+        debug_print("<-")
+        debug_print(request_msg)
 
     try:
         request = HTTPRequest(request_msg)
     except Exception as exc:
         debug_print(exc)
-        resp_msg = HTTPResponse(400).get_response_msg()
+        response = HTTPResponse(400)
+        response.request_line = request_msg[:request_msg.find("\r\n")]
+        return response
+
+    try:
+        response = route_request(request)
+    except Exception:
+        # only this connection is closed, other connections of worker are served
+        traceback.print_exc()
+        response = HTTPResponse(500)
+        keep_alive = False
+    response.set_keep_alive(keep_alive and request.keep_alive and not request.has_body)
+    response.request_line = request_msg[:request_msg.find("\r\n")]
+    response.request = request
+
+    if DEBUG:
         debug_print("->")
-        debug_print(resp_msg)
-        s.send(resp_msg)
-        s.close()
-        return
+        debug_print(response.get_response_msg())
+    return response
+
 
+def route_request(request):
     method_type = request.method_type
     uri = request.uri
-    if method_type in (GET, HEAD):
-        if uri and uri.startswith('/'):
-            if uri == '/':
-                # index.html
-                body = "<ul>"
-                filenames = []
-                for name in os.listdir("."):
-                    filenames.append(name)
-                body_msg = "<ul><li>" + "</li><li>".join(filenames) + "</li><ul>"
-                resp_msg = HTTPResponse(200, body_msg=body_msg).get_response_msg()
-            elif uri.endswith('/'):
-                # directory
-                index_name = os.path.join(DOCUMENT_ROOT, uri[1:len(uri)-1], "index.html")
-                if os.path.isfile(index_name):
-                    # index.html exists
-                    body_msg = read_file(index_name)
-                    content_type = get_content_type(index_name)
-                    if method_type == GET:
-                        only_headers = False
-                    else:
-                        only_headers = True
-                    resp_msg = HTTPResponse(200, body_msg=body_msg,
-                                            only_headers=only_headers,
-                                            content_type=content_type).get_response_msg()
-                else:
-                    resp_msg = HTTPResponse(403).get_response_msg()
-            else:
-                # file
-                filename = os.path.join(DOCUMENT_ROOT, uri[1:])
-                if os.path.isfile(filename):
-                    body_msg = read_file(filename)
-                    content_type = get_content_type(filename)
-                    if method_type == GET:
-                        only_headers = False
-                    else:
-                        only_headers = True
-                    resp_msg = HTTPResponse(200, body_msg=body_msg,
-                                            only_headers=only_headers,
-                                            content_type=content_type).get_response_msg()
+    if method_type not in (GET, HEAD):
+        return HTTPResponse(405)
+    if not uri or not uri.startswith('/'):
+        # bad request
+        return HTTPResponse(405)
+    try:
+        path = resolve_path(uri)
+    except ValueError:
+        return HTTPResponse(400)
+    if path is None:
+        return HTTPResponse(403)
+    if uri.endswith('/'):
+        # directory
+        index_file = file_cache.get(os.path.join(path, "index.html"))
+        if index_file is not None:
+            # index.html exists
+            return make_file_response(request, index_file)
+        return make_listing_response(request, path)
+    # file
+    body_file = file_cache.get(path)
+    if body_file is not None:
+        return make_file_response(request, body_file)
+    return HTTPResponse(404)
+
+
+def make_listing_response(request, path):
+    """Page of generated directory index, page number is in query string"""
+    root = os.path.normpath(DOCUMENT_ROOT)
+    title = "/" if path == root else "/" + os.path.relpath(path, root) + "/"
+    page = urlparse.parse_qs(request.query_str or "").get("page", ["1"])[0]
+    body_msg = dir_cache.get_page(path, title, int(page)) if page.isdigit() else None
+    if body_msg is None:
+        return HTTPResponse(404)
+    return HTTPResponse(200, body_msg=body_msg, only_headers=request.method_type != GET)
+
+
+def make_file_response(request, body_file):
+    """Gzip encoded response for compressible types if client accepts it,
+    identity otherwise. Range requests are served from the original file.
+    body_file is passed to the response or released, also on error"""
+    try:
+        if body_file.content_type not in GZIP_TYPES:
+            return make_identity_response(request, body_file)
+        response = None
+        if "range" not in request.headers and accepts_gzip(request):
+            response = make_gzip_response(request, body_file)
+        if response is None:
+            response = make_identity_response(request, body_file)
+    except Exception:
+        # helpers release body_file only after the response is built
+        body_file.close()
+        raise
+    response.headers["Vary"] = "Accept-Encoding"
+    return response
+
+
+def accepts_gzip(request):
+    for coding in request.headers.get("accept-encoding", "").split(","):
+        name, _, params = coding.partition(";")
+        if name.strip().lower() not in ("gzip", "*"):
+            continue
+        params = params.strip().replace(" ", "")
+        if not params.startswith("q="):
+            return True
+        try:
+            return float(params[2:]) > 0
+        except ValueError:
+            return False
+    return False
+
+
+def make_gzip_response(request, body_file):
+    """200 or 304 for pre-compressed .gz file next to body_file, or for its
+    copy from gzip_cache. None if there is no smaller compressed variant,
+    body_file is released otherwise"""
+    only_headers = request.method_type != GET
+    gz_file = file_cache.get(body_file.path + ".gz")
+    if gz_file is not None:
+        if gz_file.mtime >= body_file.mtime:
+            try:
+                if is_not_modified(request, gz_file):
+                    response = HTTPResponse(304, body_file=gz_file, only_headers=True)
                 else:
-                    resp_msg = HTTPResponse(404).get_response_msg()
-        else:
-            # bad request
-            resp_msg = HTTPResponse(405).get_response_msg()
+                    response = HTTPResponse(200, content_type=body_file.content_type, body_file=gz_file,
+                                            only_headers=only_headers, content_encoding="gzip")
+            except Exception:
+                gz_file.close()
+                raise
+            body_file.close()
+            return response
+        # stale .gz file
+        gz_file.close()
+
+    if not GZIP_MIN_SIZE <= body_file.size <= GZIP_MAX_SIZE or gzip_cache.maxsize <= 0:
+        return None
+    compressed = gzip_cache.get(body_file)
+    if compressed.data is None:
+        return None
+    if is_not_modified(request, compressed):
+        response = HTTPResponse(304)
     else:
-        resp_msg = HTTPResponse(405).get_response_msg()
+        response = HTTPResponse(200, content_type=body_file.content_type, body_msg=compressed.data,
+                                only_headers=only_headers, content_encoding="gzip")
+    response.headers.update(compressed.validators)
+    body_file.close()
+    return response
 
-    debug_print("->")
-    debug_print(resp_msg)
-    s.send(resp_msg)
-    s.close()
 
+def make_identity_response(request, body_file):
+    """200 with whole file, 304 if client copy is fresh,
+    206 for satisfiable single range, 416 otherwise"""
+    only_headers = request.method_type != GET
+    if is_not_modified(request, body_file):
+        return HTTPResponse(304, body_file=body_file, only_headers=True)
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and (if_range is None or if_range in (body_file.etag, body_file.last_modified)):
+        file_range = parse_range(range_header, body_file.size)
+        if file_range == RANGE_NOT_SATISFIABLE:
+            response = HTTPResponse(416)
+            response.headers["Content-Range"] = "bytes */{}".format(body_file.size)
+            body_file.close()
+            return response
+        if file_range is not None:
+            return HTTPResponse(206, body_file=body_file, file_range=file_range, only_headers=only_headers)
+    return HTTPResponse(200, body_file=body_file, only_headers=only_headers)
 
-def read_file(filename):
-    file_data = []
-    with open(filename, 'rb') as f:
-        for line in f:
-            file_data.append(line)
-    return "".join(file_data)
+
+def is_not_modified(request, body_file):
+    """If-None-Match takes precedence over If-Modified-Since"""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        if if_none_match.strip() == "*":
+            return True
+        # weak comparison
+        etags = [tag.strip() for tag in if_none_match.split(",")]
+        return any((tag[2:] if tag.startswith("W/") else tag) == body_file.etag for tag in etags)
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is not None:
+        date = parsedate_tz(if_modified_since)
+        if date is None:
+            return False
+        try:
+            return int(body_file.mtime) <= mktime_tz(date)
+        except (ValueError, OverflowError):
+            return False
+    return False
+
+
+def parse_range(range_header, size):
+    """(first, last) for single byte range, None if header should be ignored
+    (invalid syntax or several ranges), RANGE_NOT_SATISFIABLE"""
+    unit, _, spec = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, sep, last = spec.strip().partition("-")
+    if not sep:
+        return None
+    try:
+        if not first:
+            # suffix range: last N bytes
+            suffix = int(last)
+            if suffix < 0:
+                return None
+            if suffix == 0 or size == 0:
+                return RANGE_NOT_SATISFIABLE
+            return max(size - suffix, 0), size - 1
+        first = int(first)
+        last = int(last) if last else None
+    except ValueError:
+        return None
+    if first < 0 or last is not None and last < first:
+        return None
+    if first >= size:
+        return RANGE_NOT_SATISFIABLE
+    if last is None or last >= size:
+        last = size - 1
+    return first, last
+
+
+CONTENT_TYPES = {
+    ".html": "text/html",
+    ".css": "text/css",
+    ".js": "text/javascript",
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".png": "image/png",
+    ".gif": "image/gif",
+    ".swf": "application/x-shockwave-flash",
+}
 
 
 def get_content_type(filename):
-    content_type = "text/plain"
-    if filename.endswith(".html"):
-        content_type = "text/html"
-    elif filename.endswith(".css"):
-        content_type = "text/css"
-    elif filename.endswith(".js"):
-        content_type = "text/javascript"
-    elif filename.endswith(".jpg") or filename.endswith(".jpeg"):
-        content_type = "image/jpeg"
-    elif filename.endswith("png"):
-        content_type = "image/png"
-    elif filename.endswith(".gif"):
-        content_type = "image/gif"
-    elif filename.endswith(".swf"):
-        content_type = "application/x-shockwave-flash"
-    return content_type
+    _, ext = os.path.splitext(filename)
+    return CONTENT_TYPES.get(ext, "text/plain")
 
 
 def debug_print(msg):
@@ -186,37 +1103,422 @@ def debug_print(msg):
         print msg
 
 
-def start_server():
-    debug_print("Mainloop   Current process: {}, thread: {}".format(os.getpid(), threading.currentThread().ident))
+def make_server_socket(host, port):
     serv_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    # serv_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    serv_socket.bind(("", 80))
-    serv_socket.listen(5)
-    debug_print("Server started in folder {}".format(DOCUMENT_ROOT))
+    serv_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    serv_socket.bind((host, port))
+    serv_socket.listen(BACKLOG)
+    return serv_socket
+
+
+class AccessLog(object):
+    """Access log in nginx ui_short format, readable by hw1/log_analyzer:
+    $remote_addr $remote_user $http_x_real_ip [$time_local] "$request" $status
+    $body_bytes_sent "$http_referer" "$http_user_agent" "$http_x_forwarded_for"
+    "$http_X_REQUEST_ID" "$http_X_RB_USER" $request_time
+    Request threads only append records to deque, lines are formatted and
+    written in batches by background thread. Workers append to the same file"""
+
+    def __init__(self, path=None, flush_interval=ACCESS_LOG_FLUSH_INTERVAL):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.records = collections.deque()
+        self.fd = None
+        self.flush_lock = threading.Lock()
+        self.time_local = (0, "")
+
+    def start(self):
+        """Open file and start writer thread, called in worker after fork"""
+        if not self.path:
+            return
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        t = threading.Thread(target=self.run)
+        t.daemon = True
+        t.start()
+
+    def log(self, addr, response, body_bytes, started):
+        if self.fd is None:
+            return
+        now = time.time()
+        self.records.append((now, addr, response.request_line, response.request,
+                             response.status, body_bytes, now - started))
+
+    def run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        if self.fd is None:
+            return
+        with self.flush_lock:
+            lines = []
+            records = self.records
+            while records:
+                lines.append(self.format(*records.popleft()))
+            if not lines:
+                return
+            try:
+                # one write of whole lines, O_APPEND keeps lines of workers apart
+                os.write(self.fd, "".join(lines))
+            except EnvironmentError:
+                traceback.print_exc()
+
+    def format(self, now, addr, request_line, request, status, body_bytes, request_time):
+        second, time_local = self.time_local
+        if second != int(now):
+            time_local = time.strftime("%d/%b/%Y:%H:%M:%S +0000", time.gmtime(now))
+            self.time_local = (int(now), time_local)
+        headers = request.headers if request is not None else {}
+        return '{} - {} [{}] "{}" {} {} "{}" "{}" "{}" "{}" "{}" {:.3f}\n'.format(
+            addr[0] if addr else "-", log_value(headers.get("x-real-ip", "-")), time_local,
+            log_value(request_line), status, body_bytes,
+            log_value(headers.get("referer", "-")), log_value(headers.get("user-agent", "-")),
+            log_value(headers.get("x-forwarded-for", "-")), log_value(headers.get("x-request-id", "-")),
+            log_value(headers.get("x-rb-user", "-")), request_time)
+
+
+def log_value(value):
+    """Escape quotes like nginx does, so fields can be split by quotes"""
+    return value.replace("\\", "\\x5C").replace('"', "\\x22")
+
+
+access_log = AccessLog()
+
+
+def handle_client_safe(conn, idle):
+    try:
+        handle_client(conn, idle)
+    except EnvironmentError as e:
+        # client gone
+        if e.errno not in (errno.EPIPE, errno.ECONNRESET):
+            traceback.print_exc()
+        conn.close()
+    except Exception:
+        traceback.print_exc()
+        conn.close()
+
+
+def pool_thread(clients, idle):
     while True:
-        cl_socket, addr = serv_socket.accept()
-        # cl_socket.settimeout(5)
-        debug_print("Connection accepted {}\n".format(str(addr)))
-        t = threading.Thread(target=handle_client, args=(cl_socket,))
+        conn = clients.get()
+        handle_client_safe(conn, idle)
+        clients.task_done()
+
+
+def serve_forever(serv_socket, threads):
+    """Worker loop: accept connections on shared socket and handle them in
+    a pool of threads. When all threads are busy worker stops accepting,
+    so pending connections go to other workers. Connections without received
+    requests wait in IdleConnections, not in pool threads"""
+    clients = Queue(maxsize=threads)
+    idle = IdleConnections(clients)
+    t = threading.Thread(target=idle.run, name="idle")
+    t.daemon = True
+    t.start()
+    for _ in range(threads):
+        t = threading.Thread(target=pool_thread, args=(clients, idle))
+        t.daemon = True
         t.start()
-        debug_print(t.isAlive())
-        # handle_client(cl_socket)
+    while True:
+        try:
+            cl_socket, addr = serv_socket.accept()
+        except socket.error as e:
+            if e.errno in (errno.EINTR, errno.EAGAIN, errno.ECONNABORTED):
+                continue
+            raise
+        debug_print("Connection accepted {}\n".format(str(addr)))
+        # headers and sendfile body are separate writes, don't wait for ack
+        # of headers on keep-alive connections (Nagle + delayed ack)
+        cl_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        clients.put(PooledConnection(cl_socket, addr))
+
+
+class Connection(object):
+    """Client connection in epoll mode. State machine:
+    READING - collect request until end of headers, then make whole response
+    WRITING - send response, partial writes continue on next EPOLLOUT
+    CLOSED - connection should be unregistered and closed
+    After response is sent keep-alive connection goes back to READING,
+    pipelined requests are taken from the same buffer"""
+    READING = "reading"
+    WRITING = "writing"
+    CLOSED = "closed"
+
+    def __init__(self, sock, addr):
+        self.sock = sock
+        self.addr = addr
+        self.state = self.READING
+        self.buf = RequestBuffer()
+        self.served = 0
+        self.peer_closed = False
+        self.response = None
+        self.resp_parts = None
+        self.resp_size = 0
+        self.sent = 0
+        self.file_offset = 0
+        self.started = 0
+        self.last_activity = time.time()
+
+    def on_readable(self):
+        # edge-triggered: read until EAGAIN, responses are made as soon as
+        # requests are complete, leftovers of pipelined requests go first
+        self.process()
+        while self.state == self.READING and not self.peer_closed:
+            try:
+                received = self.buf.recv_from(self.sock)
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                self.state = self.CLOSED
+                return
+            if received:
+                self.last_activity = time.time()
+            else:
+                self.peer_closed = True
+            self.process()
+
+    def process(self):
+        """Make responses for buffered requests while socket accepts writes"""
+        while self.state == self.READING:
+            request_msg = self.buf.pop_request()
+            if request_msg is not None:
+                self.served += 1
+                self.started = time.time()
+                self.start_response(make_response(request_msg, self.served < MAX_KEEP_ALIVE_REQUESTS))
+            elif len(self.buf) > MAX_HEADERS_SIZE:
+                self.started = time.time()
+                self.start_response(HTTPResponse(400))
+            elif self.peer_closed:
+                self.state = self.CLOSED
+            else:
+                return
+
+    def start_response(self, response):
+        self.response = response
+        self.resp_parts = response.get_response_parts()
+        self.resp_size = sum(len(part) for part in self.resp_parts)
+        self.sent = 0
+        self.file_offset = response.body_file_offset
+        self.state = self.WRITING
+        self.on_writable()
+
+    def finish_response(self):
+        response = self.response
+        body_bytes = (self.sent - len(self.resp_parts[0])) + (self.file_offset - response.body_file_offset)
+        access_log.log(self.addr, response, body_bytes, self.started)
+        keep_alive = response.keep_alive
+        response.close()
+        self.response = self.resp_parts = None
+        self.state = self.READING if keep_alive else self.CLOSED
+
+    def on_writable(self):
+        """Write headers and in-memory body with writev, then file body with sendfile"""
+        response = self.response
+        while self.state == self.WRITING:
+            try:
+                if self.sent < self.resp_size:
+                    self.sent += send_parts(self.sock, self.resp_parts, self.sent)
+                elif response.body_file is not None and self.file_offset < response.body_file_end:
+                    sent = send_file_part(self.sock, response.body_file, self.file_offset,
+                                          response.body_file_end - self.file_offset)
+                    if not sent:
+                        # file was truncated after fstat
+                        self.state = self.CLOSED
+                    self.file_offset += sent
+                else:
+                    self.finish_response()
+            except EnvironmentError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                self.state = self.CLOSED
+                return
+            self.last_activity = time.time()
+
+    def close(self):
+        self.state = self.CLOSED
+        if self.response is not None:
+            self.response.close()
+        self.sock.close()
+
+
+def serve_forever_epoll(serv_socket):
+    """Worker loop for epoll mode: edge-triggered, non-blocking sockets,
+    one thread serves all connections of the worker"""
+    serv_socket.setblocking(0)
+    serv_fd = serv_socket.fileno()
+    epoll = select.epoll()
+    epoll.register(serv_fd, select.EPOLLIN | select.EPOLLET)
+    connections = {}
+    last_sweep = time.time()
+    while True:
+        try:
+            events = epoll.poll(1)
+        except IOError as e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+
+        for fd, event in events:
+            if fd == serv_fd:
+                accept_all(serv_socket, epoll, connections)
+                continue
+            conn = connections.get(fd)
+            if conn is None:
+                continue
+            state = conn.state
+            try:
+                if event & select.EPOLLIN and conn.state == Connection.READING:
+                    conn.on_readable()
+                if event & select.EPOLLOUT and conn.state == Connection.WRITING:
+                    conn.on_writable()
+                    if conn.state == Connection.READING:
+                        # keep-alive: serve pipelined requests already buffered
+                        conn.on_readable()
+            except Exception:
+                # error of one connection must not stop the worker
+                traceback.print_exc()
+                conn.state = Connection.CLOSED
+            if event & (select.EPOLLERR | select.EPOLLHUP):
+                conn.state = Connection.CLOSED
+            update_connection(epoll, connections, fd, conn, state)
+
+        now = time.time()
+        if now - last_sweep > 1:
+            last_sweep = now
+            for fd, conn in connections.items():
+                if now - conn.last_activity > KEEP_ALIVE_TIMEOUT:
+                    conn.state = Connection.CLOSED
+                    update_connection(epoll, connections, fd, conn, None)
+
+
+def accept_all(serv_socket, epoll, connections):
+    # edge-triggered: accept until queue is empty
+    while True:
+        try:
+            cl_socket, addr = serv_socket.accept()
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ECONNABORTED, errno.EINTR):
+                return
+            raise
+        debug_print("Connection accepted {}\n".format(str(addr)))
+        cl_socket.setblocking(0)
+        cl_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn = Connection(cl_socket, addr)
+        connections[cl_socket.fileno()] = conn
+        epoll.register(cl_socket.fileno(), select.EPOLLIN | select.EPOLLET)
+
+
+def update_connection(epoll, connections, fd, conn, prev_state):
+    if conn.state == Connection.CLOSED:
+        epoll.unregister(fd)
+        del connections[fd]
+        conn.close()
+    elif conn.state != prev_state:
+        if conn.state == Connection.WRITING:
+            epoll.modify(fd, select.EPOLLOUT | select.EPOLLET)
+        else:
+            epoll.modify(fd, select.EPOLLIN | select.EPOLLET)
+
+
+def spawn_worker(serv_socket, threads, mode):
+    pid = os.fork()
+    if pid:
+        return pid
+    # worker
+    def terminate(signum, frame):
+        raise SystemExit(0)
+    signal.signal(signal.SIGTERM, terminate)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    debug_print("Worker {} started".format(os.getpid()))
+    try:
+        access_log.start()
+        if mode == EPOLL_MODE:
+            serve_forever_epoll(serv_socket)
+        else:
+            serve_forever(serv_socket, threads)
+    except Exception:
+        traceback.print_exc()
+    finally:
+        # records of last flush interval
+        access_log.flush()
+        os._exit(1)
+
+
+def stop_workers(workers):
+    for pid in workers:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass
+    for pid in workers:
+        try:
+            os.waitpid(pid, 0)
+        except OSError:
+            pass
+
+
+def start_server(host, port, workers, threads, mode=MODE):
+    """Pre-fork master: bind once, fork workers accepting on the shared
+    socket and respawn the ones which exit"""
+    debug_print("Master {}".format(os.getpid()))
+    serv_socket = make_server_socket(host, port)
+    debug_print("Server started in folder {} on port {}, mode {}".format(DOCUMENT_ROOT, port, mode))
+
+    def terminate(signum, frame):
+        raise SystemExit(0)
+    signal.signal(signal.SIGTERM, terminate)
+
+    started = {}
+    try:
+        for _ in range(workers):
+            started[spawn_worker(serv_socket, threads, mode)] = time.time()
+        while True:
+            try:
+                pid, status = os.wait()
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            if pid not in started:
+                continue
+            debug_print("Worker {} exited with status {}, respawning".format(pid, status))
+            if time.time() - started.pop(pid) < MIN_WORKER_LIFETIME:
+                time.sleep(MIN_WORKER_LIFETIME)
+            started[spawn_worker(serv_socket, threads, mode)] = time.time()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_workers(started)
+        serv_socket.close()
 
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Simple threaded web server")
-    parser.add_argument('-w', type=int, help="Amount of workers")
+    parser = argparse.ArgumentParser(description="Simple pre-fork web server")
+    parser.add_argument('-w', type=int, default=WORKERS, help="Amount of workers")
+    parser.add_argument('-t', type=int, default=THREADS, help="Amount of threads in every worker")
     parser.add_argument('-r', type=str, help="Document root for web server")
+    parser.add_argument('-p', type=int, default=PORT, help="Port")
+    parser.add_argument('-m', choices=(THREAD_MODE, EPOLL_MODE), default=MODE,
+                        help="Worker mode: thread pool or epoll event loop")
+    parser.add_argument('-c', type=int, default=FILE_CACHE_SIZE, help="Open files cache size, 0 to disable")
+    parser.add_argument('-l', type=int, default=DIR_CACHE_SIZE // (1024 * 1024),
+                        help="Directory listings cache size in MB, 0 to disable")
+    parser.add_argument('-z', type=int, default=GZIP_CACHE_SIZE // (1024 * 1024),
+                        help="Compressed files cache size in MB, 0 to disable on-the-fly gzip")
+    parser.add_argument('-a', type=str, help="Access log file in ui_short format")
+    parser.add_argument('-d', action="store_true", help="Print requests and responses to stdout")
+    parser.add_argument('-k', type=int, default=KEEP_ALIVE_TIMEOUT, help="Keep-alive timeout in seconds")
+    parser.add_argument('-n', type=int, default=MAX_KEEP_ALIVE_REQUESTS,
+                        help="Max requests per keep-alive connection, 1 to disable keep-alive")
     args = parser.parse_args()
-    if args.w:
-        workers = args.w
-    else:
-        workers = 1
     if args.r:
         DOCUMENT_ROOT = args.r
-    debug_print("Master " + str(os.getpid()))
-    # Запускаем необходимое инстансов сервера
-    # for _ in range(workers):
-    #     p = multiprocessing.Process(target=start_server())
-    #     p.start()
-    start_server()
+    access_log.path = args.a
+    DEBUG = args.d
+    file_cache.maxsize = args.c
+    gzip_cache.maxsize = args.z * 1024 * 1024
+    dir_cache.maxsize = args.l * 1024 * 1024
+    KEEP_ALIVE_TIMEOUT = max(args.k, 1)
+    MAX_KEEP_ALIVE_REQUESTS = max(args.n, 1)
+    start_server(HOST, args.p, max(args.w, 1), max(args.t, 1), args.m)
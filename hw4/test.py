@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+
+# Поведенческие тесты httpd: сервер запускается отдельным процессом в каждом
+# из режимов (thread, epoll) на временном DOCUMENT_ROOT, оба режима проходят
+# одни и те же проверки.
+
+# $ python -m unittest test
+
+import httplib
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+import bench
+import httpd
+from benchstats import wait_port
+
+FILE_DATA = "".join(chr(i % 256) for i in range(1000))
+
+
+def free_port():
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+class ServerBehaviour(object):
+    mode = None
+    server_args = []
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.mkdtemp(prefix="httpd-test-")
+        cls.root = os.path.join(cls.tmp, "root")
+        os.makedirs(os.path.join(cls.root, "dir"))
+        with open(os.path.join(cls.root, "file.bin"), "wb") as f:
+            f.write(FILE_DATA)
+        with open(os.path.join(cls.root, "dir", "a.txt"), "wb") as f:
+            f.write("a")
+        with open(os.path.join(cls.tmp, "secret.txt"), "wb") as f:
+            f.write("secret")
+        cls.port = free_port()
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "httpd.py")
+        cmd = [sys.executable, path, "-m", cls.mode, "-w", "1", "-t", "4",
+               "-r", cls.root, "-p", str(cls.port)] + cls.server_args
+        with open(os.devnull, "w") as devnull:
+            cls.proc = subprocess.Popen(cmd, stdout=devnull, stderr=devnull)
+        wait_port(cls.port)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.proc.terminate()
+        cls.proc.wait()
+        shutil.rmtree(cls.tmp)
+
+    def connect(self):
+        return socket.create_connection(("127.0.0.1", self.port), timeout=5)
+
+    def request(self, method, uri, headers=None):
+        conn = httplib.HTTPConnection("127.0.0.1", self.port, timeout=5)
+        try:
+            conn.putrequest(method, uri, skip_accept_encoding=True)
+            for name, value in (headers or {}).items():
+                conn.putheader(name, value)
+            conn.endheaders()
+            response = conn.getresponse()
+            return response.status, dict(response.getheaders()), response.read()
+        finally:
+            conn.close()
+
+    def read_response(self, sock, method="GET"):
+        response = httplib.HTTPResponse(sock, method=method)
+        response.begin()
+        return response.status, dict(response.getheaders()), response.read()
+
+    def test_get(self):
+        status, headers, body = self.request("GET", "/file.bin")
+        self.assertEqual(status, 200)
+        self.assertEqual(headers["content-length"], str(len(FILE_DATA)))
+        self.assertEqual(body, FILE_DATA)
+
+    def test_head(self):
+        status, headers, body = self.request("HEAD", "/file.bin")
+        self.assertEqual(status, 200)
+        self.assertEqual(headers["content-length"], str(len(FILE_DATA)))
+        self.assertEqual(body, "")
+
+    def test_not_found(self):
+        self.assertEqual(self.request("GET", "/missing.bin")[0], 404)
+
+    def test_method_not_allowed(self):
+        self.assertEqual(self.request("POST", "/file.bin")[0], 405)
+
+    def test_range(self):
+        status, headers, body = self.request("GET", "/file.bin", {"Range": "bytes=10-19"})
+        self.assertEqual(status, 206)
+        self.assertEqual(headers["content-range"], "bytes 10-19/%d" % len(FILE_DATA))
+        self.assertEqual(body, FILE_DATA[10:20])
+        status, headers, body = self.request("GET", "/file.bin", {"Range": "bytes=-5"})
+        self.assertEqual((status, body), (206, FILE_DATA[-5:]))
+        status, headers, _ = self.request("GET", "/file.bin", {"Range": "bytes=5000-"})
+        self.assertEqual(status, 416)
+        self.assertEqual(headers["content-range"], "bytes */%d" % len(FILE_DATA))
+
+    def test_not_modified(self):
+        _, headers, _ = self.request("GET", "/file.bin")
+        status, _, body = self.request("GET", "/file.bin", {"If-None-Match": headers["etag"]})
+        self.assertEqual((status, body), (304, ""))
+        status, _, body = self.request("GET", "/file.bin", {"If-Modified-Since": headers["last-modified"]})
+        self.assertEqual((status, body), (304, ""))
+        status, _, _ = self.request("GET", "/file.bin", {"If-None-Match": '"other"'})
+        self.assertEqual(status, 200)
+
+    def test_traversal(self):
+        for uri in ("/../secret.txt", "/dir/../../secret.txt", "/%2e%2e/secret.txt"):
+            status, _, body = self.request("GET", uri)
+            self.assertEqual(status, 403, uri)
+            self.assertNotIn("secret", body)
+
+    def test_directory_listing(self):
+        status, _, body = self.request("GET", "/dir/")
+        self.assertEqual(status, 200)
+        self.assertIn("a.txt", body)
+
+    def test_pipelining(self):
+        sock = self.connect()
+        sock.sendall("GET /file.bin HTTP/1.1\r\nHost: x\r\n\r\n"
+                     "HEAD /file.bin HTTP/1.1\r\nHost: x\r\n\r\n"
+                     "GET /missing.bin HTTP/1.1\r\nHost: x\r\n\r\n"
+                     "GET /dir/a.txt HTTP/1.1\r\nHost: x\r\nConnection: close\r\n\r\n")
+        try:
+            self.assertEqual(self.read_response(sock)[::2], (200, FILE_DATA))
+            self.assertEqual(self.read_response(sock, "HEAD")[::2], (200, ""))
+            self.assertEqual(self.read_response(sock)[0], 404)
+            status, headers, body = self.read_response(sock)
+            self.assertEqual((status, body, headers["connection"]), (200, "a", "close"))
+            self.assertEqual(sock.recv(1), "")
+        finally:
+            sock.close()
+
+    def test_idle_keep_alive_connections(self):
+        # more idle keep-alive clients than threads in the worker
+        idle = [self.connect() for _ in range(8)]
+        try:
+            for sock in idle:
+                sock.sendall("GET /dir/a.txt HTTP/1.1\r\nHost: x\r\n\r\n")
+                self.assertEqual(self.read_response(sock)[0], 200)
+            started = time.time()
+            self.assertEqual(self.request("GET", "/dir/a.txt")[0], 200)
+            self.assertLess(time.time() - started, 1)
+            # idle connections are still served
+            for sock in idle:
+                sock.sendall("GET /dir/a.txt HTTP/1.1\r\nHost: x\r\n\r\n")
+                self.assertEqual(self.read_response(sock)[::2], (200, "a"))
+        finally:
+            for sock in idle:
+                sock.close()
+
+    def test_bad_uri_does_not_break_other_connections(self):
+        idle = self.connect()
+        try:
+            idle.sendall("GET /dir/a.txt HTTP/1.1\r\nHost: x\r\n\r\n")
+            self.assertEqual(self.read_response(idle)[0], 200)
+            for uri in ("/a%00b", "/%ff%fe"):
+                self.assertEqual(self.request("GET", uri)[0], 400, uri)
+            # same worker still serves the connection opened before
+            idle.sendall("GET /dir/a.txt HTTP/1.1\r\nHost: x\r\n\r\n")
+            self.assertEqual(self.read_response(idle)[::2], (200, "a"))
+        finally:
+            idle.close()
+
+
+class TestCaches(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="httpd-test-")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_dir_listing_all_names_paginated(self):
+        for i in range(30):
+            open(os.path.join(self.tmp, "f%02d" % i), "w").close()
+        os.mkdir(os.path.join(self.tmp, "sub"))
+        old_page_size, httpd.LISTING_PAGE_SIZE = httpd.LISTING_PAGE_SIZE, 10
+        try:
+            listing = httpd.DirListing(self.tmp, "/", os.stat(self.tmp))
+            self.assertEqual(listing.pages_count, 4)
+            self.assertIn('href="sub/"', listing.get_page(1))
+            self.assertIn('href="f29"', listing.get_page(4))
+            self.assertIsNone(listing.get_page(5))
+        finally:
+            httpd.LISTING_PAGE_SIZE = old_page_size
+        self.assertEqual(len(listing.names), 31)
+        self.assertEqual(listing.names.get_range(0, 3), ["sub/", "f00", "f01"])
+        self.assertEqual(listing.names.get_range(29, 40), ["f28", "f29"])
+        # without subdirectories entries are not stat'ed
+        self.assertEqual(httpd.list_dir(os.path.join(self.tmp, "sub"), nlink=2), [])
+
+    def test_dir_listing_larger_than_cache_not_cached(self):
+        for i in range(30):
+            open(os.path.join(self.tmp, "file-%d" % i), "w").close()
+        cache = httpd.DirListingCache(maxsize=httpd.DIR_ENTRY_OVERHEAD + 100)
+        self.assertIn("file-29", cache.get_page(self.tmp, "/", 1))
+        self.assertEqual((len(cache.entries), cache.size), (0, 0))
+
+    def test_dir_cache_bounded_by_bytes(self):
+        dirs = []
+        for i in range(5):
+            path = os.path.join(self.tmp, "d%d" % i)
+            os.mkdir(path)
+            for j in range(20):
+                open(os.path.join(path, "file-%d" % j), "w").close()
+            dirs.append(path)
+        one = httpd.DirListing(dirs[0], "/d0/", os.stat(dirs[0]))
+        one.get_page(1)
+        cache = httpd.DirListingCache(maxsize=one.size * 2)
+        for path in dirs:
+            self.assertIn("file-19", cache.get_page(path, "/", 1))
+            self.assertLessEqual(cache.size, cache.maxsize)
+        self.assertEqual(len(cache.entries), 2)
+        self.assertEqual(cache.size, sum(listing.size for listing in cache.entries.values()))
+        self.assertIsNone(cache.get_page(dirs[0], "/", 2))
+
+    def test_gzip_cache_counts_not_compressible(self):
+        cache = httpd.GzipCache(maxsize=httpd.GZIP_ENTRY_OVERHEAD * 3)
+        for i in range(10):
+            path = os.path.join(self.tmp, "f%d.html" % i)
+            with open(path, "wb") as f:
+                f.write(os.urandom(300))
+            body_file = httpd.file_cache.get(path)
+            self.assertIsNone(cache.get(body_file).data)
+            httpd.file_cache.release(body_file)
+        self.assertEqual(len(cache.entries), 3)
+
+    def test_files_released_on_internal_error(self):
+        with open(os.path.join(self.tmp, "a.txt"), "wb") as f:
+            f.write("a")
+        with open(os.path.join(self.tmp, "b.html"), "wb") as f:
+            f.write("<html></html>")
+        with open(os.path.join(self.tmp, "b.html.gz"), "wb") as f:
+            f.write("gz")
+
+        def fail(*args):
+            raise RuntimeError("fail")
+
+        saved = httpd.DOCUMENT_ROOT, httpd.file_cache, httpd.is_not_modified
+        httpd.DOCUMENT_ROOT, httpd.file_cache, httpd.is_not_modified = self.tmp, httpd.FileCache(), fail
+        try:
+            for uri, headers in (("/a.txt", ""), ("/b.html", "Accept-Encoding: gzip\r\n")):
+                msg = "GET {} HTTP/1.1\r\nHost: x\r\n{}\r\n".format(uri, headers)
+                self.assertEqual(httpd.make_response(msg, keep_alive=True).status, 500, uri)
+            entries = httpd.file_cache.entries
+        finally:
+            httpd.DOCUMENT_ROOT, httpd.file_cache, httpd.is_not_modified = saved
+        self.assertEqual(sorted(os.path.basename(path) for path in entries), ["a.txt", "b.html", "b.html.gz"])
+        self.assertEqual([entry.users for entry in entries.values()], [0, 0, 0])
+
+
+class TestBench(unittest.TestCase):
+    def make_results(self, **modes):
+        return {"modes": {mode: {"total": {"rps": rps, "error_rate": 0.0, "latency_ms": {"p50": 1.0, "p99": 5.0}}}
+                          for mode, rps in modes.items()}}
+
+    def test_compare_by_mode(self):
+        baseline = self.make_results(thread=1000, epoll=1000)
+        self.assertEqual(bench.compare(self.make_results(thread=950, epoll=1100), baseline, 0.1), [])
+        self.assertEqual(bench.compare(self.make_results(thread=800, epoll=1000), baseline, 0.1),
+                         ["thread: rps 800.0 < baseline 1000.0"])
+        # modes missing in baseline are skipped
+        self.assertEqual(bench.compare(self.make_results(epoll=10), self.make_results(thread=1000), 0.1), [])
+
+    def test_parse_files(self):
+        self.assertEqual(bench.parse_files("small=1024:70,large=1048576"),
+                         [("small", 1024, 70), ("large", 1048576, 1)])
+
+
+class TestThreadMode(ServerBehaviour, unittest.TestCase):
+    mode = httpd.THREAD_MODE
+
+
+class TestEpollMode(ServerBehaviour, unittest.TestCase):
+    mode = httpd.EPOLL_MODE
+
+
+if __name__ == "__main__":
+    unittest.main()